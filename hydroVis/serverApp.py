@@ -1,8 +1,10 @@
 import json
 import os
+import gzip
 import math
 import argparse
-from flask import Flask, render_template, request
+import threading
+from flask import Flask, render_template, request, Response, g
 from time import time_ns
 
 from webServer.dataCube import DataCube
@@ -10,6 +12,15 @@ from webServer.routeLink import RouteLinkData
 from webServer.assimilationData import AssimilationData
 from webServer.observationData import ObservationData
 from webServer.openloopData import OpenLoopData
+from webServer.cubeWatcher import CubeWatcher
+from webServer.ncHandleCache import NcHandleCache
+from webServer.queryCache import QueryCache
+from webServer.serving import ReadPool, serve
+from webServer.metrics import Metrics
+from webServer.buildStatus import BuildStatus
+from webServer.timeWindow import TimeWindowPager
+from webServer.verificationData import VerificationData
+from webServer.riverTopology import basinReducers
 
 app = Flask('hydroVis')
 
@@ -20,61 +31,282 @@ if __name__=='__main__':
     parser.add_argument('-rl', '--routeLinkFilePath', required=True)
     parser.add_argument('-p', '--portNum', type=int, default=8000)
     parser.add_argument('-xr', '--createXarrayFromScratch', action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes used to build the datacube, one cycle per task')
+    parser.add_argument('-a', '--appendNewCycles', action='store_true', help='ingest the cycles finished since the datacube was persisted')
+    parser.add_argument('--watchInterval', type=int, default=0, help='poll output/ for newly finished cycles every given number of seconds, 0 disables')
+    parser.add_argument('--cubeBackend', choices=['memory', 'chunked'], default='memory', help='hold the datacube in memory or read it lazily from the chunked files on disk')
+    parser.add_argument('--dualLayout', action='store_true', help='also persist a link major chunking of the datacube for fast hydrograph reads')
+    parser.add_argument('--maxOpenFiles', type=int, default=None, help='number of netcdf files kept open by the file access paths, by default max(64, 3 x ensemble members), enough for the preassim, analysis and openloop files of every member')
+    parser.add_argument('--queryCacheMB', type=int, default=256, help='memory budget of the cache of serialized query results')
+    parser.add_argument('--obsSeqReader', choices=['netcdf', 'native'], default='netcdf', help="read the obs_seq files after converting them with DART's obs_seq_to_netcdf, or directly without a DART build")
+    parser.add_argument('--storageDtype', choices=['float64', 'float32', 'int16'], default='float64', help='precision of the datacube variables in memory and on disk, int16 packs each variable with a scale and offset')
+    parser.add_argument('--chunkCacheMB', type=int, default=1024, help='memory budget of the chunk cache of the chunked datacube backend')
+    parser.add_argument('--server', choices=['development', 'waitress', 'gunicorn'], default='development', help='the Flask development server, or a production server for many concurrent users')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--serverWorkers', type=int, default=1, help='number of gunicorn worker processes, forked after the datacube is built')
+    parser.add_argument('--serverThreads', type=int, default=8, help='number of request threads of each waitress or gunicorn worker')
+    parser.add_argument('--traceFile', default=None, help='append one json line with the phase timings of every request to this file')
+    parser.add_argument('--serveWhileBuilding', action='store_true', help='start serving right away and build the datacube in the background, see /getStatus')
+    parser.add_argument('--initialCycles', type=int, default=1, help='with --serveWhileBuilding, number of cycles built before the data endpoints are served')
+    parser.add_argument('--buildBatchCycles', type=int, default=0, help='with --serveWhileBuilding, number of cycles appended at a time after the initial ones, 0 for the number of build workers')
+    parser.add_argument('--timeWindow', type=int, default=0, help='with --cubeBackend chunked, number of cycles per time window, the cube is built and persisted one window at a time and the map data is read ahead by windows, 0 builds every cycle at once; implies --dualLayout, so that the hydrographs do not read the time major chunks of every window')
+    parser.add_argument('--prefetchWindows', type=int, default=1, help='number of windows read ahead on each side of the requested timestamp, with --cubeBackend chunked')
+    parser.add_argument('--readThreads', type=int, default=4, help='number of concurrent datacube reads of each worker')
+    parser.add_argument('--maxBatchLinks', type=int, default=500, help='largest number of links returned by /getBatchHydrographData and /getUpstreamLinks')
 
     args = parser.parse_args()
+    if args.timeWindow > 0 and args.cubeBackend != 'chunked':
+        # the memory backend would concatenate the whole cube for every window
+        parser.error('--timeWindow requires --cubeBackend chunked')
+    if args.timeWindow > 0:
+        # the hydrographs read the link major layout, one chunk per link instead of one per window
+        args.dualLayout = True
 
-    start = time_ns()
-    datacube = DataCube()
+    datacube = DataCube(args.cubeBackend, args.chunkCacheMB * 1024 * 1024, args.dualLayout, args.storageDtype)
+    # sized from the ensemble once the assimilation data is loaded, see buildDatacube
+    ncHandles = NcHandleCache(args.maxOpenFiles or 64)
 
-    rlData = RouteLinkData(args.routeLinkFilePath, datacube, args.createXarrayFromScratch)
-    print("Loaded route link data")
-    ensemble = AssimilationData(args.daDataPath, rlData, datacube, args.createXarrayFromScratch)
-    print("Loaded assimilation data")
-    observations = ObservationData(args.daDataPath, ensemble.timestamps, datacube, args.createXarrayFromScratch)
-    print("Loaded observation data")
-    openLoop = OpenLoopData(args.openLoopDataPath, ensemble.timestamps, ensemble.numEnsembleModels, rlData, datacube, args.createXarrayFromScratch)
-    print("Loaded open loop data")
+    # set by buildDatacube, the endpoints needing them wait for their build stage (see checkBuildStage)
+    rlData = ensemble = observations = openLoop = verification = watcher = pager = None
+    buildStatus = BuildStatus()
 
-    print(f'createDatacube: {(time_ns() - start) * math.pow(10, -6)} ms')
-    # datacube bookkeeping
-    datacube.bookkeeping(args.createXarrayFromScratch)
+    def buildDatacube(initialCycles=None, batchCycles=1, persistBatches=False):
+        # build the datacube stage by stage
+        # with initialCycles, the cube is first built from the first cycles, the remaining ones are then
+        # appended batchCycles at a time and listed in the timestamps as soon as they are queryable
+        # with persistBatches, every batch is written out, so that the chunked backend releases it from memory
+        global rlData, ensemble, observations, openLoop, verification, watcher, pager
+        stage = 'routeLink'
+        try:
+            start = time_ns()
+            buildStatus.begin(stage)
+            rlData = RouteLinkData(args.routeLinkFilePath, datacube, args.createXarrayFromScratch)
+            buildStatus.end(stage)
+            print("Loaded route link data")
+
+            stage = 'assimilation'
+            buildStatus.begin(stage)
+            ensemble = AssimilationData(args.daDataPath, rlData, datacube, args.createXarrayFromScratch, args.workers, ncHandles, initialCycles)
+            # a hydrograph or append pass opens the preassim and analysis files of every member, and the openloop members,
+            # with a smaller budget the handles are closed and reopened on every request
+            filesPerCycle = 3 * ensemble.numEnsembleModels
+            if args.maxOpenFiles is None:
+                ncHandles.resize(max(64, filesPerCycle))
+            elif args.maxOpenFiles < filesPerCycle:
+                print(f'Warning: --maxOpenFiles {args.maxOpenFiles} is below the {filesPerCycle} files of a cycle, the file handles will be reopened on every request')
+            buildStatus.end(stage)
+            print("Loaded assimilation data")
+            if args.timeWindow > 0:
+                pager = TimeWindowPager(datacube, ensemble.timestamps, args.timeWindow, args.prefetchWindows)
+
+            stage = 'observation'
+            buildStatus.begin(stage)
+            observations = ObservationData(args.daDataPath, ensemble.timestamps, datacube, args.createXarrayFromScratch, args.workers, args.obsSeqReader)
+            rlData.updateGaugeDescriptor(observations.observation_gauge_data.coords['linkID'].values, datacube)
+            buildStatus.end(stage)
+            print("Loaded observation data")
+
+            stage = 'openloop'
+            buildStatus.begin(stage)
+            openLoop = OpenLoopData(args.openLoopDataPath, ensemble.timestamps, ensemble.numEnsembleModels, ensemble.stateVariables, rlData, datacube, args.createXarrayFromScratch, args.workers)
+            # the derived diagnostics need the openloop values
+            ensemble.addDerivedDataArrays(datacube, args.createXarrayFromScratch)
+            # the verification statistics need the openloop members as well
+            verification = VerificationData(ensemble, observations, datacube, args.createXarrayFromScratch)
+            buildStatus.end(stage)
+            print("Loaded open loop data")
+
+            # incremental updates for newly finished DA cycles
+            watcher = CubeWatcher(datacube, ensemble, observations, openLoop, args.watchInterval, verification=verification)
+
+            stage = 'cycles'
+            buildStatus.begin(stage)
+            numCycles = len(ensemble.timestamps) + len(ensemble.pendingTimestamps)
+            remainingCycles = len(ensemble.pendingTimestamps)
+            buildStatus.setCycles(len(ensemble.timestamps), numCycles)
+            while remainingCycles > 0:
+                appendedTimestamps = watcher.update(min(batchCycles, remainingCycles), persist=persistBatches)
+                if not appendedTimestamps:
+                    break
+                remainingCycles -= len(appendedTimestamps)
+                buildStatus.setCycles(len(ensemble.timestamps), numCycles)
+            buildStatus.end(stage)
+
+            print(f'createDatacube: {(time_ns() - start) * math.pow(10, -6)} ms')
+
+            stage = 'persist'
+            buildStatus.begin(stage)
+            # datacube bookkeeping
+            datacube.bookkeeping(args.createXarrayFromScratch)
+            buildStatus.end(stage)
+
+            if args.appendNewCycles:
+                watcher.update()
+            if args.watchInterval > 0:
+                if args.server == 'gunicorn' and args.serverWorkers > 1:
+                    # the watcher would only update the datacube of this (master) process, not the forked workers
+                    print('--watchInterval requires a single server process, use --serverWorkers 1 with more --serverThreads, or restart with --appendNewCycles')
+                else:
+                    watcher.start()
+
+        except Exception as e:
+            buildStatus.fail(stage, e)
+            raise
+
+    # long experiments are built one time window at a time, with the chunked backend every window
+    # is persisted and released from memory before the next one is loaded
+    windowCycles = args.timeWindow if args.timeWindow > 0 else None
+    persistBatches = windowCycles is not None
+    if args.serveWhileBuilding and not (args.server == 'gunicorn' and args.serverWorkers > 1):
+        threading.Thread(target=buildDatacube, args=(args.initialCycles, windowCycles or args.buildBatchCycles or max(args.workers, 1), persistBatches), name='buildDatacube', daemon=True).start()
+    else:
+        if args.serveWhileBuilding:
+            # the gunicorn workers are forked with the datacube, it has to be built first
+            print('--serveWhileBuilding requires a single server process, building the datacube first')
+        buildDatacube(windowCycles, windowCycles, persistBatches)
+
+    queryCache = QueryCache(args.queryCacheMB * 1024 * 1024)
+    readPool = ReadPool(args.readThreads)
+    metrics = Metrics(args.traceFile)
+
+    @app.before_request
+    def beginRequest():
+        g.requestTimer = metrics.beginRequest(request.endpoint or request.path)
+
+    # build stage needed by each endpoint, the others are served right away
+    requiredStage = {
+        'getRouteLinkData': 'routeLink',
+        'getLonLatBoundingBox': 'routeLink',
+        'getUIParameters': 'assimilation',
+        'getTimestamps': 'assimilation',
+        'getMapLinkIDs': 'assimilation',
+        'getGaugeLocations': 'observation',
+        'getMapData': 'openloop',
+        'getDistributionData': 'openloop',
+        'getHydrographStateVariableData': 'openloop',
+        'getHydrographInflationData': 'openloop',
+        'getBatchHydrographData': 'openloop',
+        'getUpstreamLinks': 'routeLink',
+        'getDownstreamLinks': 'routeLink',
+        'getBasinAggregateData': 'openloop',
+        'getVerificationMapData': 'openloop',
+        'getVerificationTableData': 'openloop',
+        'getRankHistogramData': 'openloop'
+    }
+
+    @app.before_request
+    def checkBuildStage():
+        stage = requiredStage.get(request.endpoint)
+        if stage is not None and not buildStatus.isDone(stage):
+            # not built yet, the client retries later, see /getStatus for the progress
+            response = Response(json.dumps(buildStatus.summary()), status=503, mimetype='application/json')
+            response.headers['Retry-After'] = '5'
+            return response
+
+    @app.after_request
+    def endRequest(response):
+        # bytes of the (possibly compressed) body, 0 for 304 Not Modified
+        bytesSent = response.content_length or 0
+        # the latencies are recorded in the /metrics histograms and the --traceFile, not printed
+        metrics.endRequest(g.requestTimer, response.status_code, bytesSent)
+        return response
+
+    def parseQuery():
+        with g.requestTimer.phase('parse'):
+            return json.loads(request.data) if request.data else {}
+
+    def cachedResponse(endpoint, query, select, serialize=json.dumps, mimetype='application/json'):
+        # serve the result from the query cache, or compute and cache it
+        # the ETag lets clients revalidate with If-None-Match instead of downloading the result again
+        # results are computed on the bounded read pool, so a burst of slow reads can not take every request thread
+        timer = g.requestTimer
+
+        def compute():
+            with timer.phase('select'):
+                result = select()
+            with timer.phase('serialize'):
+                return serialize(result), mimetype
+
+        body, mimetype, etag = queryCache.getOrCompute(endpoint, query, datacube.version, lambda: readPool.run(compute))
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
 
     @app.route('/', methods=['GET'])
     def index():
         return render_template('index.html')
         
-    @app.route('/getRouteLinkData', methods=['POST'])
+    @app.route('/getRouteLinkData', methods=['GET', 'POST'])
     def getRouteLinkData():
-        if request.method == 'POST':
-            start = time_ns()
+        if request.method in ['GET', 'POST']:
+            query = parseQuery()
+            rows = rlData.getVisibleRows(query.get('bbox'), query.get('zoom'))
+
+            if rows is not None:
+                # viewport query, only the visible links
+                with g.requestTimer.phase('select'):
+                    routeLinkData = readPool.run(rlData.getRouteLinkData, rows)
+                with g.requestTimer.phase('serialize'):
+                    routeLinkData = json.dumps(routeLinkData)
+            # precompressed geometry, revalidated by the browser with If-None-Match
+            elif 'gzip' in request.accept_encodings:
+                routeLinkData = Response(rlData.geometryArtifact, mimetype='application/json')
+                routeLinkData.headers['Content-Encoding'] = 'gzip'
+            else:
+                routeLinkData = Response(gzip.decompress(rlData.geometryArtifact), mimetype='application/json')
+            if rows is None:
+                routeLinkData.headers['Vary'] = 'Accept-Encoding'
+                routeLinkData.cache_control.no_cache = True
+                routeLinkData.set_etag(rlData.geometryETag)
+                routeLinkData = routeLinkData.make_conditional(request)
 
-            routeLinkData = json.dumps(rlData.getRouteLinkData())
-            
-            print(f'getRouteLinkData: {(time_ns() - start) * math.pow(10, -6)} ms')
             return routeLinkData
         else:
-            print('Expected POST method, but received ' + request.method)
+            print('Expected GET or POST method, but received ' + request.method)
 
     @app.route('/getMapData', methods=['POST'])
     # netcdf files access
     def getMapData():
         if request.method == 'POST':
-            start = time_ns()
-            query = json.loads(request.data)
+            query = parseQuery()
             timestamp = query['timestamp']
             aggregation = query['aggregation']
             daStage = query['daStage']
             stateVariable = query['stateVariable']
             inflation = None if query['inflation'] == 'none' else query['inflation']
+            # optional viewport bbox and zoom level, only the visible links are returned
+            rows = rlData.getVisibleRows(query.get('bbox'), query.get('zoom'))
+            # optional basin reducer, the values aggregated over the links upstream of every link
+            basin = query.get('basin')
+            if basin is not None and basin not in basinReducers:
+                return Response(json.dumps({'error': f'expected basin in {basinReducers}'}), status=400, mimetype='application/json')
+            if pager is not None:
+                # read the adjacent time windows ahead, the user is likely to scrub the timeline
+                pager.touch(timestamp, ensemble.getMapSelections(aggregation, daStage, stateVariable, inflation))
 
-            # stateData = json.dumps(ensemble.getStateData(timestamp, aggregation, daStage, stateVariable, inflation))
-            stateData = json.dumps(ensemble.getMapData(datacube, timestamp, aggregation, daStage, stateVariable, inflation))
+            if query.get('format') == 'binary':
+                # float32 values in the order of /getMapLinkIDs
+                stateData = cachedResponse('getMapData', query, lambda: ensemble.getMapDataBinary(datacube, timestamp, aggregation, daStage, stateVariable, inflation, rows, basin), bytes, 'application/octet-stream')
+            else:
+                # stateData = json.dumps(ensemble.getStateData(timestamp, aggregation, daStage, stateVariable, inflation))
+                stateData = cachedResponse('getMapData', query, lambda: ensemble.getMapData(datacube, timestamp, aggregation, daStage, stateVariable, inflation, rows, basin))
 
-            print(f'getMapData: {(time_ns() - start) * math.pow(10, -6)} ms')
             return stateData
         else:
             print('Expected POST method, but received ' + request.method)
 
+    @app.route('/getMapLinkIDs', methods=['GET'])
+    def getMapLinkIDs():
+        if request.method == 'GET':
+            # int32 linkIDs, fixed at startup, the order of the binary /getMapData values
+            return Response(ensemble.getMapLinkIDsBinary(), mimetype='application/octet-stream')
+        else:
+            print('Expected GET method, but received ' + request.method)
+
     @app.route('/getUIParameters', methods=['GET'])
     def getUIParameters():
         if request.method == 'GET':
@@ -99,19 +331,16 @@ if __name__=='__main__':
     @app.route('/getDistributionData', methods=['POST'])
     def getDistributionData():
         if request.method == 'POST':
-            start = time_ns()
-            query = json.loads(request.data)
+            query = parseQuery()
             timestamp = query['timestamp']
             stateVariable = query['stateVariable']
             linkID = query['linkID']
 
             # netcdf file access
-            distributionData = json.dumps(ensemble.getEnsembleData(timestamp, stateVariable, linkID))
+            # distributionData = json.dumps(ensemble.getEnsembleData(timestamp, stateVariable, linkID))
 
             # xarray access
-            # distributionData =json.dumps(ensemble.getDistributionData(datacube, timestamp, stateVariable, linkID))
-            
-            print(f'getDistributionData: {(time_ns() - start) * math.pow(10, -6)} ms')
+            distributionData = cachedResponse('getDistributionData', query, lambda: ensemble.getDistributionData(datacube, timestamp, stateVariable, linkID))
 
             return distributionData
         else:
@@ -120,38 +349,116 @@ if __name__=='__main__':
     @app.route('/getHydrographStateVariableData', methods=['POST'])
     def getHydrographStateVariableData():
         if request.method == 'POST':
-            start = time_ns()
-            query = json.loads(request.data)
+            query = parseQuery()
             linkID = query['linkID']
             stateVariable = query['stateVariable']
             aggregation = query['aggregation']
 
-            # netcdf files access
             readFromGaugeLocation = query['readFromGaugeLocation']
+            # optional member quantile envelopes next to the mean +- sd ones
+            quantiles = query.get('quantiles', False)
 
             if readFromGaugeLocation and stateVariable == 'qlink1':
-                hydrographData = json.dumps(observations.getHydrographStateVariableData(linkID, aggregation))
+                hydrographData = cachedResponse('getHydrographStateVariableData', query, lambda: observations.getHydrographStateVariableData(linkID, aggregation, quantiles))
             else:
-                hydrographData = json.dumps(ensemble.getHydrographStateVariableData(linkID, aggregation, stateVariable))
+                # netcdf files access
+                # hydrographData = json.dumps(ensemble.getHydrographStateVariableData(linkID, aggregation, stateVariable))
 
-            # xarray access
-            # hydrographData = json.dumps(ensemble.getStateVariableHydrographData(datacube, linkID, aggregation, stateVariable))
+                # xarray access
+                hydrographData = cachedResponse('getHydrographStateVariableData', query, lambda: ensemble.getStateVariableHydrographData(datacube, linkID, aggregation, stateVariable, quantiles))
 
-            print(f'getHydrographStateVariableData: {(time_ns() - start) * math.pow(10, -6)} ms')
-            
             return hydrographData
         else:
             print('Expected POST method, but received ' + request.method)
 
+    @app.route('/getBatchHydrographData', methods=['POST'])
+    def getBatchHydrographData():
+        if request.method == 'POST':
+            query = parseQuery()
+            stateVariable = query['stateVariable']
+            aggregation = query['aggregation']
+            quantiles = query.get('quantiles', False)
+            maxLinks = min(query.get('maxLinks', args.maxBatchLinks), args.maxBatchLinks)
+
+            # the links are given as a list of linkIDs, as the observation gauges within a bbox,
+            # or as the links upstream of a link
+            if 'linkIDs' in query:
+                selectLinkIDs = lambda: query['linkIDs'][:maxLinks]
+            elif 'bbox' in query:
+                selectLinkIDs = lambda: observations.getGaugesInBoundingBox(query['bbox'])[:maxLinks]
+            elif 'upstreamOf' in query:
+                selectLinkIDs = lambda: rlData.getUpstreamLinkIDs(query['upstreamOf'], maxLinks)
+            else:
+                return Response(json.dumps({'error': 'expected linkIDs, bbox or upstreamOf'}), status=400, mimetype='application/json')
+
+            return cachedResponse('getBatchHydrographData', query, lambda: ensemble.getBatchHydrographData(datacube, selectLinkIDs(), aggregation, stateVariable, quantiles))
+        else:
+            print('Expected POST method, but received ' + request.method)
+
+    def linkIDError(linkID):
+        # 400 for a linkID that is not a link of the RouteLink file
+        if not rlData.isValidLinkID(linkID):
+            return Response(json.dumps({'error': f'expected linkID in [1, {rlData.numLinks}]'}), status=400, mimetype='application/json')
+        return None
+
+    @app.route('/getUpstreamLinks', methods=['POST'])
+    def getUpstreamLinks():
+        if request.method == 'POST':
+            query = parseQuery()
+            linkID = query['linkID']
+            # nearest links first, capped at maxLinks
+            maxLinks = min(query.get('maxLinks', args.maxBatchLinks), args.maxBatchLinks)
+
+            error = linkIDError(linkID)
+            if error is not None:
+                return error
+
+            return cachedResponse('getUpstreamLinks', query, lambda: {'linkID': linkID, 'linkIDs': rlData.getUpstreamLinkIDs(linkID, maxLinks)})
+        else:
+            print('Expected POST method, but received ' + request.method)
+
+    @app.route('/getDownstreamLinks', methods=['POST'])
+    def getDownstreamLinks():
+        if request.method == 'POST':
+            query = parseQuery()
+            linkID = query['linkID']
+
+            error = linkIDError(linkID)
+            if error is not None:
+                return error
+
+            return cachedResponse('getDownstreamLinks', query, lambda: {'linkID': linkID, 'linkIDs': rlData.getDownstreamLinkIDs(linkID)})
+        else:
+            print('Expected POST method, but received ' + request.method)
+
+    @app.route('/getBasinAggregateData', methods=['POST'])
+    def getBasinAggregateData():
+        if request.method == 'POST':
+            query = parseQuery()
+            linkID = query['linkID']
+            stateVariable = query['stateVariable']
+            aggregation = query.get('aggregation', 'mean')
+            daStage = query['daStage']
+            inflation = None if query.get('inflation', 'none') == 'none' else query['inflation']
+            # 'sum', 'mean' or 'count' over the links of the basin
+            reducer = query.get('reducer', 'mean')
+            if reducer not in basinReducers:
+                return Response(json.dumps({'error': f'expected reducer in {basinReducers}'}), status=400, mimetype='application/json')
+
+            error = linkIDError(linkID)
+            if error is not None:
+                return error
+
+            return cachedResponse('getBasinAggregateData', query, lambda: ensemble.getBasinAggregateData(datacube, linkID, aggregation, daStage, stateVariable, inflation, reducer))
+        else:
+            print('Expected POST method, but received ' + request.method)
+
     @app.route('/getGaugeLocations', methods=['GET'])
     def getGaugeLocations():
         if request.method == 'GET':
-            start = time_ns()
-            
             # gaugeLocationData = json.dumps(observations.getGaugeLocations())
             gaugeLocationData = json.dumps(observations.getObservationGaugeLocationData())
             
-            print(f'getGaugeLocations: {(time_ns() - start) * math.pow(10, -6)} ms')
             return gaugeLocationData
         else:
             print('Expected GET method, but received ' + request.method)
@@ -159,21 +466,109 @@ if __name__=='__main__':
     @app.route('/getHydrographInflationData', methods=['POST'])
     def getHydrographInflationData():
         if request.method == 'POST':
-            start = time_ns()
-            query = json.loads(request.data)
+            query = parseQuery()
             linkID = query['linkID']
             stateVariable = query['stateVariable']
             inflation = query['inflation']
 
             # netcdf files access
-            hydrographData = json.dumps(ensemble.getHydrographInflationData(linkID, stateVariable, inflation))
+            # hydrographData = json.dumps(ensemble.getHydrographInflationData(linkID, stateVariable, inflation))
 
             # xarray access
-            # hydrographData = json.dumps(ensemble.getInflationHydrographData(datacube, linkID, stateVariable, inflation))
+            hydrographData = cachedResponse('getHydrographInflationData', query, lambda: ensemble.getInflationHydrographData(datacube, linkID, stateVariable, inflation))
 
-            print(f'getInflationHydrographData: {(time_ns() - start) * math.pow(10, -6)} ms')
             return hydrographData
         else:
             print('Expected POST method, but received ' + request.method)
 
-    app.run(host='127.0.0.1', port=args.portNum, debug=True, use_evalex=False, use_reloader=False)
+    def verificationError(daStage, statistic=None, timestamp=None, linkID=None):
+        # 404 without a streamflow state variable to verify, 400 for a statistic, daStage, cycle or gauge that does not exist
+        if not verification.available:
+            return Response(json.dumps({'error': 'no verification without the qlink1 state variable'}), status=404, mimetype='application/json')
+        error = verification.checkQuery(daStage, statistic, timestamp, linkID, datacube)
+        if error is not None:
+            return Response(json.dumps({'error': error}), status=400, mimetype='application/json')
+        return None
+
+    @app.route('/getVerificationMapData', methods=['POST'])
+    def getVerificationMapData():
+        if request.method == 'POST':
+            query = parseQuery()
+            # summary statistic over the cycles (in the optional timeRange), or with timestamp a statistic of one cycle
+            timestamp = query.get('timestamp')
+            statistic = query.get('statistic', 'rmse' if timestamp is None else 'error')
+            daStage = query.get('daStage', 'analysis')
+            timeRange = query.get('timeRange')
+
+            error = verificationError(daStage, statistic, timestamp)
+            if error is not None:
+                return error
+
+            return cachedResponse('getVerificationMapData', query, lambda: verification.getVerificationMapData(datacube, statistic, daStage, timestamp, timeRange))
+        else:
+            print('Expected POST method, but received ' + request.method)
+
+    @app.route('/getVerificationTableData', methods=['POST'])
+    def getVerificationTableData():
+        if request.method == 'POST':
+            query = parseQuery()
+            daStage = query.get('daStage', 'analysis')
+            sortBy = query.get('sortBy', 'rmse')
+            descending = query.get('descending', True)
+            limit = query.get('limit')
+            timeRange = query.get('timeRange')
+
+            error = verificationError(daStage, sortBy)
+            if error is not None:
+                return error
+
+            return cachedResponse('getVerificationTableData', query, lambda: verification.getVerificationTableData(datacube, daStage, sortBy, descending, limit, timeRange))
+        else:
+            print('Expected POST method, but received ' + request.method)
+
+    @app.route('/getRankHistogramData', methods=['POST'])
+    def getRankHistogramData():
+        if request.method == 'POST':
+            query = parseQuery()
+            daStage = query.get('daStage', 'analysis')
+            # one gauge, or all the gauges without linkID
+            linkID = query.get('linkID')
+            timeRange = query.get('timeRange')
+
+            error = verificationError(daStage, linkID=linkID)
+            if error is not None:
+                return error
+
+            return cachedResponse('getRankHistogramData', query, lambda: verification.getRankHistogramData(datacube, daStage, linkID, timeRange))
+        else:
+            print('Expected POST method, but received ' + request.method)
+
+    @app.route('/getStatus', methods=['GET'])
+    def getStatus():
+        if request.method == 'GET':
+            # progress of the datacube build
+            return json.dumps(buildStatus.summary())
+        else:
+            print('Expected GET method, but received ' + request.method)
+
+    @app.route('/metrics', methods=['GET'])
+    def getMetrics():
+        if request.method == 'GET':
+            # latency histograms per endpoint and phase, and the hit rates of the caches
+            return json.dumps({
+                'endpoints': metrics.summary(),
+                'queryCache': queryCache.stats(),
+                'chunkCache': datacube.store.cache.stats() if datacube.store is not None else None,
+                # every miss opens a netcdf file
+                'ncHandles': ncHandles.stats()
+            })
+        else:
+            print('Expected GET method, but received ' + request.method)
+
+    def reopenFileHandles():
+        # in each gunicorn worker: the chunked datacube files are reopened, the cached file access handles are
+        # closed and reopened on demand, HDF5 does not support handles shared across fork
+        datacube.reopenFiles()
+        ncHandles.close()
+
+    serve(app, args.server, args.host, args.portNum, args.serverWorkers, args.serverThreads, reopenFileHandles)
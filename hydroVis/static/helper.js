@@ -113,6 +113,28 @@ export const wrfHydroStateVariables = {
     }
 }
 
+export async function waitForBuildStage(stage) {
+    // the server may still be building the datacube, poll its progress until the given stage is done
+    while (true) {
+        const status = await d3.json('/getStatus');
+        if (status.stages[stage] === 'done') {
+            return status;
+        }
+        if (status.error) {
+            throw `Datacube build failed: ${status.error}`;
+        }
+        console.log(`Waiting for the datacube ${stage} stage, ${status.cyclesLoaded}/${status.cyclesTotal} cycles loaded`);
+        await new Promise(resolve => setTimeout(resolve, 2000));
+    }
+}
+
+// derived diagnostics precomputed by the server, selected like a data assimilation phase
+export const derivedDiagnostics = {
+    spreadRatio: 'Spread Ratio (Analysis / Forecast)',
+    openloopMinusAnalysis: 'Open Loop minus Analysis Mean',
+    inflatedSpread: 'Prior Inflated Forecast Spread'
+}
+
 export function captializeFirstLetter(string) {
     return string.charAt(0).toUpperCase() + string.slice(1);
 }
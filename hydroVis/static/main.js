@@ -2,7 +2,7 @@ import { uiParameters } from './uiParameters.js';
 import { setupBaseMap, drawMapData, drawMapDataV2, drawGaugeLocations, drawLinkData } from './map.js';
 import { setupDistributionPlot, drawDistribution } from './distribution.js';
 import { setupHydrographPlots, drawHydrographStateVariable, drawHydrographStateVariableV2, drawHydrographInflation } from './hydrograph.js';
-import { getJSDateObjectFromTimestamp, wrfHydroStateVariables } from './helper.js';
+import { getJSDateObjectFromTimestamp, wrfHydroStateVariables, waitForBuildStage } from './helper.js';
 
 function updateStateVariable(stateVariable) {
     uiParameters.updateStateVariable(stateVariable);
@@ -183,11 +183,13 @@ async function setupControlPanel() {
 
 async function init() {
     // draw visualization scaffolds
+    await waitForBuildStage('routeLink');
     await setupBaseMap();
     await setupDistributionPlot();
     await setupHydrographPlots();
 
-    // setup UI elements
+    // setup UI elements, once the first cycles are queryable
+    await waitForBuildStage('openloop');
     const defaultParameters = await setupControlPanel();
     uiParameters.init(defaultParameters);
 
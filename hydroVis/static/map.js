@@ -1,5 +1,5 @@
 import { uiParameters } from './uiParameters.js';
-import { setupTooltip, wrfHydroStateVariables, captializeFirstLetter, downloadSvg } from './helper.js';
+import { setupTooltip, wrfHydroStateVariables, captializeFirstLetter, downloadSvg, derivedDiagnostics } from './helper.js';
 import { drawDistribution } from "./distribution.js";
 import { drawHydrographStateVariable, drawHydrographStateVariableV2, drawHydrographInflation } from "./hydrograph.js";
 
@@ -76,6 +76,28 @@ class mapPlotParams {
         this.path = path;
     }
 
+    // visible lon/lat bbox and zoom level of the map, null at the full extent
+    // sent with the map data requests, so that only the links in view at that level of detail are read
+    static viewport = null;
+    static setViewport(transform) {
+        if (transform.k <= 1) {
+            this.viewport = null;
+            return;
+        }
+
+        const [lonMin, latMax] = this.projection.invert(transform.invert([this.leftMargin, this.topMargin]));
+        const [lonMax, latMin] = this.projection.invert(transform.invert([this.leftMargin+this.mapWidth, this.topMargin+this.mapHeight]));
+        this.viewport = {
+            bbox: {lonMin: lonMin, latMin: latMin, lonMax: lonMax, latMax: latMax},
+            // every zoom level doubles the scale
+            zoom: Math.round(Math.log2(transform.k))
+        };
+    }
+
+    static viewportQuery() {
+        return this.viewport == null ? {} : this.viewport;
+    }
+
     static tooltip = null;
     static setTooltip(tt) {
         this.tooltip = tt;
@@ -168,6 +190,12 @@ class mapPlotParams {
             }
         }
 
+        // the inflation is ignored for the derived diagnostics
+        if (daStage in derivedDiagnostics) {
+            labelTitle = `${derivedDiagnostics[daStage]} for ${wrfHydroStateVariables[stateVariable].commonName}`;
+            subTitle = daStage == 'spreadRatio' ? '' : 'in ' + wrfHydroStateVariables[stateVariable].units;
+        }
+
         ticks.push({
             x: 0,
             y1: this.legendTitleVerticalOffset,
@@ -448,7 +476,8 @@ export async function setupBaseMap() {
                     [mapPlotParams.leftMargin, mapPlotParams.topMargin],
                     [mapPlotParams.leftMargin+mapPlotParams.mapWidth, mapPlotParams.topMargin+mapPlotParams.mapHeight]
                 ])
-                .on("zoom", zoomed);
+                .on("zoom", zoomed)
+                .on("end", zoomEnded);
 
     svgMap.call(zoom);
 
@@ -516,6 +545,13 @@ export async function setupBaseMap() {
             .style("font-size", mapPlotParams.mapAxesTickLabelFontSize);
     }
 
+    function zoomEnded(event) {
+        // fetch the links in the new viewport
+        mapPlotParams.setViewport(event.transform);
+        // drawMapDataV2(); // xarray access
+        drawMapData();  // netcdf files access
+    }
+
     const tooltip = setupTooltip(mapPlotParams.leftMargin+mapPlotParams.mapWidth+mapPlotParams.rightMargin, mapPlotParams.topMargin+mapPlotParams.mapHeight+mapPlotParams.bottomMargin);
     mapPlotParams.setTooltip(tooltip);
 
@@ -568,13 +604,7 @@ export async function setupBaseMap() {
 }
 
 export async function drawLinkData() {
-    await d3.json('/getRouteLinkData',
-    {
-        method: 'POST',
-        headers: {
-            'Content-type': 'application/json; charset=UTF-8'
-        }
-    })
+    await d3.json('/getRouteLinkData')
     .then(function(data) {
         console.log(data)
 
@@ -618,6 +648,7 @@ export async function drawMapData() {
                 daStage: daStage,
                 inflation: inflation,
                 timestamp: timestamp,
+                ...mapPlotParams.viewportQuery()
             })
     })
     .then(function(wrf_hydro_data) {
@@ -670,7 +701,8 @@ export async function drawMapData() {
                         });
                 },
                 function update(update) {
-                    update.attr("d", function(d) {    return mapPlotParams.path(d.line); })
+                    // the datacube responses carry no geometry, the links keep the path they were drawn with
+                    update.attr("d", function(d) {    return d.line ? mapPlotParams.path(d.line) : d3.select(this).attr("d"); })
                         .attr("stroke-width", function(d) {
                             return sizeScale(d[stateVariable]);
                         })
@@ -696,6 +728,11 @@ export async function drawMapData() {
 
                             mapPlotParams.tooltip.hide();
                         });
+                },
+                function exit(exit) {
+                    // links out of the viewport or below the level of detail are hidden, not removed, so that they
+                    // are shown again when the viewport includes them
+                    exit.attr("stroke-width", 0);
                 }
             )
 
@@ -703,17 +740,31 @@ export async function drawMapData() {
     })
 }
 
-export async function drawMapDataV2() {
-    const stateVariable = uiParameters.stateVariable;
-    const aggregation = uiParameters.aggregation;
-    const daStage = uiParameters.daStage;
-    const inflation = uiParameters.inflation;
-    const timestamp = uiParameters.timestamp;
+// linkIDs of the binary map data, the server fixes their order at startup
+var mapLinkIDs = null;
 
-    // TODO: check if new data really needs to be fetched, 
-    // or can we simply used already fetched data
+async function fetchMapDataBinary(stateVariable, aggregation, daStage, inflation, timestamp) {
+    if (mapLinkIDs == null) {
+        mapLinkIDs = new Int32Array(await d3.buffer('/getMapLinkIDs'));
+    }
 
-    d3.json('/getMapData',
+    // with a viewport, the values are the ones of the visible links in the order of the matching /getRouteLinkData query
+    const viewport = mapPlotParams.viewportQuery();
+    var visibleLinkIDs = mapLinkIDs;
+    if (mapPlotParams.viewport != null) {
+        const visibleLinks = await d3.json('/getRouteLinkData',
+        {
+            method: 'POST',
+            headers: {
+                'Content-type': 'application/json; charset=UTF-8'
+            },
+            body: JSON.stringify(viewport)
+        });
+        visibleLinkIDs = visibleLinks.map(d => d.linkID);
+    }
+
+    // float32 values, one per link in the mapLinkIDs order
+    const values = new Float32Array(await d3.buffer('/getMapData',
     {
         method: 'POST',
         headers: {
@@ -725,8 +776,25 @@ export async function drawMapDataV2() {
                 daStage: daStage,
                 inflation: inflation,
                 timestamp: timestamp,
+                format: 'binary',
+                ...viewport
             })
-    })
+    }));
+
+    return Array.from(visibleLinkIDs, (linkID, i) => ({linkID: linkID, [stateVariable]: values[i]}));
+}
+
+export async function drawMapDataV2() {
+    const stateVariable = uiParameters.stateVariable;
+    const aggregation = uiParameters.aggregation;
+    const daStage = uiParameters.daStage;
+    const inflation = uiParameters.inflation;
+    const timestamp = uiParameters.timestamp;
+
+    // TODO: check if new data really needs to be fetched, 
+    // or can we simply used already fetched data
+
+    fetchMapDataBinary(stateVariable, aggregation, daStage, inflation, timestamp)
     .then(function(wrf_hydro_data) {
         // console.log(wrf_hydro_data);
 
@@ -779,6 +847,10 @@ export async function drawMapDataV2() {
                             drawHydrographStateVariableV2();
                             drawHydrographInflation();
                         });
+                },
+                function exit(exit) {
+                    // links out of the viewport or below the level of detail are hidden, they are drawn once by drawLinkData
+                    exit.attr("stroke-width", 0);
                 }
             )
 
@@ -0,0 +1,27 @@
+import numpy as np
+
+from webServer.observationData import copy_index, grouped_nanmean, observation_copy_index
+
+dartCopyNames = [
+    'observation', 'prior ensemble mean', 'posterior ensemble mean', 'prior ensemble spread', 'posterior ensemble spread',
+    'prior ensemble member      1', 'posterior ensemble member      1'
+]
+
+def test_observation_copy_index():
+    assert observation_copy_index(dartCopyNames) == 0
+    assert observation_copy_index(['prior ensemble mean', 'NCEP BUFR observation']) == 1
+    assert observation_copy_index(['prior ensemble mean', ' observations ']) == 1
+    # no copy names, the first copy
+    assert observation_copy_index(['0', '1', '2']) == 0
+
+def test_copy_index():
+    assert copy_index(dartCopyNames, 'prior ensemble member 1', 5) == 5
+    assert copy_index(dartCopyNames, 'posterior ensemble member  1', 6) == 6
+    assert copy_index(dartCopyNames, 'prior ensemble member 2', 7) is None
+    # the default copy order is only assumed without copy names
+    assert copy_index(['0', '1', '2'], 'prior ensemble mean', 1) == 1
+    assert copy_index(['0', '1', '2'], 'prior ensemble spread', 3) is None
+
+def test_grouped_nanmean():
+    values = np.array([[1.0, np.nan], [3.0, np.nan], [5.0, 6.0]])
+    np.testing.assert_array_equal(grouped_nanmean(values, [0, 2]), [[2.0, np.nan], [5.0, 6.0]])
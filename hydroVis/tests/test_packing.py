@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from webServer.packing import append_packed, concat_time, decode_data_array, encode_data_array, int16FillValue, pack_int16, unpack_int16
+
+def make_data_array(values):
+    return xr.DataArray(
+        data=np.asarray(values, dtype=np.float64),
+        coords={'linkID': np.arange(1, len(values) + 1), 'time': np.arange(np.shape(values)[1])},
+        dims=['linkID', 'time']
+    )
+
+def test_pack_int16_round_trip():
+    values = np.array([[-3.5, 0.0, np.nan], [10.25, 1e-3, 7.0]])
+    packed, scale, offset = pack_int16(values)
+    assert packed.dtype == np.int16
+    assert packed[0, 2] == int16FillValue
+    finite = ~np.isnan(values)
+    assert packed[finite].min() == -32767 and packed[finite].max() == 32767
+
+    unpacked = unpack_int16(packed, scale, offset)
+    assert np.isnan(unpacked[0, 2])
+    # float32 decoding, within half a quantization step
+    np.testing.assert_allclose(unpacked, values, atol=scale / 2 + 1e-5, equal_nan=True)
+
+def test_pack_int16_constant():
+    packed, scale, offset = pack_int16(np.full((2, 2), 4.0))
+    np.testing.assert_array_equal(unpack_int16(packed, scale, offset), np.full((2, 2), 4.0))
+
+def test_encode_decode():
+    dataArray = make_data_array([[1.0, 2.0], [np.nan, 4.0]])
+    assert encode_data_array(dataArray, 'float64') is dataArray
+    assert encode_data_array(dataArray, 'float32').dtype == np.float32
+
+    encoded = encode_data_array(dataArray, 'int16')
+    assert encoded.dtype == np.int16 and 'packScale' in encoded.attrs
+    decoded = decode_data_array(encoded)
+    assert 'packScale' not in decoded.attrs
+    np.testing.assert_allclose(decoded.values, dataArray.values, atol=1e-4, equal_nan=True)
+
+def test_append_packed():
+    encoded = encode_data_array(make_data_array([[0.0, 10.0], [5.0, 2.5]]), 'int16')
+
+    appended = append_packed(encoded, make_data_array([[7.5], [np.nan]]).assign_coords(time=[2]))
+    assert appended.attrs == encoded.attrs
+    # the packed cycles are kept as is
+    np.testing.assert_array_equal(appended.values[:, :2], encoded.values)
+    np.testing.assert_allclose(decode_data_array(appended).values[:, 2], [7.5, np.nan], atol=1e-3, equal_nan=True)
+
+    # out of the packed range, the variable has to be repacked
+    assert append_packed(encoded, make_data_array([[20.0], [1.0]]).assign_coords(time=[2])) is None
+
+def test_concat_time():
+    dataArray = make_data_array([[1.0], [2.0]])
+    # new gauges in the new cycles, nan in the existing ones
+    newDataArray = make_data_array([[3.0], [4.0], [5.0]]).assign_coords(time=[1])
+    np.testing.assert_array_equal(concat_time(dataArray, newDataArray).values, [[1.0, 3.0], [2.0, 4.0], [np.nan, 5.0]])
+
+    encoded = encode_data_array(make_data_array([[0.0], [10.0]]), 'int16')
+    appended = append_packed(encoded, make_data_array([[5.0], [5.0], [5.0]]).assign_coords(time=[1]))
+    assert appended.dtype == np.int16 and appended.values[2, 0] == int16FillValue
+
+    # links missing from the new cycles are not padded
+    with pytest.raises(ValueError):
+        concat_time(newDataArray.assign_coords(time=[0]), dataArray.assign_coords(time=[1]))
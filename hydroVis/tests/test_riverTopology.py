@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from webServer.riverTopology import RiverTopology, reduce_links
+
+# known answers on a small forest, 0-based links:
+#   3 -> 1 -> 0 <- 2    and the isolated outlet 4
+# given as the 1-based fromIndsStart/fromIndsEnd/fromIndices CSR arrays of a RouteLink file
+
+@pytest.fixture
+def topology():
+    return RiverTopology(
+        fromIndsStart=[1, 3, 0, 0, 0],
+        fromIndsEnd=[2, 3, 0, 0, 0],
+        fromIndices=[2, 3, 4]
+    )
+
+def test_levels(topology):
+    assert topology.downstream.tolist() == [-1, 0, 0, 1, -1]
+    assert topology.depth.tolist() == [0, 1, 1, 2, 0]
+    assert [level.tolist() for level in topology.levels] == [[0, 4], [1, 2], [3]]
+    assert topology.basinSize.tolist() == [4, 2, 1, 1, 1]
+
+def test_intervals(topology):
+    assert topology.tin.tolist() == [0, 1, 3, 2, 4]
+    assert topology.tout.tolist() == [4, 3, 4, 3, 5]
+    assert topology.preorder.tolist() == [0, 1, 3, 2, 4]
+
+def test_upstream_downstream(topology):
+    assert topology.upstreamLinks(0).tolist() == [0, 1, 3, 2]
+    assert topology.upstreamLinks(1).tolist() == [1, 3]
+    assert topology.upstreamLinks(4).tolist() == [4]
+    assert topology.downstreamLinks(3).tolist() == [3, 1, 0]
+    assert topology.downstreamLinks(2).tolist() == [2, 0]
+    assert topology.downstreamLinks(4).tolist() == [4]
+    assert topology.isUpstream(np.arange(5), 1).tolist() == [False, True, False, True, False]
+
+def test_accumulate(topology):
+    values = np.array([1.0, 2.0, np.nan, 4.0, 8.0])
+    np.testing.assert_array_equal(topology.accumulate(values, 'sum'), [7.0, 6.0, np.nan, 4.0, 8.0])
+    np.testing.assert_array_equal(topology.accumulate(values, 'mean'), [7.0 / 3, 3.0, np.nan, 4.0, 8.0])
+    np.testing.assert_array_equal(topology.accumulate(values, 'count'), [3.0, 2.0, 0.0, 1.0, 1.0])
+
+    # the basins of every link match a direct reduction over its upstream links, also over a second axis
+    values = np.stack([values, values[::-1]], axis=1)
+    for reducer in ['sum', 'mean', 'count']:
+        expected = [reduce_links(values[topology.upstreamLinks(link)], reducer) for link in range(5)]
+        np.testing.assert_allclose(topology.accumulate(values, reducer), expected)
+
+def test_loop():
+    # 0 and 1 are each other's uplink, 2 is an outlet
+    with pytest.raises(ValueError):
+        RiverTopology(fromIndsStart=[1, 2, 0], fromIndsEnd=[1, 2, 0], fromIndices=[2, 1])
@@ -0,0 +1,36 @@
+import numpy as np
+
+from webServer.verificationData import compute_verification, cycleStatistics, summarize_verification
+
+def test_compute_verification_known_answer():
+    # one gauge, one cycle, one daPhase, members 1, 2, 3 and the observation 2
+    stats = compute_verification(np.array([[2.0]]), np.array([[[[1.0, 2.0, 3.0]]]]))
+    error, spread, crps, rank = [stats[0, 0, 0, cycleStatistics.index(name)] for name in cycleStatistics]
+    assert error == 0.0
+    assert spread == 1.0
+    # mean |x_i - o| - 1/2 mean |x_i - x_j| = 2/3 - 4/9
+    np.testing.assert_allclose(crps, 2 / 9)
+    assert rank == 1
+
+def test_crps_matches_pairwise_definition():
+    rng = np.random.default_rng(0)
+    observations = rng.normal(size=(4, 5))
+    members = rng.normal(size=(4, 5, 2, 7))
+    crps = compute_verification(observations, members)[..., cycleStatistics.index('crps')]
+
+    meanAbsError = np.abs(members - observations[:, :, np.newaxis, np.newaxis]).mean(axis=-1)
+    meanAbsDifference = np.abs(members[..., :, np.newaxis] - members[..., np.newaxis, :]).mean(axis=(-2, -1))
+    np.testing.assert_allclose(crps, meanAbsError - 0.5 * meanAbsDifference)
+
+def test_missing_observations():
+    observations = np.array([[np.nan, 0.5]])
+    members = np.array([[[[0.0, 1.0]], [[0.0, 1.0]]]])
+    stats = compute_verification(observations, members)
+    # the statistics compared to a missing observation are missing
+    assert np.isnan(stats[0, 0, 0, [cycleStatistics.index(name) for name in ['error', 'crps', 'rank']]]).all()
+
+    summary, rankHistograms = summarize_verification(stats, numMembers=2)
+    assert summary['count'].tolist() == [[1.0]]
+    np.testing.assert_allclose(summary['bias'], [[0.0]])
+    # the observation 0.5 is above one of the two members
+    assert rankHistograms.tolist() == [[[0, 1, 0]]]
@@ -2,17 +2,32 @@ import os
 import netCDF4 as nc
 import xarray as xr
 import numpy as np
+from contextlib import ExitStack
+
+from .bulkLoader import fill_blocks, load_state_files_task
+from .ncHandleCache import NcHandleCache
+from .derivedVariables import build_derived_data_array, build_quantile_data_array, derivedDiagnostics, memberQuantiles
+from .riverTopology import reduce_links
+
+def to_json_values(values):
+    # numpy values as a (nested) list, missing values as None since NaN is not valid JSON
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(values), None, values).tolist()
 
 # Class definition for parsing the assimilated data files
 # and creating xarray dataArray data structure from it
 
 class AssimilationData:
-    def __init__(self, modelFilesPath, rlData, datacube, createXarrayFromScratch):
+    def __init__(self, modelFilesPath, rlData, datacube, createXarrayFromScratch, workers=1, ncHandles=None, initialCycles=None):
         # list of timestamps for the ensemble models 
         self.modelFilesPath = modelFilesPath
+        self.workers = workers
+        # open netcdf files of the file access paths
+        self.ncHandles = NcHandleCache() if ncHandles is None else ncHandles
         self.timestamps = [f for f in os.listdir(os.path.join(self.modelFilesPath, 'output')) if os.path.isdir(os.path.join(self.modelFilesPath, 'output', f))]
         self.timestamps.sort()
-        self.timestamps = self.timestamps[:3]
+        # cycles left out of the initial build, to be appended afterwards (see CubeWatcher)
+        self.pendingTimestamps = []
         
         # number of models in the ensemble
         netcdfFiles = [f for f in os.listdir(os.path.join(self.modelFilesPath, 'output', self.timestamps[0])) if 'member' in f]
@@ -27,137 +42,133 @@ class AssimilationData:
         self.rl = rlData
 
         self.linkIDCoords = self.rl.linkIDCoords
+        # linkID order of the map data, fixed for the lifetime of the server so that the
+        # binary map responses can be plain value buffers without the linkIDs
+        self.mapLinkIDs = np.asarray(self.linkIDCoords)
         self.timeCoords = self.timestamps
         self.stateVariableDaPhaseCoords = ['preassim', 'analysis', 'openloop']
         self.stateVariableAggregationCoords = ['mean', 'sd'] + list(range(1, self.numEnsembleModels+1, 1))
         self.inflationDaPhaseCoords = ['preassim', 'analysis']
 
-        if not createXarrayFromScratch and os.path.exists(os.path.join('datacube', 'qlink1_data.nc')) and \
-            os.path.exists(os.path.join('datacube', 'z_gwsubbas_data.nc')) and \
-            os.path.exists(os.path.join('datacube', 'qlink1_priorinf.nc')) and \
-            os.path.exists(os.path.join('datacube', 'z_gwsubbas_postinf.nc')) and \
-            os.path.exists(os.path.join('datacube', 'qlink1_postinf.nc')) and \
-            os.path.exists(os.path.join('datacube', 'z_gwsubbas_postinf.nc')):
+        # datacube variables: state variable values and the prior and posterior inflation for every state variable
+        self.dataArrayNames = [f'{stateVariable}_{suffix}' for stateVariable in self.stateVariables for suffix in ['data', 'priorinf', 'postinf']]
+
+        if not createXarrayFromScratch and \
+            all(datacube.hasPersistedDataArray(dataArrayName) for dataArrayName in self.dataArrayNames):
+
+            for dataArrayName in self.dataArrayNames:
+                datacube.loadDataArray(dataArrayName)
 
-            self.qlink1_data = xr.open_dataarray(os.path.join('datacube', 'qlink1_data.nc'))
-            self.z_gwsubbas_data = xr.open_dataarray(os.path.join('datacube', 'z_gwsubbas_data.nc'))
-            self.qlink1_priorinf = xr.open_dataarray(os.path.join('datacube', 'qlink1_priorinf.nc'))
-            self.z_gwsubbas_priorinf = xr.open_dataarray(os.path.join('datacube', 'z_gwsubbas_priorinf.nc'))
-            self.qlink1_postinf = xr.open_dataarray(os.path.join('datacube', 'qlink1_postinf.nc'))
-            self.z_gwsubbas_postinf = xr.open_dataarray(os.path.join('datacube', 'z_gwsubbas_postinf.nc'))
+            # the persisted cube may hold more cycles than listed above, if new cycles were appended to it
+            # update the list in place, it is shared with the observation and openloop data
+            manifest = datacube.readManifest()
+            if manifest is not None:
+                self.timestamps[:] = manifest['timestamps']
 
         else:
-            self.qlink1_data = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), len(self.timeCoords), len(self.stateVariableDaPhaseCoords), len(self.stateVariableAggregationCoords))), 
-                coords={'linkID':self.linkIDCoords, 'time':self.timeCoords, 'daPhase':self.stateVariableDaPhaseCoords, 'aggregation':self.stateVariableAggregationCoords},
-                dims=['linkID', 'time', 'daPhase', 'aggregation'], 
-                name='qlink1_data'
-            )
+            # build the cube from the first initialCycles cycles only, so that it can be served sooner
+            if initialCycles is not None:
+                self.pendingTimestamps = self.timestamps[initialCycles:]
+                del self.timestamps[initialCycles:]
+
+            # the arrays are only referenced by the datacube, so that it can release them once persisted
+            for dataArrayName, dataArray in self.buildDataArrays(self.timestamps).items():
+                datacube.addDataArray(dataArrayName, dataArray)
+
+    def getFilePlan(self, timestamp):
+        # list of (fileName, blockName, daPhaseIndex, aggregationIndex) for all the files of one timestamp
+        filePlan = []
+        for daPhase in self.inflationDaPhaseCoords:
+            daPhaseIndex = self.stateVariableDaPhaseCoords.index(daPhase)
+            filePlan.append((f'{daPhase}_mean.{timestamp}.nc', 'data', daPhaseIndex, self.stateVariableAggregationCoords.index('mean')))
+            filePlan.append((f'{daPhase}_sd.{timestamp}.nc', 'data', daPhaseIndex, self.stateVariableAggregationCoords.index('sd')))
+            for member in range(1, self.numEnsembleModels+1):
+                filePlan.append((f'{daPhase}_member_{str(member).rjust(4, "0")}.{timestamp}.nc', 'data', daPhaseIndex, self.stateVariableAggregationCoords.index(member)))
+
+            inflationDaPhaseIndex = self.inflationDaPhaseCoords.index(daPhase)
+            filePlan.append((f'{daPhase}_priorinf_mean.{timestamp}.nc', 'priorinf', inflationDaPhaseIndex, None))
+            filePlan.append((f'{daPhase}_postinf_mean.{timestamp}.nc', 'postinf', inflationDaPhaseIndex, None))
+
+        return filePlan
+
+    def isTimestampComplete(self, timestamp):
+        # a cycle can be ingested once DART has written all of its output files
+        timestampPath = os.path.join(self.modelFilesPath, 'output', timestamp)
+        return all(os.path.exists(os.path.join(timestampPath, fileName)) for fileName, _, _, _ in self.getFilePlan(timestamp))
+
+    def buildDataArrays(self, timestamps):
+        # preallocate positional numpy blocks for the given timestamps and fill them one file at a time
+        # the openloop daPhase is left as nan here, it is filled in by OpenLoopData
+        linkIndices = np.asarray(self.linkIDCoords) - 1
+        stateVariableShape = (len(self.linkIDCoords), len(timestamps), len(self.stateVariableDaPhaseCoords), len(self.stateVariableAggregationCoords))
+        inflationShape = (len(self.linkIDCoords), len(timestamps), len(self.inflationDaPhaseCoords))
+
+        shapes = {
+            'data': {stateVariable: stateVariableShape for stateVariable in self.stateVariables},
+            'priorinf': {stateVariable: inflationShape for stateVariable in self.stateVariables},
+            'postinf': {stateVariable: inflationShape for stateVariable in self.stateVariables}
+        }
 
-            self.z_gwsubbas_data = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), len(self.timeCoords), len(self.stateVariableDaPhaseCoords), len(self.stateVariableAggregationCoords))), 
-                coords={'linkID':self.linkIDCoords, 'time':self.timeCoords, 'daPhase':self.stateVariableDaPhaseCoords, 'aggregation':self.stateVariableAggregationCoords},
-                dims=['linkID', 'time', 'daPhase', 'aggregation'], 
-                name='z_gwsubbas_data'
+        # one task per timestamp (cycle), spread across the process pool when workers > 1
+        tasks = [(timestamp, os.path.join(self.modelFilesPath, 'output', timestamp), self.getFilePlan(timestamp), timeIndex)
+                 for timeIndex, timestamp in enumerate(timestamps)]
+        blocks = fill_blocks(load_state_files_task, tasks, shapes, (self.stateVariables, linkIndices), self.workers, "Assimilation data")
+
+        dataArrays = {}
+        for stateVariable in self.stateVariables:
+            dataArrays[f'{stateVariable}_data'] = xr.DataArray(
+                data=blocks['data'][stateVariable],
+                coords={'linkID':self.linkIDCoords, 'time':list(timestamps), 'daPhase':self.stateVariableDaPhaseCoords, 'aggregation':self.stateVariableAggregationCoords},
+                dims=['linkID', 'time', 'daPhase', 'aggregation'],
+                name=f'{stateVariable}_data'
             )
 
-            self.qlink1_priorinf = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), len(self.timeCoords), len(self.inflationDaPhaseCoords))), 
-                coords={'linkID':self.linkIDCoords, 'time':self.timeCoords, 'daPhase':self.inflationDaPhaseCoords}, 
-                dims=['linkID', 'time', 'daPhase'], 
-                name='qlink1_priorinf'
-            )
+            for inflation in ['priorinf', 'postinf']:
+                dataArrays[f'{stateVariable}_{inflation}'] = xr.DataArray(
+                    data=blocks[inflation][stateVariable],
+                    coords={'linkID':self.linkIDCoords, 'time':list(timestamps), 'daPhase':self.inflationDaPhaseCoords},
+                    dims=['linkID', 'time', 'daPhase'],
+                    name=f'{stateVariable}_{inflation}'
+                )
 
-            self.z_gwsubbas_priorinf = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), len(self.timeCoords), len(self.inflationDaPhaseCoords))), 
-                coords={'linkID':self.linkIDCoords, 'time':self.timeCoords, 'daPhase':self.inflationDaPhaseCoords}, 
-                dims=['linkID', 'time', 'daPhase'], 
-                name='z_gwsubbas_priorinf'
-            )
+        return dataArrays
 
-            self.qlink1_postinf = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), len(self.timeCoords), len(self.inflationDaPhaseCoords))), 
-                coords={'linkID':self.linkIDCoords, 'time':self.timeCoords, 'daPhase':self.inflationDaPhaseCoords}, 
-                dims=['linkID', 'time', 'daPhase'], 
-                name='qlink1_postinf'
-            )
+    def buildStateVariableDerivedDataArrays(self, stateVariable, dataArrays):
+        # derived diagnostics and member quantiles of one state variable
+        # the openloop daPhase has to be filled in already
+        return {
+            f'{stateVariable}_derived': build_derived_data_array(dataArrays[f'{stateVariable}_data'], dataArrays[f'{stateVariable}_priorinf'], f'{stateVariable}_derived'),
+            f'{stateVariable}_quantiles': build_quantile_data_array(dataArrays[f'{stateVariable}_data'], f'{stateVariable}_quantiles')
+        }
 
-            self.z_gwsubbas_postinf = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), len(self.timeCoords), len(self.inflationDaPhaseCoords))), 
-                coords={'linkID':self.linkIDCoords, 'time':self.timeCoords, 'daPhase':self.inflationDaPhaseCoords},
-                dims=['linkID', 'time', 'daPhase'], 
-                name='z_gwsubbas_postinf'
-            )
+    def buildDerivedDataArrays(self, dataArrays):
+        # derived variables of the given cube arrays, the whole cube or the newly appended cycles
+        derivedDataArrays = {}
+        for stateVariable in self.stateVariables:
+            derivedDataArrays.update(self.buildStateVariableDerivedDataArrays(stateVariable, dataArrays))
+
+        return derivedDataArrays
+
+    def addDerivedDataArrays(self, datacube, createXarrayFromScratch):
+        # evaluate the derived diagnostics and member quantiles once over the whole cube, after the openloop data was loaded
+        derivedNames = [f'{stateVariable}_{suffix}' for stateVariable in self.stateVariables for suffix in ['derived', 'quantiles']]
+        if not createXarrayFromScratch and all(datacube.hasPersistedDataArray(derivedName) for derivedName in derivedNames):
+            for derivedName in derivedNames:
+                datacube.loadDataArray(derivedName)
+            return
 
-            for timestamp in self.timestamps:
-                # FORECAST
-                # mean
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'preassim_mean.{timestamp}.nc'))
-                self.qlink1_data.loc[dict(time=timestamp, daPhase='preassim', aggregation='mean')] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='preassim', aggregation='mean')] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-                
-                # stdev
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'preassim_sd.{timestamp}.nc'))
-                self.qlink1_data.loc[dict(time=timestamp, daPhase='preassim', aggregation='sd')] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='preassim', aggregation='sd')] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-
-                # member
-                for member in range(1, self.numEnsembleModels+1):
-                    ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'preassim_member_{str(member).rjust(4, "0")}.{timestamp}.nc'))
-                    self.qlink1_data.loc[dict(time=timestamp, daPhase='preassim', aggregation=str(member))] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                    self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='preassim', aggregation=str(member))] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-
-                # prior_inflation
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'preassim_priorinf_mean.{timestamp}.nc'))
-                self.qlink1_priorinf.loc[dict(time=timestamp, daPhase='preassim')] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                self.z_gwsubbas_priorinf.loc[dict(time=timestamp, daPhase='preassim')] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-
-                # post_inflation
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'preassim_postinf_mean.{timestamp}.nc'))
-                self.qlink1_postinf.loc[dict(time=timestamp, daPhase='preassim')] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                self.z_gwsubbas_postinf.loc[dict(time=timestamp, daPhase='preassim')] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-
-                # ANALYSIS
-                # mean
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'analysis_mean.{timestamp}.nc'))
-                self.qlink1_data.loc[dict(time=timestamp, daPhase='analysis', aggregation='mean')] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='analysis', aggregation='mean')] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-                
-                # stdev
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'analysis_sd.{timestamp}.nc'))
-                self.qlink1_data.loc[dict(time=timestamp, daPhase='analysis', aggregation='sd')] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='analysis', aggregation='sd')] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-
-                # member
-                for member in range(1, self.numEnsembleModels+1):
-                    ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'analysis_member_{str(member).rjust(4, "0")}.{timestamp}.nc'))
-                    self.qlink1_data.loc[dict(time=timestamp, daPhase='analysis', aggregation=str(member))] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                    self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='analysis', aggregation=str(member))] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-
-                # prior_inflation mean
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'analysis_priorinf_mean.{timestamp}.nc'))
-                self.qlink1_priorinf.loc[dict(time=timestamp, daPhase='analysis')] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                self.z_gwsubbas_priorinf.loc[dict(time=timestamp, daPhase='analysis')] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-
-                # post_inflation mean
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'analysis_postinf_mean.{timestamp}.nc'))
-                self.qlink1_postinf.loc[dict(time=timestamp, daPhase='analysis')] = ncData.variables['qlink1'][self.linkIDCoords-1]
-                self.z_gwsubbas_postinf.loc[dict(time=timestamp, daPhase='analysis')] = ncData.variables['z_gwsubbas'][self.linkIDCoords-1]
-
-                print("Loaded timestamp", timestamp)
-
-        datacube.addDataArray('qlink1_data', self.qlink1_data)
-        datacube.addDataArray('z_gwsubbas_data', self.z_gwsubbas_data)
-        datacube.addDataArray('qlink1_priorinf', self.qlink1_priorinf)
-        datacube.addDataArray('z_gwsubbas_priorinf', self.z_gwsubbas_priorinf)
-        datacube.addDataArray('qlink1_postinf', self.qlink1_postinf)
-        datacube.addDataArray('z_gwsubbas_postinf', self.z_gwsubbas_postinf)
+        # one state variable at a time, so that only its arrays are held in memory
+        for stateVariable in self.stateVariables:
+            dataArrays = {f'{stateVariable}_{suffix}': datacube.getDataArray(f'{stateVariable}_{suffix}') for suffix in ['data', 'priorinf']}
+            for derivedName, derivedDataArray in self.buildStateVariableDerivedDataArrays(stateVariable, dataArrays).items():
+                datacube.updateDataArray(derivedName, derivedDataArray)
 
     def getUIParameters(self):
         return {
             'stateVariables': self.stateVariables,
             'numEnsembleModels': self.numEnsembleModels,
-            'timestamps': self.timestamps
+            'timestamps': self.timestamps,
+            'derivedDiagnostics': list(derivedDiagnostics.keys())
         }
     
     def getTimestamps(self):
@@ -169,65 +180,66 @@ class AssimilationData:
         # for map visualization
         print(timestamp, aggregation, daStage, stateVariable, inflation)
 
-        # construct required netcdf file name
-        if daStage == 'increment':
-            analysisFilename = f'analysis_mean.{timestamp}.nc'
-            forecastFilename = f'preassim_mean.{timestamp}.nc'
-
-            analysisData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, analysisFilename))
-            forecastData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, forecastFilename))
-            assert(self.rl.numLinks == len(analysisData.variables[self.stateVariables[0]][:]))
-            assert(self.rl.numLinks == len(forecastData.variables[self.stateVariables[0]][:]))
-
-        elif aggregation == 'mean' or aggregation == 'sd':
-            if inflation:
-                filename = f'{daStage}_{inflation}_{aggregation}.{timestamp}.nc'
-            else:
-                filename = f'{daStage}_{aggregation}.{timestamp}.nc'
-
-            ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, filename))
-            assert(self.rl.numLinks == len(ncData.variables[self.stateVariables[0]][:]))
-
-        else:
-            filename = f'{daStage}_member_{str(aggregation).rjust(4, "0")}.{timestamp}.nc'
-
-            ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, filename))
-            assert(self.rl.numLinks == len(ncData.variables[self.stateVariables[0]][:]))
+        with ExitStack() as stack:
+            # construct required netcdf file name
+            if daStage == 'increment':
+                analysisFilename = f'analysis_mean.{timestamp}.nc'
+                forecastFilename = f'preassim_mean.{timestamp}.nc'
 
-        renderData = []
-        for i in range(self.rl.numLinks):
-            if self.rl.numUpLinks[i] == 0:
-                continue
+                analysisData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, analysisFilename)))
+                forecastData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, forecastFilename)))
+                assert(self.rl.numLinks == len(analysisData.variables[self.stateVariables[0]][:]))
+                assert(self.rl.numLinks == len(forecastData.variables[self.stateVariables[0]][:]))
 
-            linkIndices = self.rl.fromIndices[self.rl.fromIndsStart[i]-1: self.rl.fromIndsEnd[i]]-1
-            # it should have been
-            # linkIndices = self.rl.fromIndices[self.rl.fromIndsStart[i]: self.rl.fromIndsEnd[i]+1]
-            # but the netcdf files were written using 1-based indexes for fromIndsStart, fromIndsEnd and fromIndices
-            # therefore to make it work with python's netCDF library, we do a '-1' for each of the three array accesses
-            assert (self.rl.numUpLinks[i] == len(linkIndices))
+            elif aggregation == 'mean' or aggregation == 'sd':
+                if inflation:
+                    filename = f'{daStage}_{inflation}_{aggregation}.{timestamp}.nc'
+                else:
+                    filename = f'{daStage}_{aggregation}.{timestamp}.nc'
 
-            for linkID in linkIndices:
-                dataPoint = {}
-                dataPoint['linkID'] = int(linkID)+1
-                # to be consistent with the way the data was written in the original netCDF files (1-based index)
-                # change from python netCDF library's 0-based index to 1-based index with a '+1'
-                # only for storing the linkID, not for accessing the lat and lon arrays
+                ncData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, filename)))
+                assert(self.rl.numLinks == len(ncData.variables[self.stateVariables[0]][:]))
 
-                if daStage == 'increment':
-                    dataPoint[stateVariable] = float(analysisData.variables[stateVariable][linkID].item()) - float(forecastData.variables[stateVariable][linkID].item())
-                else:
-                    dataPoint[stateVariable] = float(ncData.variables[stateVariable][linkID].item())
+            else:
+                filename = f'{daStage}_member_{str(aggregation).rjust(4, "0")}.{timestamp}.nc'
+
+                ncData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, filename)))
+                assert(self.rl.numLinks == len(ncData.variables[self.stateVariables[0]][:]))
+
+            renderData = []
+            for i in range(self.rl.numLinks):
+                if self.rl.numUpLinks[i] == 0:
+                    continue
+
+                linkIndices = self.rl.fromIndices[self.rl.fromIndsStart[i]-1: self.rl.fromIndsEnd[i]]-1
+                # it should have been
+                # linkIndices = self.rl.fromIndices[self.rl.fromIndsStart[i]: self.rl.fromIndsEnd[i]+1]
+                # but the netcdf files were written using 1-based indexes for fromIndsStart, fromIndsEnd and fromIndices
+                # therefore to make it work with python's netCDF library, we do a '-1' for each of the three array accesses
+                assert (self.rl.numUpLinks[i] == len(linkIndices))
+
+                for linkID in linkIndices:
+                    dataPoint = {}
+                    dataPoint['linkID'] = int(linkID)+1
+                    # to be consistent with the way the data was written in the original netCDF files (1-based index)
+                    # change from python netCDF library's 0-based index to 1-based index with a '+1'
+                    # only for storing the linkID, not for accessing the lat and lon arrays
+
+                    if daStage == 'increment':
+                        dataPoint[stateVariable] = float(analysisData.variables[stateVariable][linkID].item()) - float(forecastData.variables[stateVariable][linkID].item())
+                    else:
+                        dataPoint[stateVariable] = float(ncData.variables[stateVariable][linkID].item())
             
-                lineData = {
-                    'type': "LineString",
-                    'coordinates': []
-                }
+                    lineData = {
+                        'type': "LineString",
+                        'coordinates': []
+                    }
 
-                lineData['coordinates'].append([float(self.rl.lon[i]), float(self.rl.lat[i])])
-                lineData['coordinates'].append([float(self.rl.lon[linkID]), float(self.rl.lat[linkID])])
+                    lineData['coordinates'].append([float(self.rl.lon[i]), float(self.rl.lat[i])])
+                    lineData['coordinates'].append([float(self.rl.lon[linkID]), float(self.rl.lat[linkID])])
 
-                dataPoint['line'] = lineData
-                renderData.append(dataPoint)
+                    dataPoint['line'] = lineData
+                    renderData.append(dataPoint)
         
         return renderData
     
@@ -237,21 +249,22 @@ class AssimilationData:
 
         # construct required netcdf file name
         for id in range(self.numEnsembleModels):
-            memberID = str(id+1).rjust(4, '0')
-            analysisFilename = f'analysis_member_{memberID}.{timestamp}.nc'
-            forecastFilename = f'preassim_member_{memberID}.{timestamp}.nc'
-
-            memberAnalysisData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, analysisFilename))
-            memberForecastData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, forecastFilename))
-
-            dataPoint = {}
-            dataPoint['memberID'] = id
-            dataPoint[stateVariable] = {
-                'analysis': float(memberAnalysisData.variables[stateVariable][linkID].item()),
-                'forecast': float(memberForecastData.variables[stateVariable][linkID].item())
-            }
+            with ExitStack() as stack:
+                memberID = str(id+1).rjust(4, '0')
+                analysisFilename = f'analysis_member_{memberID}.{timestamp}.nc'
+                forecastFilename = f'preassim_member_{memberID}.{timestamp}.nc'
+
+                memberAnalysisData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, analysisFilename)))
+                memberForecastData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, forecastFilename)))
+
+                dataPoint = {}
+                dataPoint['memberID'] = id
+                dataPoint[stateVariable] = {
+                    'analysis': float(memberAnalysisData.variables[stateVariable][linkID].item()),
+                    'forecast': float(memberForecastData.variables[stateVariable][linkID].item())
+                }
 
-            ensembleData.append(dataPoint)
+                ensembleData.append(dataPoint)
 
         return ensembleData
 
@@ -275,58 +288,59 @@ class AssimilationData:
         hydrographData['data'] = []
     
         for timestamp in self.timestamps:
-            analysisSdFilename = f'analysis_sd.{timestamp}.nc'
-            forecastSdFilename = f'preassim_sd.{timestamp}.nc'
-
-            analysisSdData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, analysisSdFilename))
-            forecastSdData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, forecastSdFilename))
-
-            if aggregation != 'sd':
-                analysisMeanFilename = f'analysis_mean.{timestamp}.nc'
-                forecastMeanFilename = f'preassim_mean.{timestamp}.nc'
-
-                analysisMeanData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, analysisMeanFilename))
-                forecastMeanData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, forecastMeanFilename))
-
-                if aggregation != 'mean':
-                    analysisMemberFilename = f'analysis_member_{str(aggregation).rjust(4, "0")}.{timestamp}.nc'
-                    forecastMemberFilename = f'preassim_member_{str(aggregation).rjust(4, "0")}.{timestamp}.nc'
-
-                    analysisMemberData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, analysisMemberFilename))
-                    forecastMemberData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, forecastMemberFilename))
-
-            if aggregation == 'mean':
-                hydrographData['data'].append({
-                    'timestamp': timestamp,
-                    'forecast': float(forecastMeanData.variables[stateVariable][linkID].item()),
-                    'analysis': float(analysisMeanData.variables[stateVariable][linkID].item()),
-                    'forecastSdMax': float(forecastMeanData.variables[stateVariable][linkID].item()) + float(forecastSdData.variables[stateVariable][linkID].item()),
-                    'forecastSdMin': float(forecastMeanData.variables[stateVariable][linkID].item()) - float(forecastSdData.variables[stateVariable][linkID].item()),
-                    'analysisSdMax': float(analysisMeanData.variables[stateVariable][linkID].item()) + float(analysisSdData.variables[stateVariable][linkID].item()),
-                    'analysisSdMin': float(analysisMeanData.variables[stateVariable][linkID].item()) - float(analysisSdData.variables[stateVariable][linkID].item())
-                })
+            with ExitStack() as stack:
+                analysisSdFilename = f'analysis_sd.{timestamp}.nc'
+                forecastSdFilename = f'preassim_sd.{timestamp}.nc'
+
+                analysisSdData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, analysisSdFilename)))
+                forecastSdData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, forecastSdFilename)))
+
+                if aggregation != 'sd':
+                    analysisMeanFilename = f'analysis_mean.{timestamp}.nc'
+                    forecastMeanFilename = f'preassim_mean.{timestamp}.nc'
+
+                    analysisMeanData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, analysisMeanFilename)))
+                    forecastMeanData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, forecastMeanFilename)))
+
+                    if aggregation != 'mean':
+                        analysisMemberFilename = f'analysis_member_{str(aggregation).rjust(4, "0")}.{timestamp}.nc'
+                        forecastMemberFilename = f'preassim_member_{str(aggregation).rjust(4, "0")}.{timestamp}.nc'
+
+                        analysisMemberData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, analysisMemberFilename)))
+                        forecastMemberData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, forecastMemberFilename)))
+
+                if aggregation == 'mean':
+                    hydrographData['data'].append({
+                        'timestamp': timestamp,
+                        'forecast': float(forecastMeanData.variables[stateVariable][linkID].item()),
+                        'analysis': float(analysisMeanData.variables[stateVariable][linkID].item()),
+                        'forecastSdMax': float(forecastMeanData.variables[stateVariable][linkID].item()) + float(forecastSdData.variables[stateVariable][linkID].item()),
+                        'forecastSdMin': float(forecastMeanData.variables[stateVariable][linkID].item()) - float(forecastSdData.variables[stateVariable][linkID].item()),
+                        'analysisSdMax': float(analysisMeanData.variables[stateVariable][linkID].item()) + float(analysisSdData.variables[stateVariable][linkID].item()),
+                        'analysisSdMin': float(analysisMeanData.variables[stateVariable][linkID].item()) - float(analysisSdData.variables[stateVariable][linkID].item())
+                    })
             
-            elif aggregation == 'sd':
-                hydrographData['data'].append({
-                    'timestamp': timestamp,
-                    'forecast': float(forecastSdData.variables[stateVariable][linkID].item()),
-                    'analysis': float(analysisSdData.variables[stateVariable][linkID].item()),
-                    'forecastSdMax': float(forecastSdData.variables[stateVariable][linkID].item()),
-                    'forecastSdMin': float(forecastSdData.variables[stateVariable][linkID].item()),
-                    'analysisSdMax': float(analysisSdData.variables[stateVariable][linkID].item()),
-                    'analysisSdMin': float(analysisSdData.variables[stateVariable][linkID].item())
-                })
-
-            else: # aggregation == 'member'
-                hydrographData['data'].append({
-                    'timestamp': timestamp,
-                    'forecast': float(forecastMemberData.variables[stateVariable][linkID].item()),
-                    'analysis': float(analysisMemberData.variables[stateVariable][linkID].item()),
-                    'forecastSdMax': float(forecastMeanData.variables[stateVariable][linkID].item()) + float(forecastSdData.variables[stateVariable][linkID].item()),
-                    'forecastSdMin': float(forecastMeanData.variables[stateVariable][linkID].item()) - float(forecastSdData.variables[stateVariable][linkID].item()),
-                    'analysisSdMax': float(analysisMeanData.variables[stateVariable][linkID].item()) + float(analysisSdData.variables[stateVariable][linkID].item()),
-                    'analysisSdMin': float(analysisMeanData.variables[stateVariable][linkID].item()) - float(analysisSdData.variables[stateVariable][linkID].item())
-                })
+                elif aggregation == 'sd':
+                    hydrographData['data'].append({
+                        'timestamp': timestamp,
+                        'forecast': float(forecastSdData.variables[stateVariable][linkID].item()),
+                        'analysis': float(analysisSdData.variables[stateVariable][linkID].item()),
+                        'forecastSdMax': float(forecastSdData.variables[stateVariable][linkID].item()),
+                        'forecastSdMin': float(forecastSdData.variables[stateVariable][linkID].item()),
+                        'analysisSdMax': float(analysisSdData.variables[stateVariable][linkID].item()),
+                        'analysisSdMin': float(analysisSdData.variables[stateVariable][linkID].item())
+                    })
+
+                else: # aggregation == 'member'
+                    hydrographData['data'].append({
+                        'timestamp': timestamp,
+                        'forecast': float(forecastMemberData.variables[stateVariable][linkID].item()),
+                        'analysis': float(analysisMemberData.variables[stateVariable][linkID].item()),
+                        'forecastSdMax': float(forecastMeanData.variables[stateVariable][linkID].item()) + float(forecastSdData.variables[stateVariable][linkID].item()),
+                        'forecastSdMin': float(forecastMeanData.variables[stateVariable][linkID].item()) - float(forecastSdData.variables[stateVariable][linkID].item()),
+                        'analysisSdMax': float(analysisMeanData.variables[stateVariable][linkID].item()) + float(analysisSdData.variables[stateVariable][linkID].item()),
+                        'analysisSdMin': float(analysisMeanData.variables[stateVariable][linkID].item()) - float(analysisSdData.variables[stateVariable][linkID].item())
+                    })
 
         hydrographData['lon'] = float(self.rl.lon[linkID])
         hydrographData['lat'] = float(self.rl.lat[linkID])
@@ -342,17 +356,18 @@ class AssimilationData:
         hydrographData['data'] = []
 
         for timestamp in self.timestamps:
-            analysisFilename = f'analysis_{inflation}_mean.{timestamp}.nc'
-            forecastFilename = f'preassim_{inflation}_mean.{timestamp}.nc'
+            with ExitStack() as stack:
+                analysisFilename = f'analysis_{inflation}_mean.{timestamp}.nc'
+                forecastFilename = f'preassim_{inflation}_mean.{timestamp}.nc'
 
-            analysisData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, analysisFilename))
-            forecastData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, forecastFilename))
+                analysisData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, analysisFilename)))
+                forecastData = stack.enter_context(self.ncHandles.open(os.path.join(self.modelFilesPath, 'output', timestamp, forecastFilename)))
 
-            hydrographData['data'].append({
-                'timestamp': timestamp,
-                'analysis': float(analysisData.variables[stateVariable][linkID].item()),
-                'forecast': float(forecastData.variables[stateVariable][linkID].item())
-            })
+                hydrographData['data'].append({
+                    'timestamp': timestamp,
+                    'analysis': float(analysisData.variables[stateVariable][linkID].item()),
+                    'forecast': float(forecastData.variables[stateVariable][linkID].item())
+                })
 
         hydrographData['lon'] = float(self.rl.lon[linkID])
         hydrographData['lat'] = float(self.rl.lat[linkID])
@@ -361,116 +376,249 @@ class AssimilationData:
 
     # xarray access
 
-    def getMapData(self, datacube, timestamp, aggregation, daStage, stateVariable, inflation=None):
-        # for map visualization
+    def getMapSelections(self, aggregation, daStage, stateVariable, inflation=None):
+        # (datacube variable, indexers) read for one time slice of the map, see getMapValues
+        # the inflation is ignored for the increment and the derived diagnostics, same as the netcdf file access
+        if inflation and daStage not in derivedDiagnostics:
+            return [(f'{stateVariable}_{inflation}', {'daPhase': daStage})]
+        # the derived diagnostics are precomputed, the increment only for the ensemble mean
+        if daStage in derivedDiagnostics and (daStage != 'increment' or aggregation == 'mean'):
+            return [(f'{stateVariable}_derived', {'diagnostic': daStage})]
+        if daStage == 'increment':
+            return [(f'{stateVariable}_data', {'daPhase': 'analysis', 'aggregation': str(aggregation)}),
+                    (f'{stateVariable}_data', {'daPhase': 'preassim', 'aggregation': str(aggregation)})]
+        return [(f'{stateVariable}_data', {'daPhase': daStage, 'aggregation': str(aggregation)})]
+
+    def selectMapVariable(self, datacube, aggregation, daStage, stateVariable, inflation=None, **indexers):
+        # the map variable at the given time and link indexers, see getMapSelections
+        selections = [datacube.select(dataArrayKey, **indexers, **mapIndexers)
+                      for dataArrayKey, mapIndexers in self.getMapSelections(aggregation, daStage, stateVariable, inflation)]
+        # the increment is the analysis minus the preassim values
+        return selections[0] if len(selections) == 1 else selections[0] - selections[1]
+
+    def getMapValues(self, datacube, timestamp, aggregation, daStage, stateVariable, inflation=None, rows=None, basin=None):
+        # one time slice across all links, or the links at the given rows of mapLinkIDs, as a numpy array in the mapLinkIDs order
+        # with basin, the values reduced ('sum', 'mean' or 'count') over the links upstream of every link
         print(timestamp, aggregation, daStage, stateVariable, inflation)
-        
-        if inflation:
-            dataArrayKey = f'{stateVariable}_{inflation}'
-            dataArray = datacube.getDataArray(dataArrayKey).sel(time=timestamp, daPhase=daStage)
-        else:
-            dataArrayKey = f'{stateVariable}_data'
-            if daStage == 'increment':
-                dataArray = datacube.getDataArray(dataArrayKey).sel(time=timestamp, daPhase='analysis', aggregation=str(aggregation)) - \
-                            datacube.getDataArray(dataArrayKey).sel(time=timestamp, daPhase='preassim', aggregation=str(aggregation))
-            else:
-                dataArray = datacube.getDataArray(dataArrayKey).sel(time=timestamp, daPhase=daStage, aggregation=str(aggregation))
 
-        # TODO: Check for converting array data to json using vectorized functions
+        # the basin aggregates need every link
+        selectedRows = None if basin else rows
+        linkIDs = self.mapLinkIDs if selectedRows is None else self.mapLinkIDs[selectedRows]
+        linkIndexer = {} if selectedRows is None else {'linkID': linkIDs}
+        dataArray = self.selectMapVariable(datacube, aggregation, daStage, stateVariable, inflation, time=timestamp, **linkIndexer)
+
+        values = dataArray.values
+        if not np.array_equal(dataArray.coords['linkID'].values, linkIDs):
+            values = dataArray.reindex(linkID=linkIDs).values
+
+        if basin:
+            values = self.rl.accumulateOverBasins(values, basin)
+            values = values if rows is None else values[rows]
+
+        return values
+
+    def getMapData(self, datacube, timestamp, aggregation, daStage, stateVariable, inflation=None, rows=None, basin=None):
+        # for map visualization
+        values = self.getMapValues(datacube, timestamp, aggregation, daStage, stateVariable, inflation, rows, basin)
+        linkIDs = self.mapLinkIDs if rows is None else self.mapLinkIDs[rows]
+
+        # missing values (e.g. cycles the openloop run has not reached) are sent as null
+        values = to_json_values(values)
         renderData = [
             {
-                'linkID': lid.item(),
-                stateVariable: dataArray.sel(linkID=lid).item()
+                'linkID': lid,
+                stateVariable: value
             }
-            for lid in dataArray.coords['linkID']
+            for lid, value in zip(linkIDs.tolist(), values)
         ]
 
         return renderData
-    
+
+    def getMapDataBinary(self, datacube, timestamp, aggregation, daStage, stateVariable, inflation=None, rows=None, basin=None):
+        # compact map response: little endian float32 values in the mapLinkIDs order, NaN for missing values
+        # with rows, only the values of those rows, in the order of the 'index' of the matching /getRouteLinkData query
+        values = self.getMapValues(datacube, timestamp, aggregation, daStage, stateVariable, inflation, rows, basin)
+        return values.astype('<f4').tobytes()
+
+    def getMapLinkIDsBinary(self):
+        # little endian int32 linkIDs, the order of the values in the binary map responses
+        return self.mapLinkIDs.astype('<i4').tobytes()
+
+    def getLinkLocation(self, linkID):
+        return self.rl.linkData.sel(linkID=linkID, descriptor=['lon', 'lat']).values.tolist()
+
     def getDistributionData(self, datacube, timestamp, stateVariable, linkID):
+        # for distribution plots, all the members of both daPhases in a single selection
         dataArrayKey = f'{stateVariable}_data'
-        dataArray = datacube.getDataArray(dataArrayKey).sel(linkID=linkID, time=timestamp, aggregation=[str(memberID) for memberID in range(1, self.numEnsembleModels, 1)])
+        memberIDs = list(range(1, self.numEnsembleModels+1, 1))
+        dataArray = datacube.select(dataArrayKey, linkID=linkID, time=timestamp, daPhase=['preassim', 'analysis'],
+                                    aggregation=[str(memberID) for memberID in memberIDs]).transpose('daPhase', 'aggregation')
+        forecast, analysis = to_json_values(dataArray.values)
 
-        # TODO: Check for converting array data to json using vectorized functions
-        renderData = [
-            {
-                'memberID': memberID,
-                stateVariable: {
-                    'analysis': dataArray.sel(aggregation=str(memberID), daPhase='analysis').item(),
-                    'forecast': dataArray.sel(aggregation=str(memberID), daPhase='preassim').item()
+        lon, lat = self.getLinkLocation(linkID)
+        renderData = {
+            'lon': lon,
+            'lat': lat,
+            'ensembleData': [
+                {
+                    'memberID': memberID,
+                    stateVariable: {
+                        'analysis': analysisValue,
+                        'forecast': forecastValue
+                    }
                 }
-            }
-            for memberID in range(1, self.numEnsembleModels, 1)
-        ]
+                for memberID, analysisValue, forecastValue in zip(memberIDs, analysis, forecast)
+            ]
+        }
 
         return renderData
-    
-    def getStateVariableHydrographData(self, datacube, linkID, aggregation, stateVariable):
+
+    def getStateVariableHydrographData(self, datacube, linkID, aggregation, stateVariable, quantiles=False):
+        # for state variable hydrograph plot, all the timestamps of the link in a single selection
+        # with quantiles, also the precomputed member quantile envelopes, e.g. forecastQ5 to forecastQ95
         dataArrayKey = f'{stateVariable}_data'
-        dataArray = datacube.getDataArray(dataArrayKey).sel(linkID=linkID)
-        
-        # TODO: Check for converting array data to json using vectorized functions
+        timestamps = list(self.timestamps)
+        aggregations = ['mean', 'sd'] if aggregation in ['mean', 'sd'] else ['mean', 'sd', str(aggregation)]
+        dataArray = datacube.select(dataArrayKey, linkID=linkID, time=timestamps, aggregation=aggregations).transpose('daPhase', 'aggregation', 'time')
+        daPhases = list(dataArray.coords['daPhase'].values)
+
+        values = {}
+        for daPhase, name in [('preassim', 'forecast'), ('analysis', 'analysis'), ('openloop', 'openloop')]:
+            phaseValues = dataArray.values[daPhases.index(daPhase)]
+            mean, sd = phaseValues[0], phaseValues[1]
+            if aggregation == 'sd':
+                values[name], values[f'{name}SdMax'], values[f'{name}SdMin'] = sd, sd, sd
+            else:
+                values[name], values[f'{name}SdMax'], values[f'{name}SdMin'] = phaseValues[aggregations.index(str(aggregation))], mean + sd, mean - sd
+        values = {name: to_json_values(series) for name, series in values.items()}
+
+        if quantiles:
+            quantileArray = datacube.select(f'{stateVariable}_quantiles', linkID=linkID, time=timestamps).transpose('daPhase', 'quantile', 'time')
+            quantileDaPhases = list(quantileArray.coords['daPhase'].values)
+            for daPhase, name in [('preassim', 'forecast'), ('analysis', 'analysis'), ('openloop', 'openloop')]:
+                for quantile, series in zip(memberQuantiles, quantileArray.values[quantileDaPhases.index(daPhase)]):
+                    values[f'{name}Q{quantile}'] = to_json_values(series)
+
+        # observations are only available for the streamflow at the gauges
+        gaugeDataAvailable = stateVariable == 'qlink1' and aggregation != 'sd' and \
+            linkID in datacube.coords('observation_gauge_data', 'linkID')
+        if gaugeDataAvailable:
+            observations = datacube.select('observation_gauge_data', linkID=linkID).reindex(time=timestamps)
+            values['observation'] = to_json_values(observations.values)
+
+        lon, lat = self.getLinkLocation(linkID)
         renderData = {
             'linkID': linkID,
             'aggregation': aggregation,
-            'data': []
+            'agg': aggregation if aggregation in ['mean', 'sd'] else int(aggregation),
+            'lon': lon,
+            'lat': lat,
+            'data': [
+                dict(timestamp=timestamp, gaugeDataAvailable=gaugeDataAvailable, **{name: series[i] for name, series in values.items()})
+                for i, timestamp in enumerate(timestamps)
+            ]
         }
-        for timestamp in self.timestamps:
-            dataPoint = {}
 
-            dataPoint['timestamp'] = timestamp
-            dataPoint['forecast'] = dataArray.sel(time=timestamp, daPhase='preassim', aggregation=str(aggregation)).item()
-            dataPoint['analysis'] = dataArray.sel(time=timestamp, daPhase='analysis', aggregation=str(aggregation)).item()
-            dataPoint['openloop'] = dataArray.sel(time=timestamp, daPhase='openloop', aggregation=str(aggregation)).item()
-            # print(dataPoint['openloop'])
-            
-            obs_dataArray = datacube.getDataArray('observation_gauge_data').sel(time=timestamp)
-            # print(linkID, obs_dataArray.coords['linkID'])
-            dataPoint['gaugeDataAvailable'] = (stateVariable == 'qlink1' and aggregation != 'sd' and (linkID in obs_dataArray.coords['linkID']))
-            # print(dataPoint['gaugeDataAvailable'], dataPoint['gaugeDataAvailable'] == True)
-            if dataPoint['gaugeDataAvailable']:
-                # print("inside ", obs_dataArray.sel(linkID=linkID).item())
-                dataPoint['observation'] = obs_dataArray.sel(linkID=linkID).item()
-            else:
-                dataPoint['observation'] = 0
-            # print("outside ", dataPoint['observation'])
-            
-            if aggregation == 'sd':
-                dataPoint['forecastSdMax'] = dataArray.sel(time=timestamp, daPhase='preassim', aggregation='sd').item()
-                dataPoint['forecastSdMin'] = dataArray.sel(time=timestamp, daPhase='preassim', aggregation='sd').item()
-                dataPoint['analysisSdMax'] = dataArray.sel(time=timestamp, daPhase='analysis', aggregation='sd').item()
-                dataPoint['analysisSdMin'] = dataArray.sel(time=timestamp, daPhase='analysis', aggregation='sd').item()
-                dataPoint['openloopSdMax'] = dataArray.sel(time=timestamp, daPhase='openloop', aggregation='sd').item()
-                dataPoint['openloopSdMin'] = dataArray.sel(time=timestamp, daPhase='openloop', aggregation='sd').item()
+        return renderData
 
+    def getBatchHydrographData(self, datacube, linkIDs, aggregation, stateVariable, quantiles=False):
+        # hydrographs of many links in a single selection, columnar: every series is a (link, time) nested list
+        # in the order of linkIDs, the linkIDs which are not in the datacube are listed in missingLinkIDs
+        dataArrayKey = f'{stateVariable}_data'
+        timestamps = list(self.timestamps)
+        cubeLinkIDs = datacube.coords(dataArrayKey, 'linkID')
+        found = np.isin(np.asarray(linkIDs, dtype=np.int64), np.asarray(cubeLinkIDs))
+        missingLinkIDs = [linkID for linkID, isFound in zip(linkIDs, found) if not isFound]
+        linkIDs = [linkID for linkID, isFound in zip(linkIDs, found) if isFound]
+
+        aggregations = ['mean', 'sd'] if aggregation in ['mean', 'sd'] else ['mean', 'sd', str(aggregation)]
+        dataArray = datacube.select(dataArrayKey, linkID=linkIDs, time=timestamps, aggregation=aggregations).transpose('daPhase', 'aggregation', 'linkID', 'time')
+        daPhases = list(dataArray.coords['daPhase'].values)
+
+        columns = {}
+        for daPhase, name in [('preassim', 'forecast'), ('analysis', 'analysis'), ('openloop', 'openloop')]:
+            phaseValues = dataArray.values[daPhases.index(daPhase)]
+            mean, sd = phaseValues[0], phaseValues[1]
+            if aggregation == 'sd':
+                columns[name], columns[f'{name}SdMax'], columns[f'{name}SdMin'] = sd, sd, sd
             else:
-                dataPoint['forecastSdMax'] = (dataArray.sel(time=timestamp, daPhase='preassim', aggregation='mean') + dataArray.sel(time=timestamp, daPhase='preassim', aggregation='sd')).item()
-                dataPoint['forecastSdMin'] = (dataArray.sel(time=timestamp, daPhase='preassim', aggregation='mean') - dataArray.sel(time=timestamp, daPhase='preassim', aggregation='sd')).item()
-                dataPoint['analysisSdMax'] = (dataArray.sel(time=timestamp, daPhase='analysis', aggregation='mean') + dataArray.sel(time=timestamp, daPhase='analysis', aggregation='sd')).item()
-                dataPoint['analysisSdMin'] = (dataArray.sel(time=timestamp, daPhase='analysis', aggregation='mean') - dataArray.sel(time=timestamp, daPhase='analysis', aggregation='sd')).item()
-                dataPoint['openloopSdMax'] = (dataArray.sel(time=timestamp, daPhase='openloop', aggregation='mean') + dataArray.sel(time=timestamp, daPhase='openloop', aggregation='sd')).item()
-                dataPoint['openloopSdMin'] = (dataArray.sel(time=timestamp, daPhase='openloop', aggregation='mean') - dataArray.sel(time=timestamp, daPhase='openloop', aggregation='sd')).item()
+                columns[name], columns[f'{name}SdMax'], columns[f'{name}SdMin'] = phaseValues[aggregations.index(str(aggregation))], mean + sd, mean - sd
+
+        if quantiles:
+            quantileArray = datacube.select(f'{stateVariable}_quantiles', linkID=linkIDs, time=timestamps).transpose('daPhase', 'quantile', 'linkID', 'time')
+            quantileDaPhases = list(quantileArray.coords['daPhase'].values)
+            for daPhase, name in [('preassim', 'forecast'), ('analysis', 'analysis'), ('openloop', 'openloop')]:
+                for quantile, series in zip(memberQuantiles, quantileArray.values[quantileDaPhases.index(daPhase)]):
+                    columns[f'{name}Q{quantile}'] = series
+
+        # observations of the links with a gauge, nan for the other links
+        gaugeDataAvailable = [False] * len(linkIDs)
+        if stateVariable == 'qlink1' and aggregation != 'sd' and len(linkIDs):
+            gauges = np.asarray(datacube.coords('observation_gauge_data', 'linkID'))
+            isGauge = np.isin(np.asarray(linkIDs, dtype=np.int64), gauges)
+            if isGauge.any():
+                observations = np.full((len(linkIDs), len(timestamps)), np.nan)
+                gaugeLinkIDs = np.asarray(linkIDs, dtype=np.int64)[isGauge].tolist()
+                observations[isGauge] = datacube.select('observation_gauge_data', linkID=gaugeLinkIDs).reindex(time=timestamps).transpose('linkID', 'time').values
+                columns['observation'] = observations
+                gaugeDataAvailable = isGauge.tolist()
+
+        locations = self.rl.linkData.sel(linkID=linkIDs, descriptor=['lon', 'lat']).values
+        renderData = {
+            'linkIDs': linkIDs,
+            'missingLinkIDs': missingLinkIDs,
+            'aggregation': aggregation,
+            'agg': aggregation if aggregation in ['mean', 'sd'] else int(aggregation),
+            'lon': locations[:, 0].tolist(),
+            'lat': locations[:, 1].tolist(),
+            'gaugeDataAvailable': gaugeDataAvailable,
+            'timestamps': timestamps,
+            'data': {name: to_json_values(values) for name, values in columns.items()}
+        }
+
+        return renderData
 
-            renderData['data'].append(dataPoint)
+    def getBasinAggregateData(self, datacube, linkID, aggregation, daStage, stateVariable, inflation=None, reducer='mean'):
+        # the map variable reduced over the links upstream of linkID, at every timestamp,
+        # e.g. the basin mean increment or the total inflation of the basin, in a single selection
+        timestamps = list(self.timestamps)
+        basinLinkIDs = self.rl.getUpstreamLinkIDs(linkID)
+        dataArray = self.selectMapVariable(datacube, aggregation, daStage, stateVariable, inflation, linkID=basinLinkIDs, time=timestamps)
+        values = reduce_links(dataArray.transpose('linkID', 'time').values, reducer)
+
+        lon, lat = self.getLinkLocation(linkID) if linkID in self.rl.linkData.indexes['linkID'] else (None, None)
+        renderData = {
+            'linkID': linkID,
+            'reducer': reducer,
+            'numLinks': len(basinLinkIDs),
+            'lon': lon,
+            'lat': lat,
+            'timestamps': timestamps,
+            'values': to_json_values(values)
+        }
 
         return renderData
-    
+
     def getInflationHydrographData(self, datacube, linkID, stateVariable, inflation):
+        # for inflation hydrograph plot, all the timestamps of the link in a single selection
         dataArrayKey = f'{stateVariable}_{inflation}'
-        dataArray = datacube.getDataArray(dataArrayKey).sel(linkID=linkID)
+        timestamps = list(self.timestamps)
+        dataArray = datacube.select(dataArrayKey, linkID=linkID, time=timestamps, daPhase=['preassim', 'analysis']).transpose('daPhase', 'time')
+        forecast, analysis = to_json_values(dataArray.values)
 
-        # TODO: Check for converting array data to json using vectorized functions
+        lon, lat = self.getLinkLocation(linkID)
         renderData = {
             'linkID': linkID,
-            'data': []
+            'lon': lon,
+            'lat': lat,
+            'data': [
+                {
+                    'timestamp': timestamp,
+                    'forecast': forecastValue,
+                    'analysis': analysisValue
+                }
+                for timestamp, forecastValue, analysisValue in zip(timestamps, forecast, analysis)
+            ]
         }
-        for timestamp in self.timestamps:
-            dataPoint = {}
 
-            dataPoint['timestamp'] = timestamp
-            dataPoint['forecast'] = dataArray.sel(time=timestamp, daPhase='preassim').item()
-            dataPoint['analysis'] = dataArray.sel(time=timestamp, daPhase='analysis').item()
-
-            renderData['data'].append(dataPoint)
-
-        return renderData
\ No newline at end of file
+        return renderData
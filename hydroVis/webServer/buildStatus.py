@@ -0,0 +1,55 @@
+import threading
+from time import time
+
+# Progress of the datacube build, reported by /getStatus while the server already serves requests
+# the build goes through the stages in order, the endpoints wait for the stage they need (see requiredStage)
+
+stages = ['routeLink', 'assimilation', 'observation', 'openloop', 'cycles', 'persist']
+
+class BuildStatus:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startTime = time()
+        # stage -> 'pending', 'running', 'done' or 'failed'
+        self.states = {stage: 'pending' for stage in stages}
+        self.stageTimes = {}
+        self.cyclesLoaded = 0
+        self.cyclesTotal = 0
+        self.error = None
+
+    def begin(self, stage):
+        with self.lock:
+            self.states[stage] = 'running'
+            self.stageTimes[stage] = time()
+
+    def end(self, stage):
+        with self.lock:
+            self.states[stage] = 'done'
+            self.stageTimes[stage] = time() - self.stageTimes.get(stage, time())
+
+    def fail(self, stage, error):
+        with self.lock:
+            self.states[stage] = 'failed'
+            self.error = f'{type(error).__name__}: {error}'
+
+    def setCycles(self, loaded, total):
+        with self.lock:
+            self.cyclesLoaded = loaded
+            self.cyclesTotal = total
+
+    def isDone(self, stage):
+        with self.lock:
+            return self.states[stage] == 'done'
+
+    def summary(self):
+        with self.lock:
+            return {
+                'ready': all(state == 'done' for state in self.states.values()),
+                'stages': dict(self.states),
+                # seconds spent in the finished stages
+                'stageSeconds': {stage: round(seconds, 3) for stage, seconds in self.stageTimes.items() if self.states[stage] == 'done'},
+                'cyclesLoaded': self.cyclesLoaded,
+                'cyclesTotal': self.cyclesTotal,
+                'elapsedSeconds': round(time() - self.startTime, 3),
+                'error': self.error
+            }
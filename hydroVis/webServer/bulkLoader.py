@@ -0,0 +1,174 @@
+import os
+import netCDF4 as nc
+import numpy as np
+from time import time_ns
+from multiprocessing import Pool, shared_memory
+
+# Bulk loading of the DART output files into preallocated positional numpy blocks
+# every file is opened exactly once and all of its state variables are read in one go,
+# the values are then scattered into the (linkID, time, daPhase, aggregation) blocks
+# using integer positions only, no xarray label lookups are involved
+
+class ReadStats:
+    def __init__(self):
+        # one entry per file read: (file path, bytes read, read time in s, scatter time in s)
+        self.files = []
+
+    def record(self, filePath, numBytes, readTime, scatterTime):
+        self.files.append((filePath, numBytes, readTime, scatterTime))
+
+    def merge(self, other):
+        self.files.extend(other.files)
+
+    def summary(self):
+        if not self.files:
+            return 'no files read'
+
+        numBytes = np.array([f[1] for f in self.files], dtype=np.float64)
+        readTime = np.array([f[2] for f in self.files], dtype=np.float64)
+        scatterTime = np.array([f[3] for f in self.files], dtype=np.float64)
+        # per file throughput, guard against timer resolution on tiny files
+        throughput = numBytes / np.maximum(readTime, 1e-9) / (1024 * 1024)
+
+        return f'{len(self.files)} files, {round(numBytes.sum() / (1024 * 1024), 1)} MB, ' \
+               f'read {round(readTime.sum() * 1000, 1)} ms, scatter {round(scatterTime.sum() * 1000, 1)} ms, ' \
+               f'per file throughput min/median/max {round(throughput.min(), 1)}/{round(float(np.median(throughput)), 1)}/{round(throughput.max(), 1)} MB/s'
+
+def read_state_file(filePath, stateVariables, linkIndices):
+    # open the netcdf file once and read every requested state variable
+    # the full variable is read contiguously and gathered in numpy,
+    # which is much faster than netCDF4's fancy indexing on the file
+    start = time_ns()
+    data = {}
+    numBytes = 0
+    with nc.Dataset(filePath) as ncData:
+        ncData.set_auto_mask(False)
+        for stateVariable in stateVariables:
+            values = ncData.variables[stateVariable][:]
+            numBytes += values.nbytes
+            data[stateVariable] = values[linkIndices]
+
+    return data, numBytes, (time_ns() - start) * 1e-9
+
+def load_timestamp(timestampPath, filePlan, timeIndex, stateVariables, linkIndices, blocks, stats):
+    # filePlan is a list of (fileName, blockName, daPhaseIndex, aggregationIndex) tuples
+    # aggregationIndex is None for the blocks without an aggregation dimension (inflation)
+    for fileName, blockName, daPhaseIndex, aggregationIndex in filePlan:
+        filePath = os.path.join(timestampPath, fileName)
+        data, numBytes, readTime = read_state_file(filePath, stateVariables, linkIndices)
+
+        start = time_ns()
+        for stateVariable in stateVariables:
+            if aggregationIndex is None:
+                blocks[blockName][stateVariable][:, timeIndex, daPhaseIndex] = data[stateVariable]
+            else:
+                blocks[blockName][stateVariable][:, timeIndex, daPhaseIndex, aggregationIndex] = data[stateVariable]
+
+        stats.record(filePath, numBytes, readTime, (time_ns() - start) * 1e-9)
+
+def load_state_files_task(task, blocks, sharedArgs):
+    # process pool task: load all the files of one timestamp (cycle) into the blocks
+    timestamp, timestampPath, filePlan, timeIndex = task
+    stateVariables, linkIndices = sharedArgs
+
+    stats = ReadStats()
+    load_timestamp(timestampPath, filePlan, timeIndex, stateVariables, linkIndices, blocks, stats)
+    return timestamp, stats
+
+class SharedBlocks:
+    # numpy blocks allocated in shared memory, so that the pool workers write
+    # their slabs of the datacube directly into them instead of pickling arrays back
+    def __init__(self, shapes, fillValue=np.nan):
+        self.segments = {}
+        self.blocks = {}
+        for blockName, arrayShapes in shapes.items():
+            self.segments[blockName] = {}
+            self.blocks[blockName] = {}
+            for arrayName, shape in arrayShapes.items():
+                segment = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(np.float64).itemsize, 1))
+                block = np.ndarray(shape, dtype=np.float64, buffer=segment.buf)
+                block.fill(fillValue)
+                self.segments[blockName][arrayName] = segment
+                self.blocks[blockName][arrayName] = block
+
+    def spec(self):
+        # picklable description of the shared blocks for attaching in the workers
+        return {
+            blockName: {arrayName: (self.segments[blockName][arrayName].name, self.blocks[blockName][arrayName].shape) for arrayName in arrayShapes}
+            for blockName, arrayShapes in self.blocks.items()
+        }
+
+    @staticmethod
+    def attach(spec):
+        segments = []
+        blocks = {}
+        for blockName, arraySpecs in spec.items():
+            blocks[blockName] = {}
+            for arrayName, (segmentName, shape) in arraySpecs.items():
+                segment = shared_memory.SharedMemory(name=segmentName)
+                segments.append(segment)
+                blocks[blockName][arrayName] = np.ndarray(shape, dtype=np.float64, buffer=segment.buf)
+
+        return segments, blocks
+
+    def copyOut(self):
+        # move the blocks into process private memory one array at a time,
+        # releasing each shared segment right away to keep the peak footprint low
+        blocks = {}
+        for blockName, arrayBlocks in self.blocks.items():
+            blocks[blockName] = {}
+            for arrayName in list(arrayBlocks.keys()):
+                blocks[blockName][arrayName] = np.array(arrayBlocks.pop(arrayName))
+                segment = self.segments[blockName].pop(arrayName)
+                segment.close()
+                segment.unlink()
+
+        return blocks
+
+# per worker process state, set up once by the pool initializer
+_poolTask = None
+_poolSegments = None
+_poolBlocks = None
+_poolSharedArgs = None
+
+def _init_pool_worker(task, spec, sharedArgs):
+    global _poolTask, _poolSegments, _poolBlocks, _poolSharedArgs
+    _poolTask = task
+    _poolSegments, _poolBlocks = SharedBlocks.attach(spec)
+    _poolSharedArgs = sharedArgs
+
+def _run_pool_task(taskArgs):
+    return _poolTask(taskArgs, _poolBlocks, _poolSharedArgs)
+
+def fill_blocks(task, taskArgsList, shapes, sharedArgs, workers=1, description=''):
+    # fill the datacube blocks by running task(taskArgs, blocks, sharedArgs) for every entry of taskArgsList
+    # task has to be a module level function returning (label, ReadStats)
+    # with workers > 1 the tasks are spread across a process pool and write into shared memory
+    stats = ReadStats()
+
+    if workers <= 1 or len(taskArgsList) <= 1:
+        blocks = {blockName: {arrayName: np.full(shape, np.nan) for arrayName, shape in arrayShapes.items()} for blockName, arrayShapes in shapes.items()}
+        for taskArgs in taskArgsList:
+            label, taskStats = task(taskArgs, blocks, sharedArgs)
+            stats.merge(taskStats)
+            print("Loaded timestamp", label, taskStats.summary())
+
+    else:
+        sharedBlocks = SharedBlocks(shapes)
+        try:
+            with Pool(min(workers, len(taskArgsList)), initializer=_init_pool_worker, initargs=(task, sharedBlocks.spec(), sharedArgs)) as pool:
+                for label, taskStats in pool.imap_unordered(_run_pool_task, taskArgsList):
+                    stats.merge(taskStats)
+                    print("Loaded timestamp", label, taskStats.summary())
+
+            blocks = sharedBlocks.copyOut()
+
+        finally:
+            # make sure no shared memory segment outlives a failed build
+            for arraySegments in sharedBlocks.segments.values():
+                for segment in arraySegments.values():
+                    segment.close()
+                    segment.unlink()
+
+    print(f"{description} read stats:", stats.summary())
+    return blocks
@@ -0,0 +1,317 @@
+import os
+import itertools
+import threading
+from collections import OrderedDict
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from .ncHandleCache import hdf5Lock
+from .packing import fits_packing
+
+# Chunked, lazily read on-disk backend for the datacube
+# every variable is kept in its chunked and compressed NETCDF4 file in the datacube directory,
+# selections only read the chunks they intersect and the chunks are kept in a bounded LRU cache
+
+# chunk sizes are picked so that a chunk holds about this many bytes
+targetChunkBytes = 1024 * 1024
+
+# dimensions which are read one label at a time by the map view
+mapSliceDims = ['time', 'daPhase', 'aggregation', 'diagnostic', 'quantile']
+
+# selections of up to this many links are read from the hydrograph (link major) layout, if there is one
+hydrographLayoutMaxLinks = 1024
+
+def chunk_shape(dims, shape, itemsize, layout='map'):
+    # map (time major) layout: one time, daPhase and aggregation per chunk,
+    # the remaining small dimensions whole and as many links as fit in targetChunkBytes
+    # hydrograph (link major) layout: all the other dimensions whole, as many links as fit in targetChunkBytes
+    if layout == 'map':
+        chunks = [1 if dim in mapSliceDims else size for dim, size in zip(dims, shape)]
+    else:
+        chunks = list(shape)
+    if 'linkID' in dims:
+        axis = dims.index('linkID')
+        chunks[axis] = 1
+        linkChunk = targetChunkBytes // max(int(np.prod(chunks)) * itemsize, 1)
+        chunks[axis] = int(min(max(linkChunk, 1), shape[axis]))
+
+    return [max(int(chunk), 1) for chunk in chunks]
+
+class ChunkCache:
+    # LRU cache of decompressed chunks bounded by a memory budget in bytes
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+        self.chunks = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                self.misses += 1
+                return None
+
+            self.chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+
+    def put(self, key, chunk):
+        with self.lock:
+            if key in self.chunks:
+                return
+
+            self.chunks[key] = chunk
+            self.currentBytes += chunk.nbytes
+            # always keep the newest chunk, even if it alone exceeds the budget
+            while self.currentBytes > self.maxBytes and len(self.chunks) > 1:
+                _, evicted = self.chunks.popitem(last=False)
+                self.currentBytes -= evicted.nbytes
+                self.evictions += 1
+
+    def evict(self, predicate):
+        # drop the chunks whose key matches the predicate, returns the number of bytes freed
+        with self.lock:
+            keys = [key for key in self.chunks if predicate(key)]
+            freedBytes = 0
+            for key in keys:
+                freedBytes += self.chunks.pop(key).nbytes
+            self.currentBytes -= freedBytes
+            self.evictions += len(keys)
+            return freedBytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'chunks': len(self.chunks),
+                'bytes': self.currentBytes,
+                'maxBytes': self.maxBytes
+            }
+
+class ChunkedVariable:
+    # read access to one datacube variable stored in a chunked netcdf file
+    def __init__(self, filePath, varName, generation, layout):
+        self.filePath = filePath
+        self.varName = varName
+        self.generation = generation
+        self.layout = layout
+
+        # decoded coordinates, used for the label to position lookups
+        with xr.open_dataarray(filePath) as dataArray:
+            self.dims = list(dataArray.dims)
+            self.indexes = {dim: pd.Index(dataArray.coords[dim].values) if dim in dataArray.coords else pd.RangeIndex(size)
+                            for dim, size in zip(dataArray.dims, dataArray.shape)}
+            self.attrs = dict(dataArray.attrs)
+
+        self.ncData = nc.Dataset(filePath)
+        self.variable = self.ncData.variables[varName]
+        self.shape = self.variable.shape
+        # int16 packed variables are decoded by netCDF4 on read and cached as float32
+        self.packed = 'scale_factor' in self.variable.ncattrs()
+        self.dtype = np.dtype(np.float32) if self.packed else self.variable.dtype
+        chunking = self.variable.chunking()
+        # files written without chunking are read in slabs of the default chunk shape
+        self.chunkShape = chunk_shape(self.dims, self.shape, self.variable.dtype.itemsize, layout) if chunking == 'contiguous' else list(chunking)
+
+    def close(self):
+        self.ncData.close()
+
+    def reopen(self):
+        # a handle of its own, e.g. in a forked server worker, HDF5 handles can not be shared across fork
+        self.ncData.close()
+        self.ncData = nc.Dataset(self.filePath)
+        self.variable = self.ncData.variables[self.varName]
+
+    def positions(self, indexers):
+        # translate the label indexers into integer positions per dimension
+        # scalar labels drop their dimension, same as xarray's sel
+        positions = []
+        coords = {}
+        scalarAxes = []
+        for axis, dim in enumerate(self.dims):
+            index = self.indexes[dim]
+            if dim not in indexers:
+                positions.append(np.arange(len(index)))
+                coords[dim] = (dim, index.values)
+
+            elif isinstance(indexers[dim], (list, tuple, np.ndarray, pd.Index)):
+                dimPositions = index.get_indexer(indexers[dim])
+                if (dimPositions < 0).any():
+                    raise KeyError(f'{self.varName}: labels not found along {dim}')
+                positions.append(dimPositions)
+                coords[dim] = (dim, index.values[dimPositions])
+
+            else:
+                positions.append(np.array([index.get_loc(indexers[dim])]))
+                coords[dim] = index.values[positions[-1][0]]
+                scalarAxes.append(axis)
+
+        return positions, coords, scalarAxes
+
+    def chunkGroups(self, axis, dimPositions):
+        # group the positions along one axis by chunk: (chunk number, output positions, positions within the chunk)
+        chunkIDs = dimPositions // self.chunkShape[axis]
+        order = np.argsort(chunkIDs, kind='stable')
+        uniqueIDs, starts = np.unique(chunkIDs[order], return_index=True)
+        groups = []
+        for chunkID, outputPositions in zip(uniqueIDs, np.split(order, starts[1:])):
+            groups.append((int(chunkID), outputPositions, dimPositions[outputPositions] - chunkID * self.chunkShape[axis]))
+
+        return groups
+
+class ChunkStore:
+    def __init__(self, directory, cacheBytes):
+        self.directory = directory
+        self.cache = ChunkCache(cacheBytes)
+        # layout name -> {varName: ChunkedVariable}, the map layout always exists
+        self.layouts = {'map': {}, 'hydrograph': {}}
+        self.variables = self.layouts['map']
+        self.generation = 0
+        # the netCDF4/HDF5 library is not thread safe, all file access goes through the process wide HDF5 lock
+        self.lock = hdf5Lock
+
+    def filePath(self, varName, layout='map'):
+        if layout == 'map':
+            return os.path.join(self.directory, f'{varName}.nc')
+        return os.path.join(self.directory, f'{varName}.linkmajor.nc')
+
+    def has(self, varName):
+        return varName in self.variables
+
+    def open(self, varName):
+        with self.lock:
+            self.close(varName)
+            # a new generation makes the chunks cached for a previous version of the file unreachable
+            self.generation += 1
+            for layout, variables in self.layouts.items():
+                if os.path.exists(self.filePath(varName, layout)):
+                    variables[varName] = ChunkedVariable(self.filePath(varName, layout), varName, self.generation, layout)
+
+    def close(self, varName):
+        with self.lock:
+            for variables in self.layouts.values():
+                if varName in variables:
+                    variables.pop(varName).close()
+
+    def reopenFiles(self):
+        with self.lock:
+            for variables in self.layouts.values():
+                for variable in variables.values():
+                    variable.reopen()
+
+    def dims(self, varName):
+        return self.variables[varName].dims
+
+    def coords(self, varName, dim):
+        return self.variables[varName].indexes[dim]
+
+    def nbytes(self, varName):
+        variable = self.variables[varName]
+        return int(np.prod(variable.shape)) * variable.variable.dtype.itemsize
+
+    def pickLayout(self, varName, indexers):
+        # a few links across many timestamps (hydrographs, distributions) are read from the link major layout,
+        # everything else, in particular one timestamp across all links (maps), from the time major layout
+        if varName in self.layouts['hydrograph'] and 'linkID' in indexers:
+            linkIndexer = indexers['linkID']
+            if np.ndim(linkIndexer) == 0 or len(linkIndexer) <= hydrographLayoutMaxLinks:
+                return self.layouts['hydrograph'][varName]
+
+        return self.variables[varName]
+
+    def getChunk(self, variable, chunkID):
+        key = (variable.varName, variable.layout, variable.generation, chunkID)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            slices = tuple(slice(c * size, min((c + 1) * size, length)) for c, size, length in zip(chunkID, variable.chunkShape, variable.shape))
+            with self.lock:
+                chunk = variable.variable[slices]
+            if np.ma.isMaskedArray(chunk):
+                chunk = chunk.filled(np.nan)
+            chunk = chunk.astype(variable.dtype, copy=False)
+            self.cache.put(key, chunk)
+
+        return chunk
+
+    def select(self, varName, **indexers):
+        # label based selection reading only the intersecting chunks of the best suited layout
+        variable = self.pickLayout(varName, indexers)
+        positions, coords, scalarAxes = variable.positions(indexers)
+
+        values = np.empty([len(dimPositions) for dimPositions in positions], dtype=variable.dtype)
+        groups = [variable.chunkGroups(axis, dimPositions) for axis, dimPositions in enumerate(positions)]
+        for combination in itertools.product(*groups):
+            chunk = self.getChunk(variable, tuple(chunkID for chunkID, _, _ in combination))
+            values[np.ix_(*[outputPositions for _, outputPositions, _ in combination])] = \
+                chunk[np.ix_(*[chunkPositions for _, _, chunkPositions in combination])]
+
+        values = values.squeeze(axis=tuple(scalarAxes)) if scalarAxes else values
+        dims = [dim for axis, dim in enumerate(variable.dims) if axis not in scalarAxes]
+        return xr.DataArray(data=values, coords=coords, dims=dims, name=varName, attrs=variable.attrs)
+
+    def prefetch(self, varName, **indexers):
+        # read the chunks of a selection into the chunk cache, without assembling the selection
+        variable = self.pickLayout(varName, indexers)
+        positions, _, _ = variable.positions(indexers)
+        groups = [variable.chunkGroups(axis, dimPositions) for axis, dimPositions in enumerate(positions)]
+        for combination in itertools.product(*groups):
+            self.getChunk(variable, tuple(chunkID for chunkID, _, _ in combination))
+
+    def evictTimeRange(self, timeStart, timeEnd):
+        # drop the cached map layout chunks of the time positions [timeStart, timeEnd)
+        def isInRange(key):
+            varName, layout, generation, chunkID = key
+            variable = self.variables.get(varName)
+            if layout != 'map' or variable is None or variable.generation != generation or 'time' not in variable.dims:
+                return False
+            axis = variable.dims.index('time')
+            chunkStart = chunkID[axis] * variable.chunkShape[axis]
+            return chunkStart < timeEnd and chunkStart + variable.chunkShape[axis] > timeStart
+
+        return self.cache.evict(isInRange)
+
+    def appendTime(self, varName, dataArray):
+        # write new timestamps at the end of the unlimited time dimension of the files of every layout
+        # returns False if the files can not be extended in place and have to be rewritten
+        with self.lock:
+            variable = self.variables.get(varName)
+            if variable is None or 'time' not in variable.dims or list(dataArray.dims) != variable.dims:
+                return False
+
+            for dim in variable.dims:
+                if dim != 'time' and not variable.indexes[dim].equals(pd.Index(dataArray.coords[dim].values)):
+                    return False
+
+            # new values outside the range of the packing of the file require repacking the whole variable
+            if variable.packed and not fits_packing(np.asarray(dataArray.values, dtype=np.float64), variable.variable.scale_factor, variable.variable.add_offset):
+                return False
+
+            layouts = [layout for layout, variables in self.layouts.items() if varName in variables]
+            self.close(varName)
+
+            extended = True
+            for layout in layouts:
+                with nc.Dataset(self.filePath(varName, layout), 'r') as ncData:
+                    extended = extended and ncData.dimensions['time'].isunlimited()
+
+            if extended:
+                timeAxis = variable.dims.index('time')
+                timestamps = np.array([str(timestamp) for timestamp in dataArray.coords['time'].values], dtype=object)
+                for layout in layouts:
+                    with nc.Dataset(self.filePath(varName, layout), 'a') as ncData:
+                        start = ncData.dimensions['time'].size
+                        ncData.variables['time'][start:start + len(timestamps)] = timestamps
+                        slices = tuple(slice(start, start + len(timestamps)) if axis == timeAxis else slice(None) for axis in range(len(variable.dims)))
+                        # netCDF4 packs the values of packed variables on write, nan as the fill value
+                        ncData.variables[varName][slices] = np.ma.masked_invalid(dataArray.values) if variable.packed else dataArray.values
+
+            self.open(varName)
+            return extended
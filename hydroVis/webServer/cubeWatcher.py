@@ -0,0 +1,86 @@
+import os
+import threading
+from time import time, sleep
+
+# Incremental update of the datacube with DA cycles that finished after the cube was built
+# new cycles are the timestamp directories in output/ later than the last ingested timestamp,
+# see the manifest written by DataCube.saveNetCDF
+
+class CubeWatcher:
+    def __init__(self, datacube, ensemble, observations, openLoop, interval=60, settleTime=None, verification=None):
+        self.datacube = datacube
+        self.ensemble = ensemble
+        self.observations = observations
+        self.openLoop = openLoop
+        self.verification = verification
+        self.interval = interval
+        # files modified within the last settleTime seconds may still be written by DART
+        self.settleTime = interval if settleTime is None else settleTime
+        self.thread = None
+
+    def findNewTimestamps(self):
+        ingestedTimestamps = self.datacube.getTimestamps()
+        lastTimestamp = max(ingestedTimestamps) if ingestedTimestamps else ''
+        outputPath = os.path.join(self.ensemble.modelFilesPath, 'output')
+
+        newTimestamps = []
+        for timestamp in sorted(os.listdir(outputPath)):
+            if timestamp <= lastTimestamp or not os.path.isdir(os.path.join(outputPath, timestamp)):
+                continue
+
+            # cycles finish in order, stop at the first one which is still running
+            if not self.isTimestampReady(timestamp):
+                break
+            newTimestamps.append(timestamp)
+
+        return newTimestamps
+
+    def isTimestampReady(self, timestamp):
+        if not (self.ensemble.isTimestampComplete(timestamp) and self.observations.isTimestampComplete(timestamp)):
+            return False
+
+        timestampPath = os.path.join(self.ensemble.modelFilesPath, 'output', timestamp)
+        lastModified = max(os.path.getmtime(os.path.join(timestampPath, f)) for f in os.listdir(timestampPath))
+        return time() - lastModified > self.settleTime
+
+    def update(self, maxCycles=None, persist=True):
+        # ingest the new cycles, extend the time axis of the datacube and persist it
+        # at most maxCycles cycles are ingested, the oldest first
+        newTimestamps = self.findNewTimestamps()[:maxCycles]
+        if not newTimestamps:
+            return []
+
+        print("Appending timestamps", newTimestamps)
+        dataArrays = self.ensemble.buildDataArrays(newTimestamps)
+        self.openLoop.fillOpenloop(dataArrays, newTimestamps)
+        dataArrays.update(self.ensemble.buildDerivedDataArrays(dataArrays))
+        dataArrays.update(self.observations.buildAppendDataArrays(newTimestamps))
+        if self.verification is not None:
+            dataArrays.update(self.verification.buildAppendDataArrays(dataArrays, newTimestamps))
+
+        self.datacube.appendTime(dataArrays)
+        self.observations.updateFromDatacube(self.datacube)
+        # gauges seen for the first time are marked in the route link descriptors
+        self.ensemble.rl.updateGaugeDescriptor(self.observations.observation_gauge_data.coords['linkID'].values, self.datacube)
+        # the timestamp list is shared by the assimilation, observation and openloop data,
+        # extend it only once the datacube holds the new cycles so requests never see a missing timestamp
+        self.ensemble.timestamps.extend(newTimestamps)
+        # results cached while the new timestamps were not listed yet are stale
+        self.datacube.bumpVersion()
+
+        if persist:
+            self.datacube.saveNetCDF(False)
+        return newTimestamps
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.update()
+            except Exception as e:
+                # keep watching, the cycle is retried on the next poll
+                print("Failed to append new timestamps:", e)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='cubeWatcher', daemon=True)
+        self.thread.start()
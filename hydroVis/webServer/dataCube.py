@@ -1,33 +1,221 @@
 import xarray as xr
 import os
+import json
+import threading
+
+from .chunkStore import ChunkStore, chunk_shape
+from .packing import encode_data_array, decode_data_array, netcdf_encoding, is_packed, append_packed, concat_time
 
 class DataCube:
-    def __init__(self):
+    def __init__(self, backend='memory', chunkCacheBytes=1024 * 1024 * 1024, dualLayout=False, storageDtype='float64'):
+        # backend 'memory' holds the whole datacube in RAM,
+        # backend 'chunked' keeps the persisted variables on disk and reads them lazily through a chunk cache
+        self.backend = backend
+        # also persist a link major (hydrograph) chunking of the variables next to the time major (map) one
+        self.dualLayout = dualLayout
+        # 'float64', 'float32' or 'int16' (scale/offset packed) storage of the (linkID, time, ...) variables,
+        # in memory and on disk, see packing.py
+        self.storageDtype = storageDtype
+        self.store = ChunkStore('datacube', chunkCacheBytes) if backend == 'chunked' else None
+        # in memory variables, with the chunked backend only the ones not yet persisted
         self.xrDataset = xr.Dataset()
+        # variables changed since they were last written to disk
+        self.modifiedVariables = set()
+        # guards replacing the dataset while the background cube watcher appends new cycles
+        self.lock = threading.RLock()
+        # incremented on every change of the datacube contents, part of the query cache keys
+        self.version = 0
 
     def addDataArray(self, varName, array):
-        self.xrDataset = self.xrDataset.assign(variables={varName: array.load()})
+        with self.lock:
+            if self.store is not None:
+                self.store.close(varName)
+            self.xrDataset = self.xrDataset.assign(variables={varName: encode_data_array(array.load(), self.storageDtype)})
+            self.version += 1
+
+    def updateDataArray(self, varName, array):
+        # replace a variable, it is rewritten on disk by the next saveNetCDF
+        with self.lock:
+            self.addDataArray(varName, array)
+            self.modifiedVariables.add(varName)
+
+    def hasPersistedDataArray(self, varName):
+        return os.path.exists(os.path.join('datacube', f'{varName}.nc'))
+
+    def loadDataArray(self, varName):
+        # bring a persisted variable into the datacube
+        if self.store is not None:
+            self.store.open(varName)
+            dims = self.store.dims(varName) if self.store.has(varName) else []
+            if self.dualLayout and 'linkID' in dims and 'time' in dims and varName not in self.store.layouts['hydrograph']:
+                print(f'{varName} has no link major layout yet, rebuild the datacube with -xr to write it')
+        else:
+            self.addDataArray(varName, xr.load_dataarray(os.path.join('datacube', f'{varName}.nc')))
 
     def getDataArray(self, varName):
-        return self.xrDataset[varName].load()
-    
+        if varName not in self.xrDataset and self.store is not None and self.store.has(varName):
+            return self.store.select(varName)
+        return decode_data_array(self.xrDataset[varName].load())
+
+    def select(self, varName, **indexers):
+        # label based selection, only reads the chunks of the selection with the chunked backend
+        if varName not in self.xrDataset and self.store is not None and self.store.has(varName):
+            return self.store.select(varName, **indexers)
+        # packed variables are only decoded for the selection
+        return decode_data_array(self.xrDataset[varName].sel(**indexers))
+
+    def prefetch(self, varName, **indexers):
+        # warm the chunk cache with a selection, in memory variables need no prefetching
+        if varName not in self.xrDataset and self.store is not None and self.store.has(varName):
+            self.store.prefetch(varName, **indexers)
+
+    def evictTimeRange(self, timeStart, timeEnd):
+        if self.store is not None:
+            self.store.evictTimeRange(timeStart, timeEnd)
+
+    def reopenFiles(self):
+        # reopen the files of the chunked variables, see serving.serveGunicorn
+        if self.store is not None:
+            self.store.reopenFiles()
+
+    def coords(self, varName, dim):
+        # index of the coordinate labels of a variable along one dimension
+        if varName not in self.xrDataset and self.store is not None and self.store.has(varName):
+            return self.store.coords(varName, dim)
+        return self.xrDataset[varName].indexes[dim]
+
+    def getTimestamps(self):
+        # timestamps (cycles) ingested in the datacube
+        if 'time' in self.xrDataset.coords:
+            return [str(timestamp) for timestamp in self.xrDataset.coords['time'].values]
+
+        if self.store is not None:
+            for varName in list(self.store.variables):
+                if 'time' in self.store.dims(varName):
+                    return [str(timestamp) for timestamp in self.store.coords(varName, 'time')]
+
+        return []
+
+    def appendTime(self, dataArrays):
+        # extend the datacube with new timestamps (cycles)
+        # dataArrays with a time dimension only hold the new timestamps and are concatenated along time,
+        # the ones without a time dimension replace the existing variable
+        # the whole dataset is swapped at once, so readers never see variables with different time coordinates
+        with self.lock:
+            if self.store is not None:
+                dataArrays = dict(dataArrays)
+                for varName in list(dataArrays.keys()):
+                    if not self.store.has(varName):
+                        continue
+
+                    # persisted variables are extended in place on disk if possible,
+                    # otherwise they are brought back in memory and rewritten by saveNetCDF
+                    if self.store.appendTime(varName, dataArrays[varName]):
+                        dataArrays.pop(varName)
+                    elif 'time' in dataArrays[varName].dims:
+                        dataArrays[varName] = concat_time(self.store.select(varName), dataArrays[varName])
+
+            updatedDataArrays = {}
+            for varName, dataArray in self.xrDataset.data_vars.items():
+                if varName in dataArrays and 'time' in dataArrays[varName].dims:
+                    # the new values of packed variables are packed with the existing scale and offset, so that the
+                    # quantization error of the existing cycles does not compound, the variable is only repacked
+                    # if the new values are outside of the packed range
+                    appended = append_packed(dataArray, dataArrays[varName]) if is_packed(dataArray) else None
+                    if appended is None:
+                        appended = encode_data_array(concat_time(decode_data_array(dataArray), dataArrays[varName]), self.storageDtype)
+                    updatedDataArrays[varName] = appended
+                elif varName in dataArrays:
+                    updatedDataArrays[varName] = encode_data_array(dataArrays[varName], self.storageDtype)
+                else:
+                    updatedDataArrays[varName] = dataArray
+
+            for varName, dataArray in dataArrays.items():
+                if varName not in updatedDataArrays:
+                    updatedDataArrays[varName] = encode_data_array(dataArray, self.storageDtype)
+                    if self.store is not None:
+                        self.store.close(varName)
+
+            self.xrDataset = xr.Dataset(updatedDataArrays)
+            self.modifiedVariables.update(dataArrays.keys())
+            self.version += 1
+
+    def bumpVersion(self):
+        # invalidate the cached query results, e.g. once the new timestamps are listed
+        with self.lock:
+            self.version += 1
+
+    @staticmethod
+    def readManifest():
+        manifestPath = os.path.join('datacube', 'manifest.json')
+        if not os.path.exists(manifestPath):
+            return None
+        with open(manifestPath) as manifestFile:
+            return json.load(manifestFile)
+
     def compute_object_size(self):
         # obj should be an xarray dataset
         print(f'{round(self.xrDataset.nbytes / (1024 * 1024 * 1024), 3)} GB')
+        if self.store is not None:
+            storedBytes = sum(self.store.nbytes(varName) for varName in self.store.variables)
+            print(f'on disk: {round(storedBytes / (1024 * 1024 * 1024), 3)} GB, chunk cache budget: {round(self.store.cache.maxBytes / (1024 * 1024 * 1024), 3)} GB')
 
     def saveNetCDF(self, createXarrayFromScratch):
         if not os.path.exists('datacube'):
             os.mkdir('datacube')
-            
-        for varName in self.xrDataset.keys():
-            if not os.path.exists(os.path.join('datacube', f'{varName}.nc')):# and createXarrayFromScratch:
-                # don't have overwrite permission on glade
-                # TODO: handle overwrite issue 
-                print(self.xrDataset[varName].load())
-                self.xrDataset[varName].load().to_netcdf(path=os.path.join('datacube', f'{varName}.nc'), mode='w', format='NETCDF4')
-                # TODO: check the dask and unlimited_dims options for live monitoring capabilities
+
+        with self.lock:
+            for varName in self.xrDataset.keys():
+                dataArray = self.xrDataset[varName]
+                rewrite = createXarrayFromScratch or varName in self.modifiedVariables
+                for layout in self.persistedLayouts(dataArray):
+                    filePath = self.layoutFilePath(varName, layout)
+                    if rewrite or not os.path.exists(filePath):
+                        self.writeDataArray(dataArray.load(), filePath, layout)
+
+            self.modifiedVariables.clear()
+
+            # with the chunked backend the persisted variables are released from memory and read lazily from disk
+            if self.store is not None:
+                for varName in list(self.xrDataset.keys()):
+                    self.store.open(varName)
+                self.xrDataset = xr.Dataset()
+
+            # manifest of the ingested timestamps, used to find the cycles not yet in the persisted cube
+            with open(os.path.join('datacube', 'manifest.json.tmp'), 'w') as manifestFile:
+                json.dump({'timestamps': self.getTimestamps()}, manifestFile)
+            os.replace(os.path.join('datacube', 'manifest.json.tmp'), os.path.join('datacube', 'manifest.json'))
+
+    def persistedLayouts(self, dataArray):
+        # the link major layout only pays off for the variables with both a linkID and a time dimension,
+        # and is only read by the chunked backend
+        if self.dualLayout and self.store is not None and 'linkID' in dataArray.dims and 'time' in dataArray.dims:
+            return ['map', 'hydrograph']
+        return ['map']
+
+    @staticmethod
+    def layoutFilePath(varName, layout):
+        if layout == 'map':
+            return os.path.join('datacube', f'{varName}.nc')
+        return os.path.join('datacube', f'{varName}.linkmajor.nc')
+
+    @staticmethod
+    def writeDataArray(dataArray, filePath, layout):
+        # chunked and compressed, with an unlimited time dimension so that new cycles can be appended in place
+        # in the storage dtype of the variable
+        chunks = chunk_shape(list(dataArray.dims), dataArray.shape, dataArray.dtype.itemsize, layout)
+        encoding = {dataArray.name: dict(netcdf_encoding(dataArray), chunksizes=chunks)}
+        # xarray packs the values itself, with the scale and offset of the encoding
+        # the encoding a variable was loaded with is dropped, the storage dtype may have changed since
+        dataArray = decode_data_array(dataArray).copy(deep=False)
+        dataArray.encoding = {}
+        # write to a temporary file and move it in place, this only needs write permission
+        # on the datacube directory and never leaves a half written variable behind
+        dataArray.to_netcdf(path=f'{filePath}.tmp', mode='w', format='NETCDF4', encoding=encoding,
+                            unlimited_dims=['time'] if 'time' in dataArray.dims else None)
+        os.replace(f'{filePath}.tmp', filePath)
 
     def bookkeeping(self, createXarrayFromScratch):
         self.compute_object_size()
         self.saveNetCDF(createXarrayFromScratch)
-        print("Finished bookkeeping")
\ No newline at end of file
+        print("Finished bookkeeping")
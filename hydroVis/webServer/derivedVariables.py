@@ -0,0 +1,77 @@
+import numpy as np
+import xarray as xr
+
+# Derived diagnostics of the state variables, evaluated once over the whole cube (or the newly appended cycles)
+# and stored in the datacube as {stateVariable}_derived with dims (linkID, time, diagnostic),
+# so that the map reads them at the cost of a raw variable
+
+class CubeSlices:
+    # (linkID, time) slices of the cube arrays of one state variable by label, as numpy views
+    def __init__(self, dataArray, priorinfArray):
+        self.values = dataArray.values
+        self.priorinfValues = priorinfArray.values
+        self.daPhases = [str(daPhase) for daPhase in dataArray.coords['daPhase'].values]
+        self.aggregations = [str(aggregation) for aggregation in dataArray.coords['aggregation'].values]
+        self.inflationDaPhases = [str(daPhase) for daPhase in priorinfArray.coords['daPhase'].values]
+
+    def data(self, daPhase, aggregation):
+        return self.values[:, :, self.daPhases.index(daPhase), self.aggregations.index(aggregation)]
+
+    def priorinf(self, daPhase):
+        return self.priorinfValues[:, :, self.inflationDaPhases.index(daPhase)]
+
+def safe_ratio(numerator, denominator):
+    # nan where the denominator is 0, e.g. links without spread
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator != 0, numerator / denominator, np.nan)
+
+# name -> expression over the CubeSlices of a state variable, in the order of the diagnostic coordinate
+derivedDiagnostics = {
+    # analysis minus preassim ensemble mean
+    'increment': lambda cube: cube.data('analysis', 'mean') - cube.data('preassim', 'mean'),
+    # reduction of the ensemble spread by the assimilation, 1 where the observations had no impact
+    'spreadRatio': lambda cube: safe_ratio(cube.data('analysis', 'sd'), cube.data('preassim', 'sd')),
+    # departure of the free running open loop from the analysis mean
+    'openloopMinusAnalysis': lambda cube: cube.data('openloop', 'mean') - cube.data('analysis', 'mean'),
+    # preassim spread scaled by the prior inflation, which DART applies to the variance
+    'inflatedSpread': lambda cube: cube.data('preassim', 'sd') * np.sqrt(cube.priorinf('preassim'))
+}
+
+def build_derived_data_array(dataArray, priorinfArray, name):
+    cube = CubeSlices(dataArray, priorinfArray)
+    with np.errstate(invalid='ignore'):
+        values = np.stack([expression(cube) for expression in derivedDiagnostics.values()], axis=-1)
+
+    return xr.DataArray(
+        data=values,
+        coords={'linkID': dataArray.coords['linkID'].values, 'time': dataArray.coords['time'].values, 'diagnostic': list(derivedDiagnostics.keys())},
+        dims=['linkID', 'time', 'diagnostic'],
+        name=name
+    )
+
+# percentiles of the ensemble members stored as {stateVariable}_quantiles with dims (linkID, time, daPhase, quantile),
+# the hydrograph envelopes of skewed ensembles (streamflow) which mean +- sd misrepresents
+memberQuantiles = [5, 25, 50, 75, 95]
+
+# cycles processed at a time, np.quantile partitions a copy of the member block
+quantileTimeBlock = 64
+
+def build_quantile_data_array(dataArray, name):
+    aggregations = [str(aggregation) for aggregation in dataArray.coords['aggregation'].values]
+    memberPositions = [position for position, aggregation in enumerate(aggregations) if aggregation not in ['mean', 'sd']]
+    values = dataArray.values
+    numLinks, numTimes, numDaPhases, _ = values.shape
+
+    quantiles = np.empty((numLinks, numTimes, numDaPhases, len(memberQuantiles)), dtype=np.float32)
+    for start in range(0, numTimes, quantileTimeBlock):
+        members = values[:, start:start + quantileTimeBlock][..., memberPositions]
+        # cycles without members (openloop not run yet) stay nan
+        quantiles[:, start:start + quantileTimeBlock] = np.moveaxis(np.quantile(members, np.array(memberQuantiles) / 100, axis=-1), 0, -1)
+
+    return xr.DataArray(
+        data=quantiles,
+        coords={'linkID': dataArray.coords['linkID'].values, 'time': dataArray.coords['time'].values,
+                'daPhase': dataArray.coords['daPhase'].values, 'quantile': memberQuantiles},
+        dims=['linkID', 'time', 'daPhase', 'quantile'],
+        name=name
+    )
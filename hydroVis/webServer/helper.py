@@ -2,50 +2,107 @@ import os
 import f90nml
 import shutil
 import argparse
+import tempfile
+import subprocess
+import importlib.util
+from functools import lru_cache
+from multiprocessing import Pool
 
-def obs_seq_to_netcdf_wrapper(obs_data_dir):
-    # wrapper function to convert obs_seq files to 
-    # netcdf format for ease of parsing
-    # requires obs_seq_to_netcdf utility to be built
-    # for the wrf_hydro model
-
+def get_dart_path():
     cwd = os.getcwd()   # DART/hydrovis
-    dartPath = cwd[:cwd.index('DART')+4]
+    return cwd[:cwd.index('DART')+4]
 
-    obs_seq_to_netcdf_dir_path = os.path.join(dartPath, 'models', 'wrf_hydro', 'work')
+def get_obs_seq_to_netcdf_dir_path():
+    # the obs_seq_to_netcdf utility built for the wrf_hydro model
+    return os.path.join(get_dart_path(), 'models', 'wrf_hydro', 'work')
 
-    shutil.copy2(os.path.join(obs_seq_to_netcdf_dir_path, 'input.nml'),
-                 os.path.join(obs_seq_to_netcdf_dir_path, 'input_org.nml'))
-    
-    nml_data = f90nml.read(os.path.join(obs_seq_to_netcdf_dir_path, 'input.nml'))
+@lru_cache(maxsize=None)
+def load_obs_seq_module():
+    # the native obs_seq reader of hydrodartpy, only depends on numpy
+    # loaded from its file, the hydrodartpy package itself requires wrfhydropy
+    # found relative to this file (DART/hydroVis/webServer), the server can be started from any directory
+    repoPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+    modulePath = os.path.join(repoPath, 'models', 'wrf_hydro', 'hydro_dart_py', 'hydrodartpy', 'core', 'obs_seq.py')
+    spec = importlib.util.spec_from_file_location('hydrodartpy_obs_seq', modulePath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
-    # set working directory to obs_seq_to_netcdf_utility_path for the utility to work correctly
-    os.chdir(obs_seq_to_netcdf_dir_path)
-    
-    for timestamp in os.listdir(os.path.join(obs_data_dir, 'output')):
-        # check if file exists
-        if os.path.exists(os.path.join(obs_data_dir, 'output', timestamp, f'obs_seq.final.{timestamp}.nc')):
-            continue
+def is_conversion_needed(obs_data_dir, timestamp):
+    # convert cycles without a netcdf file, or whose netcdf file is older than the obs_seq file
+    obsSeqPath = os.path.join(obs_data_dir, 'output', timestamp, f'obs_seq.final.{timestamp}')
+    netcdfPath = f'{obsSeqPath}.nc'
+    if not os.path.exists(obsSeqPath):
+        return False
+
+    return not os.path.exists(netcdfPath) or os.path.getmtime(netcdfPath) < os.path.getmtime(obsSeqPath)
+
+def convert_obs_seq_file(task):
+    # convert the obs_seq file of one cycle in its own scratch directory
+    # the scratch directory holds the cycle's own input.nml and links to everything else in the work directory,
+    # so that conversions can run concurrently and never modify the shared work directory
+    obs_data_dir, timestamp, obs_seq_to_netcdf_dir_path = task
+    obsSeqPath = os.path.join(obs_data_dir, 'output', timestamp, f'obs_seq.final.{timestamp}')
+
+    scratchPath = tempfile.mkdtemp(prefix=f'obs_seq_to_netcdf.{timestamp}.')
+    try:
+        for fileName in os.listdir(obs_seq_to_netcdf_dir_path):
+            # the utility writes its own dart_log.out/dart_log.nml and obs_epoch files in the scratch directory
+            if fileName == 'input.nml' or fileName.startswith('obs_epoch_') or fileName.startswith('dart_log.'):
+                continue
+            os.symlink(os.path.join(obs_seq_to_netcdf_dir_path, fileName), os.path.join(scratchPath, fileName))
 
         # set the file path for the obs_seq file to be converted to netcdf
-        nml_data['obs_seq_to_netcdf_nml']['obs_sequence_name'] = os.path.join(obs_data_dir, 'output', timestamp, f'obs_seq.final.{timestamp}')
+        nml_data = f90nml.read(os.path.join(obs_seq_to_netcdf_dir_path, 'input.nml'))
+        nml_data['obs_seq_to_netcdf_nml']['obs_sequence_name'] = os.path.abspath(obsSeqPath)
         nml_data['obs_seq_to_netcdf_nml']['obs_sequence_list'] = ''
-        nml_data.write(os.path.join(obs_seq_to_netcdf_dir_path, 'input.nml'), force=True)
+        nml_data.write(os.path.join(scratchPath, 'input.nml'), force=True)
 
         # run the obs_seq_to_netcdf utility
-        os.system('./obs_seq_to_netcdf')
+        result = subprocess.run(['./obs_seq_to_netcdf'], cwd=scratchPath, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode != 0 or not os.path.exists(os.path.join(scratchPath, 'obs_epoch_001.nc')):
+            return timestamp, False, result.stdout
+
+        # move the netcdf file in its appropriate place, the temporary name keeps readers from seeing a partial file
+        netcdfPath = f'{obsSeqPath}.nc'
+        shutil.copy2(os.path.join(scratchPath, 'obs_epoch_001.nc'), f'{netcdfPath}.tmp')
+        os.replace(f'{netcdfPath}.tmp', netcdfPath)
+        return timestamp, True, ''
 
-        # move the netcdf file back in its appropriate place
-        shutil.copy2('obs_epoch_001.nc', 
-                     os.path.join(obs_data_dir, 'output', timestamp, f'obs_seq.final.{timestamp}.nc'))
-        
-        os.remove('obs_epoch_001.nc')
+    finally:
+        shutil.rmtree(scratchPath, ignore_errors=True)
+
+def obs_seq_to_netcdf_wrapper(obs_data_dir, workers=1):
+    # wrapper function to convert obs_seq files to
+    # netcdf format for ease of parsing
+    # requires obs_seq_to_netcdf utility to be built
+    # for the wrf_hydro model
+    # cycles are converted concurrently across a process pool, cycles with an up to date netcdf file are skipped
+
+    obs_seq_to_netcdf_dir_path = get_obs_seq_to_netcdf_dir_path()
+
+    timestamps = sorted(timestamp for timestamp in os.listdir(os.path.join(obs_data_dir, 'output'))
+                        if os.path.isdir(os.path.join(obs_data_dir, 'output', timestamp)) and is_conversion_needed(obs_data_dir, timestamp))
+    if not timestamps:
+        return []
+
+    tasks = [(obs_data_dir, timestamp, obs_seq_to_netcdf_dir_path) for timestamp in timestamps]
+    if workers <= 1 or len(tasks) <= 1:
+        results = [convert_obs_seq_file(task) for task in tasks]
+    else:
+        with Pool(min(workers, len(tasks))) as pool:
+            results = pool.map(convert_obs_seq_file, tasks)
 
-    os.remove(os.path.join(obs_seq_to_netcdf_dir_path, 'input.nml'))
-    os.rename(os.path.join(obs_seq_to_netcdf_dir_path, 'input_org.nml'), os.path.join(obs_seq_to_netcdf_dir_path, 'input.nml'))
+    converted = []
+    for timestamp, success, output in results:
+        if success:
+            converted.append(timestamp)
+        else:
+            print(f'Failed to convert obs_seq.final.{timestamp}:')
+            print(output)
 
-    # restore calling function's working directory
-    os.chdir(cwd)
+    print(f'Converted {len(converted)} of {len(timestamps)} obs_seq files to netcdf')
+    return converted
 
 def clear_obs_seq_netcdf_files(obs_data_dir):
     for timestamp in os.listdir(os.path.join(obs_data_dir, 'output')):
@@ -57,6 +114,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog="HydroVis - helper to convert obs_seq files to netcdf format")
     parser.add_argument('-f', '--modelFilesPath', required=True)
     parser.add_argument('-d', '--deleteNetcdfFiles', action='store_true')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of cycles converted concurrently')
 
     args = parser.parse_args()
     obs_data_dir = args.modelFilesPath
@@ -66,4 +124,4 @@ if __name__ == '__main__':
         clear_obs_seq_netcdf_files(obs_data_dir)
 
     else:
-        obs_seq_to_netcdf_wrapper(obs_data_dir)
\ No newline at end of file
+        obs_seq_to_netcdf_wrapper(obs_data_dir, args.workers)
@@ -0,0 +1,106 @@
+import json
+import bisect
+import threading
+from contextlib import contextmanager
+from time import time, time_ns
+
+# Per endpoint latency metrics of the hydroVis routes
+# every request is split into phases: parse (query parsing), select (datacube selection),
+# serialize (json or binary encoding) and total, plus the number of bytes sent
+# the metrics are kept per process, with several gunicorn workers each reports its own
+
+# upper bounds of the latency histogram buckets in ms, roughly 10 buckets per decade
+bucketBoundsMs = [round(0.01 * 10 ** (i / 10), 4) for i in range(71)]
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(bucketBoundsMs) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, valueMs):
+        self.counts[bisect.bisect_left(bucketBoundsMs, valueMs)] += 1
+        self.count += 1
+        self.sum += valueMs
+        self.max = max(self.max, valueMs)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q quantile
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return bucketBoundsMs[bucket] if bucket < len(bucketBoundsMs) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'meanMs': self.sum / self.count if self.count else None,
+            'p50Ms': self.quantile(0.5),
+            'p95Ms': self.quantile(0.95),
+            'p99Ms': self.quantile(0.99),
+            'maxMs': self.max
+        }
+
+class RequestTimer:
+    # phase timings of one request, phases may run on the read pool threads
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time_ns()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time_ns()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (time_ns() - start) * 1e-6
+
+class Metrics:
+    def __init__(self, traceFilePath=None):
+        # endpoint -> phase -> LatencyHistogram
+        self.histograms = {}
+        # endpoint -> number of bytes sent
+        self.bytesSent = {}
+        self.lock = threading.Lock()
+        # optional json lines file with one record per request
+        self.traceFile = open(traceFilePath, 'a', buffering=1) if traceFilePath else None
+
+    def beginRequest(self, endpoint):
+        return RequestTimer(endpoint)
+
+    def endRequest(self, timer, status, bytesSent):
+        totalMs = (time_ns() - timer.start) * 1e-6
+        with self.lock:
+            histograms = self.histograms.setdefault(timer.endpoint, {})
+            for name, valueMs in list(timer.phases.items()) + [('total', totalMs)]:
+                histograms.setdefault(name, LatencyHistogram()).record(valueMs)
+            self.bytesSent[timer.endpoint] = self.bytesSent.get(timer.endpoint, 0) + bytesSent
+
+            if self.traceFile is not None:
+                self.traceFile.write(json.dumps({
+                    'time': time(),
+                    'endpoint': timer.endpoint,
+                    'status': status,
+                    'phasesMs': timer.phases,
+                    'totalMs': totalMs,
+                    'bytes': bytesSent
+                }) + '\n')
+
+        return totalMs
+
+    def summary(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    'phases': {name: histogram.summary() for name, histogram in histograms.items()},
+                    'bytesSent': self.bytesSent.get(endpoint, 0)
+                }
+                for endpoint, histograms in self.histograms.items()
+            }
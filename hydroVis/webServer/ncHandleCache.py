@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import netCDF4 as nc
+
+# Shared cache of open netCDF file handles for the file access paths
+# handles are kept open between requests up to an open file budget and closed in LRU order,
+# the HDF5 library is not thread safe, so handles are only used while holding hdf5Lock
+
+# one lock for every access to the HDF5 library in this process, shared with the chunked datacube backend
+hdf5Lock = threading.RLock()
+
+class NcHandleCache:
+    def __init__(self, maxOpenFiles=64):
+        self.maxOpenFiles = maxOpenFiles
+        # file path -> [nc.Dataset, number of users]
+        self.handles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def open(self, filePath):
+        # the handle is pinned and hdf5Lock is held while it is used, do not keep references beyond the with block
+        with hdf5Lock:
+            entry = self.handles.get(filePath)
+            if entry is None:
+                self.misses += 1
+                entry = [nc.Dataset(filePath), 0]
+                self.handles[filePath] = entry
+            else:
+                self.hits += 1
+                self.handles.move_to_end(filePath)
+
+            # pinned before evicting, so that the new handle is never the one closed
+            entry[1] += 1
+            self.evict()
+            try:
+                yield entry[0]
+            finally:
+                entry[1] -= 1
+
+    def evict(self):
+        # close the least recently used handles which are not in use until the budget is met
+        for filePath in list(self.handles.keys()):
+            if len(self.handles) <= self.maxOpenFiles:
+                break
+            ncData, users = self.handles[filePath]
+            if users == 0:
+                ncData.close()
+                del self.handles[filePath]
+                self.evictions += 1
+
+    def resize(self, maxOpenFiles):
+        # change the open file budget, e.g. once the number of ensemble members is known
+        with hdf5Lock:
+            self.maxOpenFiles = maxOpenFiles
+            self.evict()
+
+    def close(self):
+        with hdf5Lock:
+            for ncData, _ in self.handles.values():
+                ncData.close()
+            self.handles.clear()
+
+    def stats(self):
+        with hdf5Lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'openFiles': len(self.handles),
+                'maxOpenFiles': self.maxOpenFiles
+            }
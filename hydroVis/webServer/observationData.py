@@ -2,81 +2,235 @@ import netCDF4 as nc
 import xarray as xr
 import os
 import numpy as np
-
-from .helper import obs_seq_to_netcdf_wrapper
+from time import time_ns
+from multiprocessing import Pool
+
+from .helper import obs_seq_to_netcdf_wrapper, load_obs_seq_module
+from .bulkLoader import ReadStats
+from .assimilationData import to_json_values
+from .derivedVariables import memberQuantiles
+
+# DART's MISSING_R8, stored for the copies which were not computed, e.g. the posterior of QC rejected observations
+dartMissingValue = -888888.0
+
+def group_by_gauge(obsType, linkIDCoords):
+    # sort based grouping of the observations by gauge
+    # returns the order of the observations, the gauge positions in linkIDCoords and the group starts and sizes in that order
+    gaugeIndexes = np.searchsorted(linkIDCoords, -obsType)
+    order = np.argsort(gaugeIndexes, kind='stable')
+    gauges, starts, counts = np.unique(gaugeIndexes[order], return_index=True, return_counts=True)
+    return order, gauges, starts, counts
+
+def read_copy_names(ncData):
+    # names of the copies of the obs_seq netcdf file: observations, prior/posterior ensemble mean, spread and members
+    if 'CopyMetaData' in ncData.variables:
+        return [str(name).strip() for name in nc.chartostring(ncData.variables['CopyMetaData'][:])]
+    return [str(copy) for copy in range(ncData.dimensions['copy'].size)]
+
+def read_observation_file(filePath):
+    # obs_type, observations (obs x copies), lon/lat locations and copy names of an obs_seq file
+    # obs_seq_to_netcdf output if the path ends in .nc, else the obs_seq file itself read by the native reader
+    # missing copies are returned as nan
+    if filePath.endswith('.nc'):
+        with nc.Dataset(filePath) as ncData:
+            ncData.set_auto_mask(False)
+            observationsVariable = ncData.variables['observations']
+            observations = np.array(observationsVariable[:], dtype=np.float64)
+            # obs_seq_to_netcdf writes MISSING_R8 as the netcdf fill value, listed in missing_value
+            missingValues = [dartMissingValue] + [getattr(observationsVariable, name) for name in ['missing_value', '_FillValue'] if name in observationsVariable.ncattrs()]
+            observations[np.isin(observations, np.asarray(missingValues, dtype=np.float64))] = np.nan
+            return ncData.variables['obs_type'][:], observations, ncData.variables['location'][:, :2], read_copy_names(ncData)
+
+    header, columns = load_obs_seq_module().read_obs_seq(filePath)
+    if not columns:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, len(header.copy_names))), np.zeros((0, 2)), header.copy_names
+    observations = np.array(columns['values'], dtype=np.float64)
+    observations[observations == dartMissingValue] = np.nan
+    return columns['kind'], observations, columns['location'][:, :2], header.copy_names
+
+def normalize_copy_name(name):
+    # DART pads the names, e.g. 'prior ensemble member      1', the whitespace is normalized
+    return ' '.join(str(name).split())
+
+def copy_index(copyNames, name, fallbackIndex):
+    # position of a copy by its obs_seq name, None if the file has no such copy (e.g. no posterior copies)
+    # DART's default copy order is only assumed if the file has no copy names at all
+    copyNames = [normalize_copy_name(copyName) for copyName in copyNames]
+    if all(copyName.isdigit() for copyName in copyNames):
+        return fallbackIndex if fallbackIndex < len(copyNames) else None
+    name = normalize_copy_name(name)
+    return copyNames.index(name) if name in copyNames else None
+
+def observation_copy_index(copyNames):
+    # position of the observation copy, named 'observation' by DART or e.g. 'NCEP BUFR observation',
+    # the first copy if no name ends in observation(s)
+    for index, copyName in enumerate(copyNames):
+        if normalize_copy_name(copyName).lower().endswith(('observation', 'observations')):
+            return index
+    return 0
+
+def grouped_nanmean(values, starts):
+    # mean of the consecutive groups of rows beginning at starts, per column and ignoring nan, nan for groups without values
+    valid = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(valid, values, 0), starts, axis=0)
+    validCounts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(validCounts > 0, sums / validCounts, np.nan)
+
+def average_observation_file_task(task):
+    # process pool task: read the obs_seq file of one timestamp (cycle) once and average every copy of the observations
+    # of every gauge in a single grouped reduction, the gauges of all the cycles are only known once every file is read,
+    # so the gauge linkIDs are returned with their averages and locations
+    timestamp, filePath, timeIndex = task
+
+    start = time_ns()
+    obsType, observations, locations, _ = read_observation_file(filePath)
+    readTime = (time_ns() - start) * 1e-9
+
+    start = time_ns()
+    gaugeLinkIDs = np.unique(-obsType)
+    order, _, starts, _ = group_by_gauge(obsType, gaugeLinkIDs)
+    averages = grouped_nanmean(observations[order], starts)
+    gaugeLocations = np.asarray(locations, dtype=np.float64)[order][starts]
+
+    stats = ReadStats()
+    stats.record(filePath, obsType.nbytes + observations.nbytes + locations.nbytes, readTime, (time_ns() - start) * 1e-9)
+    return timestamp, timeIndex, gaugeLinkIDs, averages, gaugeLocations, stats
 
 # Class definition for parsing observation data
 # and creating xarray dataArray data structure from it
 
 class ObservationData:
-    def __init__(self, modelFilesPath, timestampList, datacube, createXarrayFromScratch):
+    def __init__(self, modelFilesPath, timestampList, datacube, createXarrayFromScratch, workers=1, obsSeqReader='netcdf'):
         self.timestampList = timestampList
+        self.workers = workers
         self.modelFilesPath = modelFilesPath
-        # convert obs_seq file to netcdf format
-        obs_seq_to_netcdf_wrapper(self.modelFilesPath)
+        # 'netcdf': convert the obs_seq files with DART's obs_seq_to_netcdf utility and read the netcdf files
+        # 'native': read the obs_seq files directly, no DART build is needed
+        self.obsSeqReader = obsSeqReader
+        self.convertObsSeqFiles()
 
-        self.observedLinkLocations = {}
-        self.observedLinkDataIndexes = {}
+        obsType, _, locations, self.copyNames = read_observation_file(self.obsSeqFilePath(self.timestampList[0]))
+        locations = np.asarray(locations, dtype=np.float64)
 
-        obs_seq = nc.Dataset(os.path.join(self.modelFilesPath, 'output', self.timestampList[0], f'obs_seq.final.{self.timestampList[0]}.nc'))
-        for idx, linkID in enumerate(obs_seq.variables['obs_type'][:]):
-            location = [
-                float(obs_seq.variables['location'][idx][0]),
-                float(obs_seq.variables['location'][idx][1])
-            ]
-            assert (-linkID not in self.observedLinkLocations) or (self.observedLinkLocations[-linkID] == location)
-            # multiple observations may exist for each location, thus check the assert condition for sanity
-            self.observedLinkLocations[-linkID] = location
-            
-            if -linkID not in self.observedLinkDataIndexes:
-                self.observedLinkDataIndexes[-linkID] = []
-            self.observedLinkDataIndexes[-linkID].append(idx)
-
-        self.linkIDCoords = set()
-
-        for timestamp in self.timestampList:
-            # iterate over all the obs_seq files once to gather all the gauge (link) IDs
-            # different obs_seq files have different gauge (link) IDs
-            ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'obs_seq.final.{timestamp}.nc'))
-            self.linkIDCoords.update(set(-1 * ncData.variables['obs_type'][:]))
-
-        self.linkIDCoords = list(self.linkIDCoords)
-
-        if not createXarrayFromScratch and os.path.exists(os.path.join('datacube', 'observation_gauge_data.nc')) \
-            and os.path.exists(os.path.join('datacube', 'observation_gauge_locations.nc')):
-
-            self.observation_gauge_data = xr.open_dataarray(os.path.join('datacube', 'observation_gauge_data.nc'))
-            self.observation_gauge_locations = xr.open_dataarray(os.path.join('datacube', 'observation_gauge_locations.nc'))
-
-        else:            
-            self.observation_gauge_data = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), len(self.timestampList))),#, len(daPhaseCoords), len(aggregationCoords))), 
-                coords={'linkID': self.linkIDCoords, 'time': self.timestampList},#, 'daPhase':daPhaseCoords, 'aggregation':aggregationCoords}, 
-                dims=['linkID', 'time'],#, 'daPhase', 'aggregation'], 
-                name='observation_gauge_data'
-            )
-
-            self.observation_gauge_locations = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), 2)),
-                coords={'linkID': self.linkIDCoords, 'location': ['lon', 'lat']},
-                dims=['linkID', 'location'],
-                name='observation_gauge_locations'
-            )
-
-            for timestamp in self.timestampList:
-                ncData = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'obs_seq.final.{timestamp}.nc'))
-
-                for linkID in np.unique(ncData.variables['obs_type']):
-                    linkIDIndexes = np.where(ncData.variables['obs_type'][:] == linkID)[0]
-                    self.observation_gauge_data.loc[dict(linkID=-linkID, time=timestamp)] = np.average(ncData.variables['observations'][linkIDIndexes, 0])
-
-                    linkIDIndex = linkIDIndexes[0]
-                    self.observation_gauge_locations.loc[dict(linkID=-linkID, location=['lon', 'lat'])] = ncData.variables['location'][linkIDIndex, :2]
-
-        datacube.addDataArray('observation_gauge_data', self.observation_gauge_data)
-        datacube.addDataArray('observation_gauge_locations', self.observation_gauge_locations)
-
-    def getHydrographStateVariableData(self, linkID, aggregation):
+        # multiple observations may exist for each location, check that they all are at the same location for sanity
+        linkIDs = np.unique(-obsType)
+        order, gauges, starts, counts = group_by_gauge(obsType, linkIDs)
+        assert (locations[order] == np.repeat(locations[order][starts], counts, axis=0)).all()
+        self.observedLinkLocations = dict(zip(linkIDs[gauges].tolist(), locations[order][starts].tolist()))
+
+        self.dataArrayNames = ['observation_gauge_data', 'observation_gauge_copies', 'observation_gauge_locations']
+        if not createXarrayFromScratch and all(datacube.hasPersistedDataArray(dataArrayName) for dataArrayName in self.dataArrayNames):
+            for dataArrayName in self.dataArrayNames:
+                datacube.loadDataArray(dataArrayName)
+
+        else:
+            for dataArrayName, dataArray in self.buildDataArrays(self.timestampList).items():
+                datacube.addDataArray(dataArrayName, dataArray)
+
+        # the gauge arrays are small, a copy is kept in memory with every datacube backend
+        self.updateFromDatacube(datacube)
+
+    def convertObsSeqFiles(self):
+        # convert obs_seq files to netcdf format, not needed by the native reader
+        if self.obsSeqReader == 'netcdf':
+            obs_seq_to_netcdf_wrapper(self.modelFilesPath, self.workers)
+
+    def obsSeqFilePath(self, timestamp):
+        obsSeqPath = os.path.join(self.modelFilesPath, 'output', timestamp, f'obs_seq.final.{timestamp}')
+        return f'{obsSeqPath}.nc' if self.obsSeqReader == 'netcdf' else obsSeqPath
+
+    def averageObservationFiles(self, timestamps):
+        # every obs_seq file is read exactly once, across a process pool when workers > 1
+        tasks = [(timestamp, self.obsSeqFilePath(timestamp), timeIndex) for timeIndex, timestamp in enumerate(timestamps)]
+        if self.workers <= 1 or len(tasks) <= 1:
+            results = map(average_observation_file_task, tasks)
+            return [self.logObservationFile(result) for result in results]
+
+        with Pool(min(self.workers, len(tasks))) as pool:
+            return [self.logObservationFile(result) for result in pool.imap_unordered(average_observation_file_task, tasks)]
+
+    @staticmethod
+    def logObservationFile(result):
+        timestamp, _, _, _, _, stats = result
+        print("Loaded timestamp", timestamp, stats.summary())
+        return result
+
+    def buildDataArrays(self, timestamps):
+        results = self.averageObservationFiles(timestamps)
+        stats = ReadStats()
+        for *_, fileStats in results:
+            stats.merge(fileStats)
+        print("Observation data read stats:", stats.summary())
+
+        # different obs_seq files have different gauge (link) IDs, the coordinate is the sorted union of them
+        linkIDCoords = np.unique(np.concatenate([gaugeLinkIDs for _, _, gaugeLinkIDs, _, _, _ in results]))
+        copies = np.full((len(linkIDCoords), len(timestamps), len(self.copyNames)), np.nan)
+        locations = np.full((len(linkIDCoords), 2), np.nan)
+        for _, timeIndex, gaugeLinkIDs, averages, gaugeLocations, _ in results:
+            gauges = np.searchsorted(linkIDCoords, gaugeLinkIDs)
+            copies[gauges, timeIndex, :] = averages
+            locations[gauges, :] = gaugeLocations
+        linkIDCoords = linkIDCoords.tolist()
+
+        # all the copies: observations, prior/posterior ensemble mean, spread and members, averaged per gauge
+        observation_gauge_copies = xr.DataArray(
+            data=copies,
+            coords={'linkID': linkIDCoords, 'time': list(timestamps), 'copy': self.copyNames},
+            dims=['linkID', 'time', 'copy'],
+            name='observation_gauge_copies'
+        )
+
+        # the observation copy only, read by the map and the assimilation data hydrographs
+        observation_gauge_data = xr.DataArray(
+            data=copies[:, :, observation_copy_index(self.copyNames)].copy(),
+            coords={'linkID': linkIDCoords, 'time': list(timestamps)},
+            dims=['linkID', 'time'],
+            name='observation_gauge_data'
+        )
+
+        observation_gauge_locations = xr.DataArray(
+            data=locations,
+            coords={'linkID': linkIDCoords, 'location': ['lon', 'lat']},
+            dims=['linkID', 'location'],
+            name='observation_gauge_locations'
+        )
+
+        return {
+            'observation_gauge_data': observation_gauge_data,
+            'observation_gauge_copies': observation_gauge_copies,
+            'observation_gauge_locations': observation_gauge_locations
+        }
+
+    def buildAppendDataArrays(self, timestamps):
+        # datacube arrays for newly finished cycles, see DataCube.appendTime
+        # gauges seen for the first time are added to the gauge locations
+        self.convertObsSeqFiles()
+        dataArrays = self.buildDataArrays(timestamps)
+        # the gauges are the union of the existing and the new ones, so that the arrays can be appended along time
+        linkIDCoords = np.union1d(self.observation_gauge_data.coords['linkID'].values, dataArrays['observation_gauge_data'].coords['linkID'].values)
+        for dataArrayName in ['observation_gauge_data', 'observation_gauge_copies']:
+            dataArrays[dataArrayName] = dataArrays[dataArrayName].reindex(linkID=linkIDCoords)
+        dataArrays['observation_gauge_locations'] = self.observation_gauge_locations.combine_first(dataArrays['observation_gauge_locations'])
+
+        return dataArrays
+
+    def updateFromDatacube(self, datacube):
+        self.observation_gauge_data = datacube.getDataArray('observation_gauge_data')
+        self.observation_gauge_copies = datacube.getDataArray('observation_gauge_copies')
+        self.observation_gauge_locations = datacube.getDataArray('observation_gauge_locations')
+
+    def isTimestampComplete(self, timestamp):
+        return os.path.exists(os.path.join(self.modelFilesPath, 'output', timestamp, f'obs_seq.final.{timestamp}'))
+
+    def getCopy(self, copies, name, fallbackIndex):
+        # (time) values of a copy, nan if the copy is not in the file
+        copyIndex = copy_index(self.observation_gauge_copies.coords['copy'].values, name, fallbackIndex)
+        return copies[copyIndex] if copyIndex is not None else np.full(copies.shape[1:], np.nan)
+
+    def getHydrographStateVariableData(self, linkID, aggregation, quantiles=False):
+        # observation space hydrograph at a gauge, read from the precomputed per gauge averages of all the copies
+        # with quantiles, also the member quantile envelopes, from the member copies of the gauge
         hydrographData = {}
         hydrographData['gaugeID'] = linkID
         
@@ -86,44 +240,54 @@ class ObservationData:
         else:
             hydrographData['agg'] = int(aggregation)
 
-        hydrographData['data'] = []
-
-        assert linkID in self.observedLinkLocations
-        for timestamp in self.timestampList:
-            obs_seq = nc.Dataset(os.path.join(self.modelFilesPath, 'output', timestamp, f'obs_seq.final.{timestamp}.nc'))
-
-            dataIndexID = self.observedLinkDataIndexes[linkID]
-
-            data = {}
-            data['timestamp'] = timestamp
-            averagedLinkData = np.average(obs_seq.variables['observations'][dataIndexID], axis=0)
-            data['observation'] = averagedLinkData[0].item()
-
-            if aggregation == 'mean':
-                data['forecast'] = averagedLinkData[1].item()
-                data['analysis'] = averagedLinkData[2].item()
-                data['forecastSdMin'] = averagedLinkData[1].item() - averagedLinkData[3].item()
-                data['forecastSdMax'] = averagedLinkData[1].item() + averagedLinkData[3].item()
-                data['analysisSdMin'] = averagedLinkData[2].item() - averagedLinkData[4].item()
-                data['analysisSdMax'] = averagedLinkData[2].item() + averagedLinkData[4].item()
-
-            elif aggregation == 'sd':
-                data['forecast'] = averagedLinkData[3].item()
-                data['analysis'] = averagedLinkData[4].item()
-                data['forecastSdMin'] = averagedLinkData[3].item()
-                data['forecastSdMax'] = averagedLinkData[4].item()
-                data['analysisSdMin'] = averagedLinkData[3].item()
-                data['analysisSdMax'] = averagedLinkData[4].item()
-
-            else:
-                data['forecast'] = averagedLinkData[4 + 2 * (aggregation - 1)].item() 
-                data['analysis'] = averagedLinkData[4 + 2 * (aggregation - 1) + 1].item()
-                data['forecastSdMin'] = averagedLinkData[1].item() - averagedLinkData[3].item()
-                data['forecastSdMax'] = averagedLinkData[1].item() + averagedLinkData[3].item()
-                data['analysisSdMin'] = averagedLinkData[2].item() - averagedLinkData[4].item()
-                data['analysisSdMax'] = averagedLinkData[2].item() + averagedLinkData[4].item()
-
-            hydrographData['data'].append(data)
+        assert linkID in self.observation_gauge_copies.indexes['linkID']
+        timestamps = list(self.timestampList)
+        copies = self.observation_gauge_copies.sel(linkID=linkID).reindex(time=timestamps).transpose('copy', 'time').values
+
+        # copies: observations, prior and posterior ensemble mean and spread, then prior and posterior of every member
+        observation = copies[observation_copy_index(self.observation_gauge_copies.coords['copy'].values)]
+        priorMean, posteriorMean = self.getCopy(copies, 'prior ensemble mean', 1), self.getCopy(copies, 'posterior ensemble mean', 2)
+        priorSpread, posteriorSpread = self.getCopy(copies, 'prior ensemble spread', 3), self.getCopy(copies, 'posterior ensemble spread', 4)
+
+        if aggregation == 'mean':
+            forecast, analysis = priorMean, posteriorMean
+            forecastSdMin, forecastSdMax = priorMean - priorSpread, priorMean + priorSpread
+            analysisSdMin, analysisSdMax = posteriorMean - posteriorSpread, posteriorMean + posteriorSpread
+
+        elif aggregation == 'sd':
+            forecast, analysis = priorSpread, posteriorSpread
+            forecastSdMin, forecastSdMax = priorSpread, priorSpread
+            analysisSdMin, analysisSdMax = posteriorSpread, posteriorSpread
+
+        else:
+            member = int(aggregation)
+            forecast = self.getCopy(copies, f'prior ensemble member {member}', 5 + 2 * (member - 1))
+            analysis = self.getCopy(copies, f'posterior ensemble member {member}', 5 + 2 * (member - 1) + 1)
+            forecastSdMin, forecastSdMax = priorMean - priorSpread, priorMean + priorSpread
+            analysisSdMin, analysisSdMax = posteriorMean - posteriorSpread, posteriorMean + posteriorSpread
+
+        series = {
+            'observation': observation,
+            'forecast': forecast,
+            'analysis': analysis,
+            'forecastSdMin': forecastSdMin,
+            'forecastSdMax': forecastSdMax,
+            'analysisSdMin': analysisSdMin,
+            'analysisSdMax': analysisSdMax
+        }
+        numMembers = sum(1 for copyName in self.observation_gauge_copies.coords['copy'].values if normalize_copy_name(copyName).startswith('prior ensemble member'))
+        if quantiles and numMembers > 0:
+            for phase, name, offset in [('prior', 'forecast', 0), ('posterior', 'analysis', 1)]:
+                members = np.stack([self.getCopy(copies, f'{phase} ensemble member {member}', 5 + 2 * (member - 1) + offset) for member in range(1, numMembers + 1)])
+                for quantile, values in zip(memberQuantiles, np.quantile(members, np.array(memberQuantiles) / 100, axis=0)):
+                    series[f'{name}Q{quantile}'] = values
+
+        series = {name: to_json_values(values) for name, values in series.items()}
+
+        hydrographData['data'] = [
+            dict(timestamp=timestamp, **{name: values[i] for name, values in series.items()})
+            for i, timestamp in enumerate(timestamps)
+        ]
 
         return hydrographData
 
@@ -150,7 +314,14 @@ class ObservationData:
         ]
 
         return gaugeLocationData
-    
+
+    def getGaugesInBoundingBox(self, bbox):
+        # linkIDs of the observation gauges within {lonMin, latMin, lonMax, latMax}
+        lon, lat = self.observation_gauge_locations.sel(location=['lon', 'lat']).values.T
+        inside = (lon >= bbox['lonMin']) & (lon <= bbox['lonMax']) & (lat >= bbox['latMin']) & (lat <= bbox['latMax'])
+        # the linkID coordinate may be stored as floats, the linkIDs are returned as ints like the requested ones
+        return self.observation_gauge_locations.coords['linkID'].values[inside].astype(int).tolist()
+
     def getObservationDataForHydrograph(self, linkID):
         renderData = {
             'gaugeID': linkID,
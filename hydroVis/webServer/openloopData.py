@@ -1,35 +1,58 @@
-import netCDF4 as nc
 import os
+import numpy as np
+
+from .bulkLoader import fill_blocks, load_state_files_task
 
 # Class definition for parsing openloop data
 # and creating xarray dataArray data structure from it
 
 class OpenLoopData:
-    def __init__(self, dataFilesPath, timestampList, numEnsembleModels, rlData, datacube, createXarrayFromScratch):
+    def __init__(self, dataFilesPath, timestampList, numEnsembleModels, stateVariables, rlData, datacube, createXarrayFromScratch, workers=1):
         self.dataFilesPath = dataFilesPath
         self.timestampList = timestampList
         self.numEnsembleModels = numEnsembleModels
+        self.stateVariables = stateVariables
         self.rlData = rlData
+        self.workers = workers
 
         self.linkIDCoords = self.rlData.linkIDCoords
 
         if createXarrayFromScratch:
-            self.qlink1_data = datacube.getDataArray('qlink1_data')
-            self.z_gwsubbas_data = datacube.getDataArray('z_gwsubbas_data')
-
-            for timestamp in self.timestampList:
-                ncData = nc.Dataset(os.path.join(dataFilesPath, 'output', timestamp, f'preassim_mean.{timestamp}.nc'))
-                self.qlink1_data.loc[dict(time=timestamp, daPhase='openloop', aggregation='mean')] = ncData.variables['qlink1'][self.linkIDCoords]
-                self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='openloop', aggregation='mean')] = ncData.variables['z_gwsubbas'][self.linkIDCoords]
-
-                ncData = nc.Dataset(os.path.join(dataFilesPath, 'output', timestamp, f'preassim_sd.{timestamp}.nc'))
-                self.qlink1_data.loc[dict(time=timestamp, daPhase='openloop', aggregation='sd')] = ncData.variables['qlink1'][self.linkIDCoords]
-                self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='openloop', aggregation='sd')] = ncData.variables['z_gwsubbas'][self.linkIDCoords]
-                
-                for memberID in range(1, numEnsembleModels+1, 1):
-                    ncData = nc.Dataset(os.path.join(dataFilesPath, 'output', timestamp, f'preassim_member_{str(memberID).rjust(4, "0")}.{timestamp}.nc'))
-                    self.qlink1_data.loc[dict(time=timestamp, daPhase='openloop', aggregation=str(memberID))] = ncData.variables['qlink1'][self.linkIDCoords]
-                    self.z_gwsubbas_data.loc[dict(time=timestamp, daPhase='openloop', aggregation=str(memberID))] = ncData.variables['z_gwsubbas'][self.linkIDCoords]        
-
-            datacube.addDataArray('qlink1_data', self.qlink1_data)
-            datacube.addDataArray('z_gwsubbas_data', self.z_gwsubbas_data)
+            self.dataArrays = {f'{stateVariable}_data': datacube.getDataArray(f'{stateVariable}_data') for stateVariable in self.stateVariables}
+            self.fillOpenloop(self.dataArrays, self.timestampList)
+
+            for stateVariable in self.stateVariables:
+                datacube.addDataArray(f'{stateVariable}_data', self.dataArrays[f'{stateVariable}_data'])
+
+    def fillOpenloop(self, dataArrays, timestamps):
+        # fill the openloop daPhase of the assimilation datacube arrays for the given timestamps
+        # timestamps the openloop run has not reached yet are left untouched
+        timestamps = [timestamp for timestamp in timestamps if os.path.exists(os.path.join(self.dataFilesPath, 'output', timestamp, f'preassim_mean.{timestamp}.nc'))]
+        if not timestamps:
+            return
+
+        sampleDataArray = dataArrays[f'{self.stateVariables[0]}_data']
+        aggregationCoords = list(sampleDataArray.coords['aggregation'].values)
+        openloopDaPhaseIndex = list(sampleDataArray.coords['daPhase'].values).index('openloop')
+        timeIndexes = [list(sampleDataArray.coords['time'].values).index(timestamp) for timestamp in timestamps]
+
+        # the openloop run only has preassim files, they are loaded into a block with a single daPhase
+        # and copied into the openloop daPhase of the assimilation datacube arrays
+        shapes = {'data': {stateVariable: (len(self.linkIDCoords), len(timestamps), 1, len(aggregationCoords)) for stateVariable in self.stateVariables}}
+        tasks = [(timestamp, os.path.join(self.dataFilesPath, 'output', timestamp), self.getFilePlan(timestamp, aggregationCoords), timeIndex)
+                 for timeIndex, timestamp in enumerate(timestamps)]
+        # the linkID coordinates are 1-based indexes into the state vector, same as for the assimilation data
+        blocks = fill_blocks(load_state_files_task, tasks, shapes, (self.stateVariables, np.asarray(self.linkIDCoords) - 1), self.workers, "Open loop data")
+
+        for stateVariable in self.stateVariables:
+            dataArrays[f'{stateVariable}_data'].data[:, timeIndexes, openloopDaPhaseIndex, :] = blocks['data'][stateVariable][:, :, 0, :]
+
+    def getFilePlan(self, timestamp, aggregationCoords):
+        filePlan = [
+            (f'preassim_mean.{timestamp}.nc', 'data', 0, aggregationCoords.index('mean')),
+            (f'preassim_sd.{timestamp}.nc', 'data', 0, aggregationCoords.index('sd'))
+        ]
+        for memberID in range(1, self.numEnsembleModels+1, 1):
+            filePlan.append((f'preassim_member_{str(memberID).rjust(4, "0")}.{timestamp}.nc', 'data', 0, aggregationCoords.index(str(memberID))))
+
+        return filePlan
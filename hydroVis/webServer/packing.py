@@ -0,0 +1,112 @@
+import numpy as np
+import xarray as xr
+
+# Reduced precision storage of the datacube variables
+# 'float64': as loaded
+# 'float32': half the memory and disk footprint, plenty of precision for visualization
+# 'int16': linear scale/offset packing per variable, a quarter of the footprint,
+#          the quantization step is (max - min) / 65534 of the variable, nan is stored as the fill value
+# packed variables are held in memory as int16 arrays with their scale and offset in the attributes
+# and are decoded to float32 on selection
+
+storageDtypes = ['float64', 'float32', 'int16']
+
+int16FillValue = np.iinfo(np.int16).min
+int16MaxPacked = np.iinfo(np.int16).max
+
+def is_stored_reduced(dataArray):
+    # only the large (linkID, time, ...) float variables are stored with reduced precision
+    return 'linkID' in dataArray.dims and 'time' in dataArray.dims and np.issubdtype(dataArray.dtype, np.floating)
+
+def is_packed(dataArray):
+    return 'packScale' in dataArray.attrs
+
+def pack_int16(values):
+    # returns the int16 values and the scale and offset mapping the finite range onto [-32767, 32767]
+    finite = np.isfinite(values)
+    if finite.any():
+        low, high = float(values[finite].min()), float(values[finite].max())
+    else:
+        low, high = 0.0, 0.0
+    scale = (high - low) / (2 * int16MaxPacked) if high > low else 1.0
+    offset = (high + low) / 2
+    return pack_int16_with(values, scale, offset), scale, offset
+
+def pack_int16_with(values, scale, offset):
+    # int16 values with a given scale and offset, see fits_packing
+    finite = np.isfinite(values)
+    packed = np.full(values.shape, int16FillValue, dtype=np.int16)
+    packed[finite] = np.round((values[finite] - offset) / scale).astype(np.int16)
+    return packed
+
+def unpack_int16(packed, scale, offset):
+    values = packed.astype(np.float32) * np.float32(scale) + np.float32(offset)
+    values[packed == int16FillValue] = np.nan
+    return values
+
+def fits_packing(values, scale, offset):
+    # whether new values can be packed with an existing scale and offset without overflowing
+    finite = np.isfinite(values)
+    if not finite.any():
+        return True
+    return np.abs((values[finite] - offset) / scale).max() <= int16MaxPacked
+
+def encode_data_array(dataArray, storageDtype):
+    # convert a float64 variable to its storage representation
+    if storageDtype == 'float64' or is_packed(dataArray) or not is_stored_reduced(dataArray):
+        # packed variables keep their scale and offset, see DataCube.appendTime for the repacking
+        return dataArray
+
+    if storageDtype == 'float32':
+        return dataArray if dataArray.dtype == np.float32 else dataArray.astype(np.float32)
+
+    packed, scale, offset = pack_int16(np.asarray(dataArray.values))
+    return dataArray.copy(data=packed).assign_attrs(packScale=scale, packOffset=offset)
+
+def concat_time(dataArray, newDataArray):
+    # append the new timestamps of a variable in its storage representation, the other coordinates have to match,
+    # except that the new cycles may add links (the gauges observed for the first time), nan in the existing cycles
+    if 'linkID' in newDataArray.dims and not dataArray.indexes['linkID'].equals(newDataArray.indexes['linkID']):
+        if not dataArray.indexes['linkID'].isin(newDataArray.indexes['linkID']).all():
+            raise ValueError(f'the linkIDs of the new cycles of {newDataArray.name} do not include the existing ones')
+        dataArray = dataArray.reindex(linkID=newDataArray.indexes['linkID'], fill_value=int16FillValue if is_packed(dataArray) else np.nan)
+    return xr.concat([dataArray, newDataArray], dim='time', join='exact')
+
+def append_packed(dataArray, newDataArray):
+    # append float values along time to a packed variable with its scale and offset, the packed cycles are kept as is,
+    # None if the new values do not fit the packed range, the variable has then to be repacked
+    scale, offset = dataArray.attrs['packScale'], dataArray.attrs['packOffset']
+    newValues = np.asarray(newDataArray.values)
+    if not fits_packing(newValues, scale, offset):
+        return None
+
+    newPacked = newDataArray.copy(data=pack_int16_with(newValues, scale, offset))
+    newPacked.attrs = dict(dataArray.attrs)
+    return concat_time(dataArray, newPacked)
+
+def decode_data_array(dataArray):
+    # float values of a (selection of a) variable in its storage representation
+    if not is_packed(dataArray):
+        return dataArray
+
+    attrs = {name: value for name, value in dataArray.attrs.items() if name not in ['packScale', 'packOffset']}
+    values = unpack_int16(np.asarray(dataArray.values), dataArray.attrs['packScale'], dataArray.attrs['packOffset'])
+    decoded = dataArray.copy(data=values)
+    decoded.attrs = attrs
+    return decoded
+
+def netcdf_encoding(dataArray):
+    # zlib with the shuffle filter, which groups the bytes of the values and compresses floats much better,
+    # packed variables are written as netcdf scale_factor/add_offset integers
+    encoding = {'zlib': True, 'complevel': 4, 'shuffle': True}
+    if is_packed(dataArray):
+        encoding.update({
+            'dtype': 'int16',
+            'scale_factor': dataArray.attrs['packScale'],
+            'add_offset': dataArray.attrs['packOffset'],
+            '_FillValue': int16FillValue
+        })
+    elif np.issubdtype(dataArray.dtype, np.floating):
+        encoding['dtype'] = str(dataArray.dtype)
+
+    return encoding
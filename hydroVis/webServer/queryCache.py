@@ -0,0 +1,76 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Server side cache of serialized query results
+# entries are keyed on the endpoint, the normalized query and the datacube version,
+# so that results computed before new cycles were appended are never served again
+
+class QueryCache:
+    def __init__(self, maxBytes=256 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.currentBytes = 0
+        # key -> (body, mimetype, etag)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def makeKey(endpoint, query, version):
+        # normalized query: key order and whitespace do not matter
+        return f'{endpoint}|{version}|{json.dumps(query, sort_keys=True, separators=(",", ":"))}'
+
+    @staticmethod
+    def makeETag(key):
+        # the result is fully determined by the key, no need to hash the body
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, mimetype):
+        entry = (body, mimetype, self.makeETag(key))
+        with self.lock:
+            if key in self.entries or len(body) > self.maxBytes:
+                return entry
+
+            self.entries[key] = entry
+            self.currentBytes += len(body)
+            while self.currentBytes > self.maxBytes:
+                _, (evictedBody, _, _) = self.entries.popitem(last=False)
+                self.currentBytes -= len(evictedBody)
+                self.evictions += 1
+
+        return entry
+
+    def getOrCompute(self, endpoint, query, version, compute):
+        # compute() returns (body, mimetype), body being str or bytes
+        key = self.makeKey(endpoint, query, version)
+        entry = self.get(key)
+        if entry is None:
+            body, mimetype = compute()
+            entry = self.put(key, body.encode('utf-8') if isinstance(body, str) else body, mimetype)
+
+        return entry
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.currentBytes,
+                'maxBytes': self.maxBytes
+            }
@@ -0,0 +1,120 @@
+import numpy as np
+
+from .spatialIndex import csr_gather
+
+# Topology of the river network, built once from the fromIndsStart/fromIndsEnd/fromIndices CSR arrays of the RouteLink file
+# the network is a forest, every link flows into at most one downstream link and the outlets are the roots
+# the links are labelled with their preorder interval [tin, tout) of a depth first traversal from the outlets,
+# the links upstream of a link (itself included) are then exactly the links with tin in its interval:
+# upstream membership is O(1), the upstream set is a contiguous slice of the preorder, O(k),
+# and aggregates over every basin at once are differences of prefix sums in preorder
+# all the links here are 0-based indices of the RouteLink file
+
+basinReducers = ['sum', 'mean', 'count']
+
+def reduce_links(values, reducer):
+    # reduce (link, ...) values over the links ignoring nan, nan where a basin has no values
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=0)
+    if reducer == 'count':
+        return counts.astype(np.float64)
+
+    sums = np.where(valid, values, 0).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts if reducer == 'mean' else sums, np.nan)
+
+class RiverTopology:
+    def __init__(self, fromIndsStart, fromIndsEnd, fromIndices):
+        # the netcdf files were written using 1-based indexes, shifted by '-1' here
+        fromIndsStart = np.asarray(fromIndsStart, dtype=np.int64)
+        self.numLinks = len(fromIndsStart)
+        self.upStarts = fromIndsStart - 1
+        self.upCounts = np.asarray(fromIndsEnd, dtype=np.int64) - fromIndsStart + 1
+        self.upCounts[fromIndsStart == 0] = 0
+        self.upLinks = np.asarray(fromIndices, dtype=np.int64) - 1
+
+        # downstream link of every link, -1 for the outlets
+        self.downstream = np.full(self.numLinks, -1, dtype=np.int64)
+        self.downstream[self.getUpLinks(np.arange(self.numLinks))] = np.repeat(np.arange(self.numLinks), self.upCounts)
+
+        self.buildLevels()
+        self.buildIntervals()
+
+    def getUpLinks(self, links):
+        # direct uplinks of the given links, concatenated in the order of the links
+        return self.upLinks[csr_gather(self.upStarts[links], self.upCounts[links])]
+
+    def buildLevels(self):
+        # breadth first from the outlets, the links at distance d from their outlet form level d
+        self.depth = np.full(self.numLinks, -1, dtype=np.int64)
+        self.levels = []
+        frontier = np.where(self.downstream == -1)[0]
+        while frontier.size:
+            self.depth[frontier] = len(self.levels)
+            self.levels.append(frontier)
+            frontier = self.getUpLinks(frontier)
+            if len(self.levels) > self.numLinks:
+                raise ValueError('the river network has a loop')
+
+        # outlets first, every link after its downstream link, reversed for an upstream first accumulation
+        self.topologicalOrder = np.concatenate(self.levels) if self.levels else np.zeros(0, dtype=np.int64)
+        if len(self.topologicalOrder) != self.numLinks:
+            raise ValueError('the river network has a loop, some links do not reach an outlet')
+
+    def buildIntervals(self):
+        # number of links in the basin of every link, accumulated from the deepest level down to the outlets
+        self.basinSize = np.ones(self.numLinks, dtype=np.int64)
+        for level in reversed(self.levels[1:]):
+            np.add.at(self.basinSize, self.downstream[level], self.basinSize[level])
+
+        # preorder position of every link, the outlets one after the other, and the uplinks of a link
+        # right after it, each one after the basins of its previous siblings
+        self.tin = np.empty(self.numLinks, dtype=np.int64)
+        outlets = self.levels[0]
+        self.tin[outlets] = np.cumsum(self.basinSize[outlets]) - self.basinSize[outlets]
+        for level in self.levels[:-1]:
+            parents = level[self.upCounts[level] > 0]
+            counts = self.upCounts[parents]
+            children = self.getUpLinks(parents)
+            precedingSizes = np.cumsum(self.basinSize[children]) - self.basinSize[children]
+            # restart the sum at the first uplink of every parent
+            precedingSizes -= np.repeat(precedingSizes[np.cumsum(counts) - counts], counts)
+            self.tin[children] = np.repeat(self.tin[parents] + 1, counts) + precedingSizes
+
+        self.tout = self.tin + self.basinSize
+        self.preorder = np.empty(self.numLinks, dtype=np.int64)
+        self.preorder[self.tin] = np.arange(self.numLinks)
+
+    def isUpstream(self, links, ofLink):
+        # whether the links are upstream of ofLink or ofLink itself, vectorized over links
+        return (self.tin[ofLink] <= self.tin[links]) & (self.tin[links] < self.tout[ofLink])
+
+    def upstreamLinks(self, link):
+        # the basin of the link in preorder, the link first
+        return self.preorder[self.tin[link]:self.tout[link]]
+
+    def downstreamLinks(self, link):
+        # the path from the link to its outlet, the link first, following the downstream pointers, O(path length)
+        path = np.empty(self.depth[link] + 1, dtype=np.int64)
+        for position in range(len(path)):
+            path[position] = link
+            link = self.downstream[link]
+        return path
+
+    def accumulate(self, values, reducer='sum'):
+        # reduce values given per link (link, ...) over the basin of every link at once, ignoring nan
+        values = np.asarray(values, dtype=np.float64)[self.preorder]
+        valid = ~np.isnan(values)
+
+        def prefixSums(x):
+            prefix = np.zeros((self.numLinks + 1,) + x.shape[1:])
+            np.cumsum(x, axis=0, out=prefix[1:])
+            return prefix[self.tout] - prefix[self.tin]
+
+        counts = prefixSums(valid.astype(np.float64))
+        if reducer == 'count':
+            return counts
+
+        sums = prefixSums(np.where(valid, values, 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, sums / counts if reducer == 'mean' else sums, np.nan)
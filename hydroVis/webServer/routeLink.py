@@ -2,6 +2,12 @@ import netCDF4 as nc
 import xarray as xr
 import numpy as np
 import os
+import json
+import gzip
+import hashlib
+
+from .spatialIndex import LinkGridIndex, csr_gather
+from .riverTopology import RiverTopology
 
 # descriptor attributes for links
 linkDescriptor = [
@@ -11,6 +17,12 @@ linkDescriptor = [
     'gauge' # enum: 0=no gauge, 1=assimilated gauge, 2=non-assimilated gauge
 ]
 
+# number of stream orders shown at the full extent of the domain, every zoom level (scale x2) adds one more
+lodOrdersAtFullExtent = 4
+
+# precomputed, gzip compressed json of the link geometry, served as is by /getRouteLinkData
+geometryArtifactPath = os.path.join('datacube', 'routeLinkGeometry.json.gz')
+
 # Class definition for parsing routeLink data
 # and creating xarray dataArray data structure from it
 
@@ -30,46 +42,148 @@ class RouteLinkData:
         # we only care about links which are themselves uplinks to some links
         # the linkID array indices for such links is in fromIndices
         self.linkIDCoords = self.fromIndices
+        # row of the linkID coordinate for each (0-based) link, -1 for links which are no uplinks
+        # the linkID coordinate stores the 1-based index to be consistent with the original netCDF files
+        self.rowOfLink = np.full(self.numLinks, -1, dtype=np.int64)
+        self.rowOfLink[np.asarray(self.fromIndices, dtype=np.int64) - 1] = np.arange(len(self.fromIndices))
+        # downstream pointers and basin intervals for the upstream/downstream queries and basin aggregates
+        self.topology = RiverTopology(self.fromIndsStart, self.fromIndsEnd, self.fromIndices)
         
         # read precomputed data cube or construct it here
         # constructing takes time
-        if not createXarrayFromScratch and os.path.exists(os.path.join('datacube', 'routeLinkData.nc')):
-            self.linkData = xr.open_dataarray(os.path.join('datacube', 'routeLinkData.nc'))
-            # TODO: Check additional options for reading netcdf files into xarray data array
+        if not createXarrayFromScratch and datacube.hasPersistedDataArray('routeLinkData'):
+            datacube.loadDataArray('routeLinkData')
+            # a copy is kept in memory with every datacube backend, it is needed for every map request
+            self.linkData = datacube.getDataArray('routeLinkData')
 
         else:
             self.linkData = xr.DataArray(
-                data=np.ndarray((len(self.linkIDCoords), len(linkDescriptor))),
+                data=self.buildLinkDescriptors(routeLinkData),
                 coords={'linkID': self.linkIDCoords, 'descriptor': linkDescriptor},
                 dims=['linkID', 'descriptor'],
                 name='routeLinkData'
             )
-        
-            for i in range(self.numLinks):
-                if self.numUpLinks[i] == 0:
-                    continue
-
-                linkIDArrayIndices = self.fromIndices[self.fromIndsStart[i] - 1: self.fromIndsEnd[i]] - 1
-                # it should have been
-                # linkIndices = self.rl.fromIndices[self.rl.fromIndsStart[i]: self.rl.fromIndsEnd[i]+1]
-                # but the netcdf files were written using 1-based indexes for fromIndsStart, fromIndsEnd and fromIndices
-                # therefore to make it work with python's netCDF library, we do a '-1' for each of the three array accesses
-                assert (self.numUpLinks[i] == len(linkIDArrayIndices))
-
-                for linkIDArrayIndex in linkIDArrayIndices:
-                    # to be consistent with the way the data was written in the original netCDF files (1-based index)
-                    # change from python netCDF library's 0-based index to 1-based index with a '+1'
-                    # only for storing the linkIDArrayIndex, not for accessing the lat and lon arrays
-                    self.linkData.loc[dict(linkID=linkIDArrayIndex+1, descriptor='lat')] = (self.lat[linkIDArrayIndex] + self.lat[i]) / 2
-                    self.linkData.loc[dict(linkID=linkIDArrayIndex+1, descriptor='lon')] = (self.lon[linkIDArrayIndex] + self.lon[i]) / 2
-                    self.linkData.loc[dict(linkID=linkIDArrayIndex+1, descriptor='srcLat')] = self.lat[linkIDArrayIndex]
-                    self.linkData.loc[dict(linkID=linkIDArrayIndex+1, descriptor='srcLon')] = self.lon[linkIDArrayIndex]
-                    self.linkData.loc[dict(linkID=linkIDArrayIndex+1, descriptor='dstLat')] = self.lat[i]
-                    self.linkData.loc[dict(linkID=linkIDArrayIndex+1, descriptor='dstLon')] = self.lon[i]
-                    self.linkData.loc[dict(linkID=linkIDArrayIndex+1, descriptor='gauge')] = 0
-                    # TODO: Update gauge descriptor as per gauge location data from routelink and obs_seq files
-
-        datacube.addDataArray('routeLinkData', self.linkData)
+
+            datacube.addDataArray('routeLinkData', self.linkData)
+
+        # stream order of every row of the linkID coordinate, used for the level of detail filtering of the map
+        self.streamOrder = None
+        self.warnedNoStreamOrder = False
+        if 'order' in routeLinkData.variables:
+            self.streamOrder = np.asarray(routeLinkData.variables['order'][:])[np.asarray(self.fromIndices, dtype=np.int64) - 1]
+        self.buildSpatialIndex()
+
+        if createXarrayFromScratch or not os.path.exists(geometryArtifactPath):
+            self.writeGeometryArtifact()
+        self.loadGeometryArtifact()
+
+    def buildLinkDescriptors(self, routeLinkData):
+        # descriptors of every link, gathered at once over the fromIndsStart/fromIndsEnd/fromIndices CSR arrays
+        # the netcdf files were written using 1-based indexes for fromIndsStart, fromIndsEnd and fromIndices,
+        # therefore the indexes are shifted by '-1' for array accesses
+        lat = np.asarray(self.lat, dtype=np.float64)
+        lon = np.asarray(self.lon, dtype=np.float64)
+        fromIndices = np.asarray(self.fromIndices, dtype=np.int64)
+
+        hasUpLinks = np.asarray(self.numUpLinks) > 0
+        counts = np.asarray(self.numUpLinks, dtype=np.int64)[hasUpLinks]
+        starts = np.asarray(self.fromIndsStart, dtype=np.int64)[hasUpLinks] - 1
+        # positions in fromIndices of the uplinks of every link: start of the link's range plus the offset within it
+        positions = csr_gather(starts, counts)
+        assert (positions < len(fromIndices)).all()
+
+        upLinks = fromIndices[positions] - 1
+        dstLinks = np.repeat(np.where(hasUpLinks)[0], counts)
+        rows = self.rowOfLink[upLinks]
+
+        data = np.full((len(self.linkIDCoords), len(linkDescriptor)), np.nan)
+        data[rows, linkDescriptor.index('lat')] = (lat[upLinks] + lat[dstLinks]) / 2
+        data[rows, linkDescriptor.index('lon')] = (lon[upLinks] + lon[dstLinks]) / 2
+        data[rows, linkDescriptor.index('srcLat')] = lat[upLinks]
+        data[rows, linkDescriptor.index('srcLon')] = lon[upLinks]
+        data[rows, linkDescriptor.index('dstLat')] = lat[dstLinks]
+        data[rows, linkDescriptor.index('dstLon')] = lon[dstLinks]
+
+        # links with a gauge listed in the routelink file are non-assimilated gauges,
+        # the gauges with observations are marked as assimilated by updateGaugeDescriptor
+        data[rows, linkDescriptor.index('gauge')] = 0
+        if 'gages' in routeLinkData.variables:
+            gages = np.char.strip(np.asarray(nc.chartostring(routeLinkData.variables['gages'][:]), dtype=str))
+            gaugedLinks = np.where(gages != '')[0]
+            gaugedRows = self.rowOfLink[gaugedLinks]
+            data[gaugedRows[gaugedRows >= 0], linkDescriptor.index('gauge')] = 2
+
+        return data
+
+    def buildSpatialIndex(self):
+        self.spatialIndex = LinkGridIndex(
+            self.linkData.sel(descriptor='srcLon').values, self.linkData.sel(descriptor='srcLat').values,
+            self.linkData.sel(descriptor='dstLon').values, self.linkData.sel(descriptor='dstLat').values
+        )
+
+    def getMinStreamOrder(self, zoom):
+        maxOrder = int(self.streamOrder.max())
+        return max(1, maxOrder - lodOrdersAtFullExtent - int(zoom) + 1)
+
+    def getVisibleRows(self, bbox=None, zoom=None):
+        # rows of the linkID coordinate visible in the viewport bbox {lonMin, latMin, lonMax, latMax}
+        # and with a stream order high enough for the zoom level, None if the whole domain is requested
+        if bbox is None and zoom is None:
+            return None
+
+        if bbox is not None:
+            rows = self.spatialIndex.query(bbox['lonMin'], bbox['latMin'], bbox['lonMax'], bbox['latMax'])
+        else:
+            rows = np.arange(len(self.linkIDCoords))
+
+        if zoom is not None and self.streamOrder is not None:
+            rows = rows[self.streamOrder[rows] >= self.getMinStreamOrder(zoom)]
+        elif zoom is not None and not self.warnedNoStreamOrder:
+            print("The RouteLink file has no 'order' variable, the zoom level of detail filtering is disabled")
+            self.warnedNoStreamOrder = True
+
+        return rows
+
+    def isValidLinkID(self, linkID):
+        # 1-based linkID of a link of the RouteLink file
+        return isinstance(linkID, (int, np.integer)) and not isinstance(linkID, bool) and 1 <= linkID <= self.numLinks
+
+    def getUpstreamLinkIDs(self, linkID, maxLinks=None):
+        # linkIDs of the link and every link upstream of it, nearest to linkID first,
+        # so that the links nearest to linkID are kept when the result is capped at maxLinks
+        links = self.topology.upstreamLinks(int(linkID) - 1)
+        links = links[np.argsort(self.topology.depth[links], kind='stable')]
+        # links which are no uplinks (the outlets) are not in the linkID coordinate
+        links = links[self.rowOfLink[links] >= 0]
+        return (links[:maxLinks] + 1).tolist()
+
+    def getDownstreamLinkIDs(self, linkID):
+        # linkIDs of the link and the links it flows through down to its outlet
+        links = self.topology.downstreamLinks(int(linkID) - 1)
+        links = links[self.rowOfLink[links] >= 0]
+        return (links + 1).tolist()
+
+    def accumulateOverBasins(self, values, reducer):
+        # values in the linkID coordinate order reduced over the basin of every link, in the same order
+        rowLinks = np.asarray(self.linkIDCoords, dtype=np.int64) - 1
+        linkValues = np.full((self.numLinks,) + values.shape[1:], np.nan)
+        linkValues[rowLinks] = values
+        return self.topology.accumulate(linkValues, reducer)[rowLinks]
+
+    def updateGaugeDescriptor(self, observedLinkIDs, datacube):
+        # mark the links with observation gauges as assimilated gauges
+        # the routeLinkData variable and the geometry artifact are only rewritten if a gauge changed
+        rows = self.linkData.indexes['linkID'].get_indexer(np.asarray(observedLinkIDs))
+        rows = rows[rows >= 0]
+        gauge = self.linkData.sel(descriptor='gauge').values
+        if (gauge[rows] == 1).all():
+            return
+
+        self.linkData = self.linkData.copy()
+        self.linkData.data[rows, linkDescriptor.index('gauge')] = 1
+        datacube.updateDataArray('routeLinkData', self.linkData)
+        self.writeGeometryArtifact()
+        self.loadGeometryArtifact()
 
     def getDataBoundingBoxLonLat(self):
         self.bbox = {
@@ -89,43 +203,45 @@ class RouteLinkData:
             'centroid': self.centroid
         }
 
-    def getRouteLinkData(self):
-        # construct json data structure to send to the front end
+    def getRouteLinkData(self, rows=None):
+        # construct json data structure to send to the front end, for all links or the given rows (see getVisibleRows)
+        # links are listed in the linkID coordinate order, 'index' is the position of the link in that order,
+        # which is also the order of the values in the binary /getMapData responses
+        rows = np.arange(len(self.linkIDCoords)) if rows is None else rows
+        linkIDs = self.linkData.coords['linkID'].values[rows].tolist()
+        columns = {descriptor: self.linkData.sel(descriptor=descriptor).values[rows].tolist() for descriptor in linkDescriptor}
+
         routeLinkData = [
             {
-                'linkID': lid.item(),
-                'lon': self.linkData.sel(linkID=lid, descriptor='lon').item(),
-                'lat': self.linkData.sel(linkID=lid, descriptor='lat').item(),
+                'linkID': lid,
+                'index': index,
+                'lon': lon,
+                'lat': lat,
                 'line': {
                     'type': 'LineString',
                     'coordinates': [
-                        self.linkData.sel(linkID=lid, descriptor=['srcLon', 'srcLat']).data.tolist(),
-                        self.linkData.sel(linkID=lid, descriptor=['dstLon', 'dstLat']).data.tolist(),
+                        [srcLon, srcLat],
+                        [dstLon, dstLat]
                     ]
                 },
-                'gauge': self.linkData.sel(linkID=lid, descriptor='gauge').item()
+                'gauge': gauge
             }
-            for lid in self.linkData.coords['linkID']
+            for index, lid, lon, lat, srcLon, srcLat, dstLon, dstLat, gauge in zip(
+                rows.tolist(), linkIDs, columns['lon'], columns['lat'], columns['srcLon'], columns['srcLat'], columns['dstLon'], columns['dstLat'], columns['gauge'])
         ]
-        
-        # for linkIDArrayIndex in self.linkData.coords['linkID']:
-        #     data = {}
-        #     data['linkID'] = linkIDArrayIndex.item()
-        #     data['lat'] = self.linkData.sel(linkID=linkIDArrayIndex, descriptor='lat').item()
-        #     data['lon'] = self.linkData.sel(linkID=linkIDArrayIndex, descriptor='lon').item()
-        #     # data['srcLat'] = self.linkData.sel(linkID=linkIDArrayIndex, descriptor='srcLat')
-        #     # data['srcLon'] = self.linkData.sel(linkID=linkIDArrayIndex, descriptor='srcLon')
-        #     # data['dstLat'] = self.linkData.sel(linkID=linkIDArrayIndex, descriptor='dstLat')
-        #     # data['dstLon'] = self.linkData.sel(linkID=linkIDArrayIndex, descriptor='dstLon')
-        #     data['line'] = {
-        #         'type': "LineString",
-        #         'coordinates': [
-        #             [self.linkData.sel(linkID=linkIDArrayIndex, descriptor='srcLon').item(), self.linkData.sel(linkID=linkIDArrayIndex, descriptor='srcLat').item()],
-        #             [self.linkData.sel(linkID=linkIDArrayIndex, descriptor='dstLon').item(), self.linkData.sel(linkID=linkIDArrayIndex, descriptor='dstLat').item()]
-        #         ]
-        #     }
-        #     data['gauge'] = self.linkData.sel(linkID=linkIDArrayIndex, descriptor='gauge').item()
-
-        #     routeLinkData.append(data)
-
-        return routeLinkData
\ No newline at end of file
+
+        return routeLinkData
+
+    def writeGeometryArtifact(self):
+        # the geometry does not change during a session, serialize and compress it once
+        if not os.path.exists('datacube'):
+            os.mkdir('datacube')
+
+        with open(f'{geometryArtifactPath}.tmp', 'wb') as artifactFile:
+            artifactFile.write(gzip.compress(json.dumps(self.getRouteLinkData()).encode('utf-8'), compresslevel=6))
+        os.replace(f'{geometryArtifactPath}.tmp', geometryArtifactPath)
+
+    def loadGeometryArtifact(self):
+        with open(geometryArtifactPath, 'rb') as artifactFile:
+            self.geometryArtifact = artifactFile.read()
+        self.geometryETag = hashlib.sha1(self.geometryArtifact).hexdigest()
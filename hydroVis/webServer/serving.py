@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+
+# Production serving of the hydroVis routes
+# 'development': the Flask development server, single process
+# 'waitress': a multithreaded WSGI server, single process, pip install waitress
+# 'gunicorn': pre-forked worker processes with threads, pip install gunicorn
+# the gunicorn workers are forked after the datacube is built, so they share its memory copy on write
+# (or the page cache of the chunked files with --cubeBackend chunked) instead of each building a copy
+
+class ReadPool:
+    # bounded pool of threads running the blocking datacube and netcdf reads
+    # the request threads only wait for the result, so at most maxReads reads compete for the CPU and the HDF5 lock
+    def __init__(self, maxReads=4):
+        self.maxReads = maxReads
+        self.executor = ThreadPoolExecutor(max_workers=maxReads, thread_name_prefix='datacubeRead')
+
+    def run(self, compute, *args):
+        return self.executor.submit(compute, *args).result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+def serveDevelopment(app, host, port):
+    app.run(host=host, port=port, debug=True, use_evalex=False, use_reloader=False)
+
+def serveWaitress(app, host, port, threads):
+    try:
+        import waitress
+    except ImportError:
+        raise ImportError("--server waitress requires the waitress package: pip install waitress")
+
+    waitress.serve(app, host=host, port=port, threads=threads)
+
+def serveGunicorn(app, host, port, workers, threads, postFork=None):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ImportError("--server gunicorn requires the gunicorn package: pip install gunicorn")
+
+    class HydroVisApplication(BaseApplication):
+        # serves the already built app, the workers are forked from this process
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            # datacube reads of long time ranges may take a while
+            self.cfg.set('timeout', 120)
+            # the open netcdf/HDF5 handles can not be shared with the forked workers, each one reopens its own
+            if postFork is not None:
+                self.cfg.set('post_fork', lambda server, worker: postFork())
+
+        def load(self):
+            return app
+
+    HydroVisApplication().run()
+
+def serve(app, server, host, port, workers=1, threads=8, postFork=None):
+    # postFork is run in every forked worker process
+    if server == 'waitress':
+        serveWaitress(app, host, port, threads)
+    elif server == 'gunicorn':
+        serveGunicorn(app, host, port, workers, threads, postFork)
+    else:
+        serveDevelopment(app, host, port)
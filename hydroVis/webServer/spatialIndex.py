@@ -0,0 +1,67 @@
+import numpy as np
+
+# Uniform grid spatial index over the link segments
+# every segment is registered in all grid cells its bounding box overlaps,
+# the cells are stored as CSR arrays (cellStarts, cellMembers) so that queries are plain numpy gathers
+
+# average number of segments per grid cell
+segmentsPerCell = 16
+
+def csr_gather(starts, counts):
+    # positions of all the entries of the given CSR ranges, concatenated
+    counts = np.asarray(counts, dtype=np.int64)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+class LinkGridIndex:
+    def __init__(self, srcLon, srcLat, dstLon, dstLat):
+        # segment bounding boxes, one row per link
+        self.lonMin = np.fmin(srcLon, dstLon)
+        self.lonMax = np.fmax(srcLon, dstLon)
+        self.latMin = np.fmin(srcLat, dstLat)
+        self.latMax = np.fmax(srcLat, dstLat)
+        self.numLinks = len(self.lonMin)
+
+        valid = ~(np.isnan(self.lonMin) | np.isnan(self.latMin))
+        self.extent = (np.nanmin(self.lonMin), np.nanmin(self.latMin), np.nanmax(self.lonMax), np.nanmax(self.latMax))
+        self.numCells = max(int(np.ceil(np.sqrt(valid.sum() / segmentsPerCell))), 1)
+        self.cellWidth = max(self.extent[2] - self.extent[0], 1e-9) / self.numCells
+        self.cellHeight = max(self.extent[3] - self.extent[1], 1e-9) / self.numCells
+
+        rows = np.where(valid)[0]
+        x0, y0 = self.cellOf(self.lonMin[rows], self.latMin[rows])
+        x1, y1 = self.cellOf(self.lonMax[rows], self.latMax[rows])
+
+        # expand every segment to all the cells of its bounding box, most segments are within a single cell
+        width = x1 - x0 + 1
+        cellsPerRow = width * (y1 - y0 + 1)
+        offsets = csr_gather(np.zeros(len(rows), dtype=np.int64), cellsPerRow)
+        members = np.repeat(rows, cellsPerRow)
+        cellX = np.repeat(x0, cellsPerRow) + offsets % np.repeat(width, cellsPerRow)
+        cellY = np.repeat(y0, cellsPerRow) + offsets // np.repeat(width, cellsPerRow)
+        cellIDs = cellY * self.numCells + cellX
+
+        order = np.argsort(cellIDs, kind='stable')
+        self.cellMembers = members[order]
+        self.cellStarts = np.concatenate([[0], np.cumsum(np.bincount(cellIDs, minlength=self.numCells * self.numCells))])
+
+    def cellOf(self, lon, lat):
+        x = np.clip(((lon - self.extent[0]) / self.cellWidth).astype(np.int64), 0, self.numCells - 1)
+        y = np.clip(((lat - self.extent[1]) / self.cellHeight).astype(np.int64), 0, self.numCells - 1)
+        return x, y
+
+    def query(self, lonMin, latMin, lonMax, latMax):
+        # sorted rows of the links whose segment bounding box intersects the given bounding box
+        if lonMin <= self.extent[0] and latMin <= self.extent[1] and lonMax >= self.extent[2] and latMax >= self.extent[3]:
+            return np.where(~np.isnan(self.lonMin))[0]
+        if lonMin > self.extent[2] or latMin > self.extent[3] or lonMax < self.extent[0] or latMax < self.extent[1]:
+            return np.array([], dtype=np.int64)
+
+        x0, y0 = self.cellOf(np.array([lonMin]), np.array([latMin]))
+        x1, y1 = self.cellOf(np.array([lonMax]), np.array([latMax]))
+        cellX, cellY = np.meshgrid(np.arange(x0[0], x1[0] + 1), np.arange(y0[0], y1[0] + 1))
+        cellIDs = (cellY * self.numCells + cellX).ravel()
+
+        candidates = np.unique(self.cellMembers[csr_gather(self.cellStarts[cellIDs], self.cellStarts[cellIDs + 1] - self.cellStarts[cellIDs])])
+        inside = (self.lonMax[candidates] >= lonMin) & (self.lonMin[candidates] <= lonMax) & \
+                 (self.latMax[candidates] >= latMin) & (self.latMin[candidates] <= latMax)
+        return candidates[inside]
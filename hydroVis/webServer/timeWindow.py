@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Time window paging of the map data for long experiments
+# the timestamps are split in windows of windowCycles cycles, when the map of a timestamp is requested
+# the same selection is read ahead for the adjacent windows in the background, so that scrubbing the timeline
+# finds the values in the chunk cache, and the map chunks of windows far from every window in use
+# are evicted once the chunk cache fills beyond evictionThreshold of its budget
+# only the chunked datacube backend pages, the memory backend holds every cycle
+# hydrographs are not paged, they read full length series from the link major layout
+
+evictionThreshold = 0.8
+
+class TimeWindowPager:
+    def __init__(self, datacube, timestamps, windowCycles, prefetchWindows=1):
+        self.datacube = datacube
+        # shared with the assimilation data, extended when new cycles are appended
+        self.timestamps = timestamps
+        self.windowCycles = windowCycles
+        self.prefetchWindows = prefetchWindows
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='windowPrefetch')
+        self.lock = threading.Lock()
+        # (varName, selection, window) read into the chunk cache or queued
+        self.requested = set()
+        # window -> number of requests, the windows in use are the ones touched since the last eviction
+        self.windowsInUse = {}
+
+    def windowOf(self, timestamp):
+        return self.timestamps.index(timestamp) // self.windowCycles
+
+    def windowTimestamps(self, window):
+        return self.timestamps[window * self.windowCycles:(window + 1) * self.windowCycles]
+
+    def touch(self, timestamp, selections):
+        # selections: (varName, indexers) of the map request, without the time indexer
+        if self.datacube.store is None or timestamp not in self.timestamps:
+            return
+
+        window = self.windowOf(timestamp)
+        numWindows = (len(self.timestamps) + self.windowCycles - 1) // self.windowCycles
+        with self.lock:
+            self.windowsInUse[window] = self.windowsInUse.get(window, 0) + 1
+            for neighbour in range(max(window - self.prefetchWindows, 0), min(window + self.prefetchWindows + 1, numWindows)):
+                for varName, indexers in selections:
+                    key = (varName, tuple(sorted((dim, str(label)) for dim, label in indexers.items())), neighbour)
+                    if key in self.requested:
+                        continue
+                    self.requested.add(key)
+                    self.executor.submit(self.prefetch, varName, indexers, neighbour)
+
+        self.evictFarWindows()
+
+    def prefetch(self, varName, indexers, window):
+        try:
+            self.datacube.prefetch(varName, time=self.windowTimestamps(window), **indexers)
+        except Exception as e:
+            print(f'Failed to prefetch window {window} of {varName}:', e)
+
+    def evictFarWindows(self):
+        cache = self.datacube.store.cache
+        if cache.currentBytes <= evictionThreshold * cache.maxBytes:
+            return
+
+        with self.lock:
+            keptWindows = set()
+            for window in self.windowsInUse:
+                keptWindows.update(range(window - self.prefetchWindows, window + self.prefetchWindows + 1))
+            # the windows touched from now on are the ones in use for the next eviction
+            self.windowsInUse = {}
+
+            evictedWindows = set(window for _, _, window in self.requested) - keptWindows
+            self.requested = set(key for key in self.requested if key[2] in keptWindows)
+
+        for window in evictedWindows:
+            timeStart = window * self.windowCycles
+            self.datacube.evictTimeRange(timeStart, timeStart + self.windowCycles)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,189 @@
+import warnings
+import numpy as np
+import xarray as xr
+
+from .assimilationData import to_json_values
+
+# Ensemble verification of the streamflow against the gauge observations
+# per gauge and cycle statistics of the preassim, analysis and openloop ensembles are computed once,
+# vectorized over all the gauges, and stored in the datacube as verification_stats;
+# the summaries over time (RMSE, bias, spread, CRPS, rank histograms) are reduced from them per request
+
+verificationStateVariable = 'qlink1'
+verificationDaPhases = ['preassim', 'analysis', 'openloop']
+# ensemble mean minus observation, ensemble spread, CRPS and rank of the observation among the members
+cycleStatistics = ['error', 'spread', 'crps', 'rank']
+summaryStatistics = ['rmse', 'bias', 'spread', 'crps', 'spreadSkill', 'count']
+
+# cycles verified at a time while building, bounds the size of the member block
+buildTimeBlock = 256
+
+def compute_verification(observations, members):
+    # observations (gauge, time), members (gauge, time, daPhase, member)
+    # returns the cycleStatistics as (gauge, time, daPhase, statistic)
+    numMembers = members.shape[-1]
+    observations = observations[:, :, np.newaxis]
+
+    with np.errstate(invalid='ignore'):
+        mean = members.mean(axis=-1)
+        spread = members.std(axis=-1, ddof=1) if numMembers > 1 else np.zeros(mean.shape)
+        error = mean - observations
+
+        # ensemble CRPS: mean |x_i - o| - 1/2 mean |x_i - x_j|, the latter in O(N log N) from the sorted members
+        meanAbsError = np.abs(members - observations[..., np.newaxis]).mean(axis=-1)
+        weights = 2 * np.arange(1, numMembers + 1) - numMembers - 1
+        meanAbsDifference = 2 * (np.sort(members, axis=-1) * weights).sum(axis=-1) / numMembers ** 2
+        crps = meanAbsError - 0.5 * meanAbsDifference
+
+        # number of members below the observation, 0..N
+        rank = (members < observations[..., np.newaxis]).sum(axis=-1).astype(np.float64)
+        rank[np.isnan(error)] = np.nan
+
+    return np.stack([error, spread, crps, rank], axis=-1)
+
+def summarize_verification(stats, numMembers):
+    # reduce the cycle statistics (gauge, time, daPhase, statistic) over time
+    # returns the summaryStatistics as {name: (gauge, daPhase)} and the rank histograms as (gauge, daPhase, numMembers+1)
+    error, spread, crps, rank = [stats[..., cycleStatistics.index(name)] for name in cycleStatistics]
+
+    with warnings.catch_warnings():
+        # gauges without any observation in the time range are nan
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        summary = {
+            'rmse': np.sqrt(np.nanmean(error ** 2, axis=1)),
+            'bias': np.nanmean(error, axis=1),
+            'spread': np.sqrt(np.nanmean(spread ** 2, axis=1)),
+            'crps': np.nanmean(crps, axis=1),
+            'count': np.sum(~np.isnan(error), axis=1).astype(np.float64)
+        }
+        # about 1 for a well dispersed ensemble, below 1 if it is underdispersive
+        summary['spreadSkill'] = summary['spread'] / summary['rmse']
+
+    numGauges, _, numDaPhases = rank.shape
+    gaugeDaPhase = np.arange(numGauges * numDaPhases).reshape(numGauges, 1, numDaPhases) * (numMembers + 1)
+    valid = ~np.isnan(rank)
+    bins = (np.broadcast_to(gaugeDaPhase, rank.shape)[valid] + rank[valid]).astype(np.int64)
+    rankHistograms = np.bincount(bins, minlength=numGauges * numDaPhases * (numMembers + 1)).reshape(numGauges, numDaPhases, numMembers + 1)
+
+    return summary, rankHistograms
+
+class VerificationData:
+    def __init__(self, ensemble, observations, datacube, createXarrayFromScratch):
+        self.ensemble = ensemble
+        self.observations = observations
+        self.numEnsembleModels = ensemble.numEnsembleModels
+        self.memberLabels = [str(member) for member in range(1, self.numEnsembleModels + 1)]
+        self.available = verificationStateVariable in ensemble.stateVariables
+
+        if not self.available:
+            return
+
+        if not createXarrayFromScratch and datacube.hasPersistedDataArray('verification_stats'):
+            datacube.loadDataArray('verification_stats')
+        else:
+            datacube.updateDataArray('verification_stats', self.buildDataArray(datacube))
+
+    def verifiedGauges(self, observationArray, stateLinkIDs):
+        return np.intersect1d(observationArray.coords['linkID'].values, np.asarray(stateLinkIDs))
+
+    def computeDataArray(self, observationArray, selectMembers, gauges, timestamps):
+        # selectMembers(timestamps) returns the member values of the gauges as (linkID, time, daPhase, aggregation)
+        stats = np.full((len(gauges), len(timestamps), len(verificationDaPhases), len(cycleStatistics)), np.nan)
+        observationValues = observationArray.sel(linkID=gauges).reindex(time=list(timestamps)).values
+        for start in range(0, len(timestamps), buildTimeBlock):
+            blockTimestamps = list(timestamps[start:start + buildTimeBlock])
+            members = selectMembers(blockTimestamps).transpose('linkID', 'time', 'daPhase', 'aggregation').values
+            stats[:, start:start + len(blockTimestamps)] = compute_verification(observationValues[:, start:start + len(blockTimestamps)], members)
+
+        return xr.DataArray(
+            data=stats,
+            coords={'linkID': gauges, 'time': list(timestamps), 'daPhase': verificationDaPhases, 'statistic': cycleStatistics},
+            dims=['linkID', 'time', 'daPhase', 'statistic'],
+            name='verification_stats'
+        )
+
+    def buildDataArray(self, datacube):
+        # the whole cube, read a block of cycles at a time
+        dataArrayKey = f'{verificationStateVariable}_data'
+        gauges = self.verifiedGauges(datacube.getDataArray('observation_gauge_data'), datacube.coords(dataArrayKey, 'linkID'))
+        selectMembers = lambda timestamps: datacube.select(dataArrayKey, linkID=gauges, time=timestamps, daPhase=verificationDaPhases, aggregation=self.memberLabels)
+        return self.computeDataArray(datacube.getDataArray('observation_gauge_data'), selectMembers, gauges, list(self.ensemble.timestamps))
+
+    def buildAppendDataArrays(self, dataArrays, timestamps):
+        # statistics of newly appended cycles, from the datacube arrays of those cycles (see CubeWatcher)
+        if not self.available:
+            return {}
+
+        dataArray = dataArrays[f'{verificationStateVariable}_data']
+        gauges = self.verifiedGauges(dataArrays['observation_gauge_data'], dataArray.coords['linkID'].values)
+        selectMembers = lambda blockTimestamps: dataArray.sel(linkID=gauges, time=blockTimestamps, daPhase=verificationDaPhases, aggregation=self.memberLabels)
+        return {'verification_stats': self.computeDataArray(dataArrays['observation_gauge_data'], selectMembers, gauges, timestamps)}
+
+    def checkQuery(self, daStage, statistic=None, timestamp=None, linkID=None, datacube=None):
+        # error message for a query the verification endpoints can not answer, None if it is valid
+        # with a timestamp the cycle statistics are mapped, else the summary statistics over the cycles
+        if daStage not in verificationDaPhases:
+            return f'expected daStage in {verificationDaPhases}'
+        statistics = cycleStatistics if timestamp is not None else summaryStatistics
+        if statistic is not None and statistic not in statistics:
+            return f'expected statistic in {statistics}'
+        if timestamp is not None and timestamp not in self.ensemble.timestamps:
+            return f'no cycle {timestamp}'
+        if linkID is not None and linkID not in datacube.coords('verification_stats', 'linkID'):
+            return f'no verified gauge {linkID}'
+        return None
+
+    def getSummary(self, datacube, timeRange=None):
+        # (gauges, summary, rank histograms) over the cycles in the inclusive timeRange [start, end], all cycles without
+        stats = datacube.getDataArray('verification_stats')
+        if timeRange is not None:
+            timestamps = [str(timestamp) for timestamp in stats.coords['time'].values]
+            stats = stats.isel(time=[i for i, timestamp in enumerate(timestamps) if timeRange[0] <= timestamp <= timeRange[1]])
+
+        summary, rankHistograms = summarize_verification(stats.transpose('linkID', 'time', 'daPhase', 'statistic').values, self.numEnsembleModels)
+        return stats.coords['linkID'].values, summary, rankHistograms
+
+    def getGaugeLocations(self, gauges):
+        locations = self.observations.observation_gauge_locations.sel(linkID=gauges, location=['lon', 'lat']).values
+        return locations.tolist()
+
+    def getVerificationMapData(self, datacube, statistic, daStage, timestamp=None, timeRange=None):
+        # one value per gauge: a summary statistic over the cycles, or with timestamp a cycle statistic of that cycle
+        daPhaseIndex = verificationDaPhases.index(daStage)
+        if timestamp is not None:
+            stats = datacube.select('verification_stats', time=timestamp, daPhase=daStage, statistic=statistic)
+            gauges, values = stats.coords['linkID'].values, stats.values
+        else:
+            gauges, summary, _ = self.getSummary(datacube, timeRange)
+            values = summary[statistic][:, daPhaseIndex]
+
+        return [
+            {'gaugeID': gaugeID, 'location': location, 'value': value}
+            for gaugeID, location, value in zip(gauges.tolist(), self.getGaugeLocations(gauges), to_json_values(values))
+        ]
+
+    def getVerificationTableData(self, datacube, daStage, sortBy='rmse', descending=True, limit=None, timeRange=None):
+        # summary statistics of every gauge, columnar and sorted by one of them, gauges without observations last
+        daPhaseIndex = verificationDaPhases.index(daStage)
+        gauges, summary, _ = self.getSummary(datacube, timeRange)
+
+        sortValues = summary[sortBy][:, daPhaseIndex]
+        order = np.argsort(-sortValues if descending else sortValues, kind='stable')
+        order = order[:limit] if limit else order
+
+        table = {'gaugeID': gauges[order].tolist()}
+        for name in summaryStatistics:
+            table[name] = to_json_values(summary[name][order, daPhaseIndex])
+
+        return {'daStage': daStage, 'sortBy': sortBy, 'descending': descending, 'columns': table}
+
+    def getRankHistogramData(self, datacube, daStage, linkID=None, timeRange=None):
+        # counts of the observation ranks 0..N among the members, of one gauge or summed over all gauges
+        daPhaseIndex = verificationDaPhases.index(daStage)
+        gauges, _, rankHistograms = self.getSummary(datacube, timeRange)
+        if linkID is None:
+            counts = rankHistograms[:, daPhaseIndex].sum(axis=0)
+        else:
+            counts = rankHistograms[list(gauges).index(linkID), daPhaseIndex]
+
+        return {'daStage': daStage, 'gaugeID': linkID, 'counts': counts.tolist()}
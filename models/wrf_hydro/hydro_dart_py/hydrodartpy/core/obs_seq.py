@@ -0,0 +1,373 @@
+import collections
+import datetime
+import pathlib
+import struct
+import typing
+
+import numpy as np
+
+# Reader for DART obs_sequence files, ASCII (formatted) and binary (unformatted
+# Fortran sequential). The observations are streamed in chunks of columnar
+# numpy arrays, see obs_seq_write in obs_sequence_mod.f90 for the layout.
+# This module only depends on numpy so it can be used without the rest of
+# hydrodartpy, e.g. by hydroVis.
+
+# DART times are days and seconds since this date.
+dart_epoch = np.datetime64('1601-01-01T00:00:00', 's')
+
+# Largest number of type specific metadata records searched for after the
+# kind of an observation in a binary file.
+max_metadata_records = 16
+
+
+class ObsSeqHeader(typing.NamedTuple):
+    format: str  # 'ascii' or 'binary'
+    type_definitions: dict  # type index: type name
+    copy_names: list
+    qc_names: list
+    num_obs: int
+    max_num_obs: int
+    first: int
+    last: int
+
+
+def dart_time_to_datetime64(seconds, days):
+    return dart_epoch + (np.asarray(days, dtype='int64') * 86400 +
+                         np.asarray(seconds, dtype='int64')).astype('timedelta64[s]')
+
+
+def to_datetime64(time):
+    if isinstance(time, datetime.datetime):
+        return np.datetime64(time.replace(tzinfo=None), 's')
+    return np.datetime64(time, 's')
+
+
+def detect_format(path: pathlib.Path) -> str:
+    # binary files start with a Fortran record marker followed by a label
+    with open(path, 'rb') as opened_file:
+        head = opened_file.read(8)
+    if len(head) == 8 and head[4:8] == b'obs_':
+        return 'binary'
+    return 'ascii'
+
+
+# ASCII -----------------------------------------------------------------------
+
+def _fortran_float(token: str) -> float:
+    # list directed Fortran output may use D exponents
+    return float(token.replace('D', 'E').replace('d', 'e'))
+
+
+def _read_ascii_header(opened_file) -> ObsSeqHeader:
+    line = opened_file.readline().strip()
+    if line == 'obs_sequence':
+        line = opened_file.readline().strip()
+
+    type_definitions = {}
+    if line in ['obs_kind_definitions', 'obs_type_definitions']:
+        num_types = int(opened_file.readline().split()[0])
+        for _ in range(num_types):
+            tokens = opened_file.readline().split()
+            type_definitions[int(tokens[0])] = tokens[1]
+        line = opened_file.readline()
+
+    # ' num_copies: C num_qc: Q'
+    tokens = line.split()
+    num_copies, num_qc = int(tokens[1]), int(tokens[3])
+    tokens = opened_file.readline().split()
+    num_obs, max_num_obs = int(tokens[1]), int(tokens[3])
+
+    copy_names = [opened_file.readline().strip() for _ in range(num_copies)]
+    qc_names = [opened_file.readline().strip() for _ in range(num_qc)]
+
+    tokens = opened_file.readline().split()
+    first, last = int(tokens[1]), int(tokens[3])
+
+    return ObsSeqHeader(
+        'ascii', type_definitions, copy_names, qc_names,
+        num_obs, max_num_obs, first, last)
+
+
+def _iter_ascii_records(opened_file, header: ObsSeqHeader):
+    # one observation per yield, as a tuple of the parsed fields
+    num_copies = len(header.copy_names)
+    num_qc = len(header.qc_names)
+
+    line = opened_file.readline()
+    while line and not line.split()[:1] == ['OBS']:
+        line = opened_file.readline()
+
+    while line:
+        key = int(line.split()[1])
+        lines = []
+        line = opened_file.readline()
+        while line and not line.split()[:1] == ['OBS']:
+            if line.strip():
+                lines.append(line.strip())
+            line = opened_file.readline()
+
+        values = [_fortran_float(lines[ii]) for ii in range(num_copies)]
+        qc = [_fortran_float(lines[num_copies + ii]) for ii in range(num_qc)]
+        # lines[num_copies + num_qc]: prev, next, cov_group; then 'obdef'
+        position = num_copies + num_qc + 2
+        location_type = lines[position]
+        location = [_fortran_float(token) for token in lines[position + 1].split()]
+        # 'kind', kind, optional type specific metadata, time, error variance
+        kind = int(lines[position + 3].split()[0])
+        seconds, days = [int(token) for token in lines[-2].split()[:2]]
+        error_variance = _fortran_float(lines[-1])
+
+        yield key, values, qc, location_type, location, kind, seconds, days, error_variance
+
+
+# Binary ----------------------------------------------------------------------
+
+class _FortranRecords:
+    # sequential access to the records of an unformatted Fortran file
+    # with 4 byte record markers, supports looking ahead
+    def __init__(self, opened_file):
+        self.opened_file = opened_file
+        marker = opened_file.read(4)
+        # the first record is a label of a few characters, which tells the byte order
+        self.endian = '<' if struct.unpack('<i', marker)[0] < 1024 else '>'
+        opened_file.seek(0)
+        self.buffer = collections.deque()
+
+    def _read(self):
+        marker = self.opened_file.read(4)
+        if len(marker) < 4:
+            return None
+        length = struct.unpack(self.endian + 'i', marker)[0]
+        record = self.opened_file.read(length)
+        self.opened_file.read(4)
+        return record
+
+    def peek(self, offset: int):
+        while len(self.buffer) <= offset:
+            record = self._read()
+            if record is None:
+                return None
+            self.buffer.append(record)
+        return self.buffer[offset]
+
+    def next(self):
+        if self.buffer:
+            return self.buffer.popleft()
+        return self._read()
+
+    def ints(self, record):
+        return struct.unpack(f'{self.endian}{len(record) // 4}i', record)
+
+    def reals(self, record):
+        # r8 is usually real(8), DART can be built with r8 = real(4)
+        size = 8 if len(record) % 8 == 0 else 4
+        code = 'd' if size == 8 else 'f'
+        return struct.unpack(f'{self.endian}{len(record) // size}{code}', record)
+
+
+def _read_binary_header(records: _FortranRecords) -> ObsSeqHeader:
+    record = records.next()
+    if record.strip() == b'obs_sequence':
+        record = records.next()
+
+    type_definitions = {}
+    if record.strip() in [b'obs_kind_definitions', b'obs_type_definitions']:
+        num_types = records.ints(records.next())[0]
+        for _ in range(num_types):
+            record = records.next()
+            type_definitions[records.ints(record[:4])[0]] = record[4:].decode('ascii', 'replace').strip()
+        record = records.next()
+
+    num_copies, num_qc, num_obs, max_num_obs = records.ints(record)[:4]
+    copy_names = [records.next().decode('ascii', 'replace').strip() for _ in range(num_copies)]
+    qc_names = [records.next().decode('ascii', 'replace').strip() for _ in range(num_qc)]
+    first, last = records.ints(records.next())[:2]
+
+    return ObsSeqHeader(
+        'binary', type_definitions, copy_names, qc_names,
+        num_obs, max_num_obs, first, last)
+
+
+def _count_metadata_records(records: _FortranRecords, num_copies: int, num_qc: int, value_size: int) -> int:
+    # the records after the kind are: type specific metadata, time (2 ints),
+    # error variance, then the values, qc and links of the next observation
+    # or the end of the file. Find the number of metadata records for which
+    # the following records have the expected sizes.
+    for num_metadata in range(max_metadata_records + 1):
+        time_record = records.peek(num_metadata)
+        variance_record = records.peek(num_metadata + 1)
+        if time_record is None or variance_record is None:
+            break
+        if len(time_record) != 8 or len(variance_record) != value_size:
+            continue
+
+        next_start = num_metadata + 2
+        if records.peek(next_start) is None:
+            return num_metadata
+        following = [records.peek(next_start + ii) for ii in range(num_copies + num_qc + 1)]
+        if any(record is None for record in following):
+            continue
+        if all(len(record) == value_size for record in following[:-1]) and len(following[-1]) == 12:
+            return num_metadata
+
+    raise ValueError('Can not find the end of an observation in the binary obs_seq file.')
+
+
+def _iter_binary_records(records: _FortranRecords, header: ObsSeqHeader):
+    num_copies = len(header.copy_names)
+    num_qc = len(header.qc_names)
+    # number of metadata records per kind, assumed fixed for each kind
+    metadata_records = {}
+
+    for key in range(1, header.num_obs + 1):
+        first_value = records.peek(0)
+        if first_value is None:
+            break
+        value_size = len(first_value)
+
+        values = [records.reals(records.next())[0] for _ in range(num_copies)]
+        qc = [records.reals(records.next())[0] for _ in range(num_qc)]
+        records.next()  # prev, next, cov_group
+        location_record = records.next()
+        kind = records.ints(records.next())[0]
+
+        if kind not in metadata_records:
+            metadata_records[kind] = _count_metadata_records(records, num_copies, num_qc, value_size)
+        for _ in range(metadata_records[kind]):
+            records.next()
+
+        seconds, days = records.ints(records.next())[:2]
+        error_variance = records.reals(records.next())[0]
+
+        # loc3d: lon, lat, vertical (r8) and which_vert (int)
+        num_reals = (len(location_record) - 4) // value_size
+        if num_reals * value_size + 4 == len(location_record):
+            location = list(records.reals(location_record[:num_reals * value_size])) + \
+                [records.ints(location_record[num_reals * value_size:])[0]]
+            location_type = f'loc{num_reals}d'
+        else:
+            location = list(records.reals(location_record))
+            location_type = f'loc{len(location)}d'
+
+        yield key, values, qc, location_type, location, kind, seconds, days, error_variance
+
+
+# Columnar interface ----------------------------------------------------------
+
+def _to_columns(rows: list, header: ObsSeqHeader) -> dict:
+    keys, values, qc, location_types, locations, kinds, seconds, days, error_variances = zip(*rows)
+    num_location = max(len(location) for location in locations)
+    location_array = np.full((len(rows), num_location), np.nan)
+    for ii, location in enumerate(locations):
+        location_array[ii, :len(location)] = location
+
+    columns = {
+        'key': np.array(keys, dtype='int64'),
+        'values': np.array(values, dtype='float64').reshape(len(rows), len(header.copy_names)),
+        'qc': np.array(qc, dtype='float64').reshape(len(rows), len(header.qc_names)),
+        'kind': np.array(kinds, dtype='int64'),
+        'time': dart_time_to_datetime64(seconds, days),
+        'error_variance': np.array(error_variances, dtype='float64'),
+    }
+
+    # loc3d locations are stored in radians, return degrees like obs_seq_to_netcdf
+    if location_types[0] == 'loc3d' and num_location >= 4:
+        columns['location'] = np.stack([
+            np.degrees(location_array[:, 0]),
+            np.degrees(location_array[:, 1]),
+            location_array[:, 2]], axis=1)
+        columns['which_vert'] = location_array[:, 3].astype('int64')
+    else:
+        columns['location'] = location_array
+
+    return columns
+
+
+def _select(columns: dict, time_window, kinds) -> dict:
+    mask = np.ones(len(columns['key']), dtype=bool)
+    if time_window is not None:
+        start, end = time_window
+        if start is not None:
+            mask &= columns['time'] >= to_datetime64(start)
+        if end is not None:
+            mask &= columns['time'] <= to_datetime64(end)
+    if kinds is not None:
+        mask &= np.isin(columns['kind'], list(kinds))
+    if mask.all():
+        return columns
+    return {name: column[mask] for name, column in columns.items()}
+
+
+def _kind_indexes(kinds, header: ObsSeqHeader):
+    # kinds may be given as type indexes or type names
+    if kinds is None:
+        return None
+    name_to_index = {name: index for index, name in header.type_definitions.items()}
+    return [name_to_index[kind] if isinstance(kind, str) else int(kind) for kind in kinds]
+
+
+def read_obs_seq_header(path: typing.Union[str, pathlib.Path]) -> ObsSeqHeader:
+    path = pathlib.Path(path)
+    if detect_format(path) == 'binary':
+        with open(path, 'rb') as opened_file:
+            return _read_binary_header(_FortranRecords(opened_file))
+    with open(path, 'r') as opened_file:
+        return _read_ascii_header(opened_file)
+
+
+def iter_obs_seq(
+    path: typing.Union[str, pathlib.Path],
+    time_window: tuple = None,
+    kinds: list = None,
+    chunk_size: int = 100000
+):
+    """Stream the observations of an obs_seq file in chunks.
+
+    Yields (header, columns) where columns is a dict of numpy arrays with one
+    row per observation: key, values (obs x copies), qc (obs x qc), kind,
+    time (datetime64), error_variance, location (degrees for loc3d) and,
+    for loc3d, which_vert. Only the observations within the inclusive
+    time_window (start, end) and of the given kinds (indexes or names; the
+    negative identity kinds are given as indexes) are returned. At most
+    chunk_size observations are held in memory before filtering.
+    """
+    path = pathlib.Path(path)
+    file_format = detect_format(path)
+    with open(path, 'rb' if file_format == 'binary' else 'r') as opened_file:
+        if file_format == 'binary':
+            records = _FortranRecords(opened_file)
+            header = _read_binary_header(records)
+            observations = _iter_binary_records(records, header)
+        else:
+            header = _read_ascii_header(opened_file)
+            observations = _iter_ascii_records(opened_file, header)
+
+        kind_indexes = _kind_indexes(kinds, header)
+        rows = []
+        for observation in observations:
+            rows.append(observation)
+            if len(rows) == chunk_size:
+                yield header, _select(_to_columns(rows, header), time_window, kind_indexes)
+                rows = []
+        if rows:
+            yield header, _select(_to_columns(rows, header), time_window, kind_indexes)
+
+
+def read_obs_seq(
+    path: typing.Union[str, pathlib.Path],
+    time_window: tuple = None,
+    kinds: list = None,
+    chunk_size: int = 100000
+) -> typing.Tuple[ObsSeqHeader, dict]:
+    """Read the (selected) observations of an obs_seq file, see iter_obs_seq."""
+    header = None
+    chunks = []
+    for header, columns in iter_obs_seq(path, time_window, kinds, chunk_size):
+        chunks.append(columns)
+
+    if header is None:
+        header = read_obs_seq_header(path)
+    if not chunks:
+        return header, {}
+
+    return header, {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
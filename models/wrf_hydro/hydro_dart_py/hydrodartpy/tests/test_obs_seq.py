@@ -0,0 +1,99 @@
+import struct
+
+import numpy as np
+import pytest
+
+from hydrodartpy.core import obs_seq
+
+# round trip tests of the obs_seq reader, on small ASCII and binary files
+# written here in the layout of obs_seq_write in obs_sequence_mod.f90
+
+type_definitions = {1: 'STREAM_FLOW', 2: 'GAUGE_HEIGHT'}
+copy_names = ['observation', 'prior ensemble mean']
+qc_names = ['DART quality control']
+# values, qc, lon, lat (degrees), vertical, which_vert, kind, seconds, days, error variance
+observations = [
+    ([12.5, 11.0], [0.0], -97.5, 32.25, 0.0, -1, 1, 43200, 154000, 0.25),
+    ([3.0, -888888.0], [7.0], -96.0, 33.5, 0.0, -1, 2, 0, 154001, 1.5),
+    ([7.75, 8.0], [0.0], -95.25, 31.0, 0.0, -1, 1, 3600, 154001, 0.5),
+]
+
+
+def write_ascii_obs_seq(path):
+    lines = ['obs_sequence', 'obs_type_definitions', f'{len(type_definitions)}']
+    lines += [f'{index} {name}' for index, name in type_definitions.items()]
+    lines += [f'  num_copies: {len(copy_names)}  num_qc: {len(qc_names)}',
+              f'  num_obs: {len(observations)}  max_num_obs: {len(observations)}']
+    lines += copy_names + qc_names + [f'  first: 1  last: {len(observations)}']
+    for key, (values, qc, lon, lat, vertical, which_vert, kind, seconds, days, variance) in enumerate(observations, 1):
+        lines.append(f' OBS {key}')
+        lines += [repr(value) for value in values] + [repr(value) for value in qc]
+        lines += [f'{key - 1} {key + 1 if key < len(observations) else -1} -1', 'obdef', 'loc3d']
+        lines.append(f'{float(np.radians(lon))!r} {float(np.radians(lat))!r} {vertical!r} {which_vert}')
+        lines += ['kind', f'{kind}', f'{seconds} {days}', repr(variance)]
+
+    with open(path, 'w') as obs_seq_file:
+        obs_seq_file.write('\n'.join(lines) + '\n')
+
+
+def write_binary_obs_seq(path, endian):
+    # unformatted Fortran sequential file: every record is framed by 4 byte length markers
+    records = [b'obs_sequence', b'obs_type_definitions', struct.pack(endian + 'i', len(type_definitions))]
+    records += [struct.pack(endian + 'i', index) + name.ljust(32).encode('ascii') for index, name in type_definitions.items()]
+    records.append(struct.pack(endian + '4i', len(copy_names), len(qc_names), len(observations), len(observations)))
+    records += [name.ljust(64).encode('ascii') for name in copy_names + qc_names]
+    records.append(struct.pack(endian + '2i', 1, len(observations)))
+    for key, (values, qc, lon, lat, vertical, which_vert, kind, seconds, days, variance) in enumerate(observations, 1):
+        records += [struct.pack(endian + 'd', value) for value in values + qc]
+        records.append(struct.pack(endian + '3i', key - 1, key + 1 if key < len(observations) else -1, -1))
+        records.append(struct.pack(endian + '3di', np.radians(lon), np.radians(lat), vertical, which_vert))
+        records.append(struct.pack(endian + 'i', kind))
+        records.append(struct.pack(endian + '2i', seconds, days))
+        records.append(struct.pack(endian + 'd', variance))
+
+    with open(path, 'wb') as obs_seq_file:
+        for record in records:
+            marker = struct.pack(endian + 'i', len(record))
+            obs_seq_file.write(marker + record + marker)
+
+
+@pytest.fixture(params=['ascii', '<', '>'], ids=['ascii', 'little-endian', 'big-endian'])
+def obs_seq_path(request, tmp_path):
+    path = tmp_path / 'obs_seq.final'
+    if request.param == 'ascii':
+        write_ascii_obs_seq(path)
+    else:
+        write_binary_obs_seq(path, request.param)
+    return path
+
+
+def test_detect_format(obs_seq_path):
+    header = obs_seq.read_obs_seq_header(obs_seq_path)
+    assert obs_seq.detect_format(obs_seq_path) == header.format
+    assert header.type_definitions == type_definitions
+    assert header.copy_names == copy_names
+    assert header.qc_names == qc_names
+    assert (header.num_obs, header.first, header.last) == (3, 1, 3)
+
+
+def test_read_obs_seq(obs_seq_path):
+    header, columns = obs_seq.read_obs_seq(obs_seq_path)
+    assert columns['key'].tolist() == [1, 2, 3]
+    np.testing.assert_array_equal(columns['values'], [values for values, *_ in observations])
+    np.testing.assert_array_equal(columns['qc'], [obs[1] for obs in observations])
+    assert columns['kind'].tolist() == [obs[6] for obs in observations]
+    np.testing.assert_allclose(columns['location'], [obs[2:5] for obs in observations])
+    assert columns['which_vert'].tolist() == [-1, -1, -1]
+    np.testing.assert_array_equal(columns['error_variance'], [obs[9] for obs in observations])
+    assert columns['time'][0] == obs_seq.dart_epoch + np.timedelta64(154000 * 86400 + 43200, 's')
+
+
+def test_read_obs_seq_selection(obs_seq_path):
+    day = obs_seq.dart_epoch + np.timedelta64(154001 * 86400, 's')
+    header, columns = obs_seq.read_obs_seq(obs_seq_path, time_window=(day, None), kinds=['STREAM_FLOW'])
+    assert columns['key'].tolist() == [3]
+
+
+def test_iter_obs_seq_chunks(obs_seq_path):
+    chunks = [columns['key'].tolist() for header, columns in obs_seq.iter_obs_seq(obs_seq_path, chunk_size=2)]
+    assert chunks == [[1, 2], [3]]